@@ -4,19 +4,40 @@ This module exposes a lightweight FastAPI application that allows
 authenticated users to spend their existing credits on image generation
 and text-to-speech conversions. Authentication is handled via per-user
 API tokens that can be managed inside the Telegram bot.
+
+Image jobs (``/v1/jobs/image``) return as soon as the Runway task is
+created; the shared :mod:`modules.generation_jobs` dispatcher polls every
+outstanding task from the ``generation_jobs`` table and settles the credits,
+and clients read the outcome from ``GET /v1/jobs/{id}`` or a signed webhook.
+The synchronous ``/v1/image`` queues the same kind of job and awaits its
+outcome, so no request thread is held while Runway renders.
 """
 from __future__ import annotations
 
+import asyncio
 import base64
+import functools
+import hashlib
+import hmac
+import ipaddress
+import json
 import logging
-from typing import Any
-
-from fastapi import Depends, FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+import requests
+from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, Field
 
 import db
+from modules import generation_jobs, http_client
 from modules.image.service import ImageGenerationError, ImageService
 from modules.image.settings import (
     CREDIT_COST as IMAGE_CREDIT_COST,
@@ -25,7 +46,7 @@ from modules.image.settings import (
     POLL_TIMEOUT,
     get_ratio_for_size,
 )
-from modules.tts.service import synthesize
+from modules.tts.service import iter_audio, synthesize_cached
 from modules.tts.settings import (
     BANNED_WORDS,
     CREDIT_PER_CHAR,
@@ -38,6 +59,7 @@ logger = logging.getLogger(__name__)
 
 # Ensure the database schema exists when the API server boots.
 db.init_db()
+db.start_maintenance()
 
 app = FastAPI(
     title="Vexa API",
@@ -47,6 +69,51 @@ app = FastAPI(
 
 _api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 
+# Blocking work runs on bounded pools so the event loop keeps serving other
+# clients meanwhile. Provider calls (Runway submits, ElevenLabs synthesis) use
+# ``_blocking_executor``, whose bound caps how many upstream generations a
+# single API process runs at once. Authentication and every other sqlite call
+# use the small ``_db_executor``, so slow providers never stall them.
+try:
+    _BLOCKING_WORKERS = max(1, int(os.getenv("API_BLOCKING_WORKERS", "16")))
+except ValueError:
+    _BLOCKING_WORKERS = 16
+_blocking_executor = ThreadPoolExecutor(
+    max_workers=_BLOCKING_WORKERS,
+    thread_name_prefix="api-blocking",
+)
+try:
+    _DB_WORKERS = max(1, int(os.getenv("API_DB_WORKERS", "4")))
+except ValueError:
+    _DB_WORKERS = 4
+_db_executor = ThreadPoolExecutor(max_workers=_DB_WORKERS, thread_name_prefix="api-db")
+
+_T = TypeVar("_T")
+
+_IMAGE_JOB_KIND = "api_image"
+try:
+    _IMAGE_BATCH_MAX = max(1, int(os.getenv("API_IMAGE_BATCH_MAX", "20")))
+except ValueError:
+    _IMAGE_BATCH_MAX = 20
+
+# Webhooks are sent off the dispatcher threads so a slow receiver never
+# delays polling of other jobs.
+_WEBHOOK_ATTEMPTS = 3
+_webhook_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="api-webhook")
+
+_image_service: ImageService | None = None
+_image_service_lock = threading.Lock()
+
+
+async def _run_blocking(func: Callable[..., _T], *args: Any, **kwargs: Any) -> _T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+async def _run_db(func: Callable[..., _T], *args: Any, **kwargs: Any) -> _T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
 
 class ImageRequest(BaseModel):
     prompt: str = Field(..., description="Text prompt that describes the desired image")
@@ -74,6 +141,45 @@ class ImageResponse(BaseModel):
     credits_remaining: float
 
 
+class ImageJobRequest(ImageRequest):
+    webhook_url: str | None = Field(
+        default=None,
+        description="Optional URL that receives a signed POST when the job finishes",
+    )
+
+
+class ImageBatchRequest(BaseModel):
+    prompts: list[str] = Field(..., description="Text prompts; one job is created per prompt")
+    size: str | None = Field(default=None, description="Optional preset size key applied to every prompt")
+    ratio: str | None = Field(default=None, description="Optional explicit Runway ratio applied to every prompt")
+    webhook_url: str | None = Field(
+        default=None,
+        description="Optional URL that receives a signed POST for each finished job",
+    )
+
+
+class JobResponse(BaseModel):
+    job_id: int | None
+    status: str
+    image_url: str | None = None
+    error: str | None = None
+    created_at: int | None = None
+    updated_at: int | None = None
+
+
+class JobSubmitResponse(BaseModel):
+    job_id: int
+    status: str
+    credits_charged: float
+    credits_remaining: float
+
+
+class BatchSubmitResponse(BaseModel):
+    jobs: list[JobResponse]
+    credits_charged: float
+    credits_remaining: float
+
+
 class TTSRequest(BaseModel):
     text: str = Field(..., description="Text that should be converted to speech")
     voice_id: str | None = Field(
@@ -135,71 +241,17 @@ def _decode_reference_image(encoded: str) -> bytes:
         raise ValueError("Reference image is not valid base64 data") from exc
 
 
-def _extract_image_url(data: Any, _visited: set[int] | None = None) -> str | None:
-    if _visited is None:
-        _visited = set()
-    data_id = id(data)
-    if data_id in _visited:
-        return None
-    _visited.add(data_id)
-
-    if isinstance(data, str):
-        candidate = data.strip()
-        if any(candidate.startswith(prefix) for prefix in ("http://", "https://")):
-            return candidate
-        return None
-
-    if isinstance(data, dict):
-        priority_keys = (
-            "url",
-            "image_url",
-            "output_url",
-            "result_url",
-            "download_url",
-            "file_url",
-            "asset_url",
-            "src",
-            "href",
-            "link",
-            "path",
-            "uri",
-            "output",
-        )
-        for key in priority_keys:
-            if key in data:
-                url = _extract_image_url(data[key], _visited)
-                if url:
-                    return url
-        lower_priority = {key.lower() for key in priority_keys}
-        for key, value in data.items():
-            if key.lower() in lower_priority:
-                continue
-            url = _extract_image_url(value, _visited)
-            if url:
-                return url
-        return None
-
-    if isinstance(data, (list, tuple, set)):
-        for item in data:
-            url = _extract_image_url(item, _visited)
-            if url:
-                return url
-        return None
-
-    return None
-
-
 async def _get_current_user(api_key: str = Depends(_api_key_header)):
     if not api_key:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="API key is missing")
 
-    user = db.get_user_by_api_token(api_key)
+    user = await _run_db(db.get_user_by_api_token, api_key)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key")
     if user.get("banned"):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User is banned")
 
-    db.touch_last_seen(user["user_id"])
+    await _run_db(db.touch_last_seen, user["user_id"])
     return user
 
 
@@ -209,81 +261,361 @@ async def generate_image(payload: ImageRequest, current_user=Depends(_get_curren
     if not prompt:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Prompt must not be empty")
 
-    fresh = db.get_user(current_user["user_id"]) or current_user
-    credits = float(fresh.get("credits") or 0)
-    if credits < IMAGE_CREDIT_COST:
+    ratio = _resolve_ratio(payload.size, payload.ratio)
+    service = _get_image_service()
+    reference_bytes = _reference_bytes(payload)
+
+    # Reserve the credits before Runway is asked to do any paid work.
+    user_id = current_user["user_id"]
+    hold_id, remaining = await _run_db(
+        db.hold_credits,
+        user_id,
+        IMAGE_CREDIT_COST,
+        reason="api_image",
+        ttl=generation_jobs.hold_ttl(POLL_TIMEOUT),
+    )
+    if not hold_id:
         raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
 
-    size_key = (payload.size or "").strip().lower() or None
-    ratio = payload.ratio.strip() if payload.ratio else None
+    # The task is polled (and the hold settled) by the job dispatcher like any
+    # other image job; this request only waits for the outcome, without
+    # holding a worker thread through the generation.
+    job_id = await _start_image_job(
+        service, user_id, hold_id, prompt, reference_bytes, payload.mime_type, ratio, ""
+    )
+    job = await _wait_for_job(job_id)
+    if not job or job["status"] != "succeeded":
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=(job or {}).get("error") or "Image generation failed",
+        )
+
+    return ImageResponse(
+        image_url=job["result_url"],
+        credits_charged=float(IMAGE_CREDIT_COST),
+        credits_remaining=remaining,
+    )
+
+
+def _resolve_ratio(size: str | None, ratio: str | None) -> str | None:
+    size_key = (size or "").strip().lower() or None
+    ratio = ratio.strip() if ratio else None
 
     if size_key:
         if size_key not in IMAGE_SIZE_OPTIONS:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid size preset")
-        ratio = get_ratio_for_size(size_key)
-    elif ratio and ":" not in ratio:
+        return get_ratio_for_size(size_key)
+    if ratio and ":" not in ratio:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid ratio format")
+    return ratio
+
 
+def _reference_bytes(payload: ImageRequest) -> bytes | None:
+    if not payload.reference_image:
+        return None
     try:
-        service = ImageService()
-    except ImageGenerationError as exc:
-        logger.exception("Image service not configured", exc_info=exc)
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)) from exc
+        return _decode_reference_image(payload.reference_image)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
 
-    reference_bytes = None
-    mime_type = payload.mime_type
-    if payload.reference_image:
-        try:
-            reference_bytes = _decode_reference_image(payload.reference_image)
-        except ValueError as exc:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc)) from exc
 
+def _get_image_service() -> ImageService:
+    """Shared Runway client, so submits and the job poller reuse one session."""
+
+    global _image_service
+    with _image_service_lock:
+        if _image_service is None:
+            try:
+                _image_service = ImageService()
+            except ImageGenerationError as exc:
+                logger.exception("Image service not configured", exc_info=exc)
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc)
+                ) from exc
+        return _image_service
+
+
+async def _submit_image_task(service, prompt, reference_bytes, mime_type, ratio) -> str:
     try:
         if reference_bytes is not None:
-            task_id = service.generate_image_from_image(
+            return await _run_blocking(
+                service.generate_image_from_image,
                 prompt,
                 reference_bytes,
                 mime_type=mime_type,
                 ratio=ratio,
             )
-        else:
-            task_id = service.generate_image(prompt, ratio=ratio)
-
-        result = service.get_image_status(
-            task_id,
-            poll_interval=POLL_INTERVAL,
-            timeout=POLL_TIMEOUT,
-        )
+        return await _run_blocking(service.generate_image, prompt, ratio=ratio)
     except ImageGenerationError as exc:
         logger.exception("Image generation failed", exc_info=exc)
         raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=str(exc)) from exc
 
-    image_url = result.get("url") or _extract_image_url(result)
-    if not image_url:
-        logger.error("Could not extract image URL from response: %s", result)
-        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Image URL not found in provider response")
 
-    if not db.deduct_credits(current_user["user_id"], IMAGE_CREDIT_COST):
-        logger.warning("Credit deduction failed after image generation", extra={"user_id": current_user["user_id"]})
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Unable to deduct credits")
+async def _wait_for_job(job_id: int) -> dict | None:
+    """The job once the dispatcher has finished it (it enforces the deadline)."""
+
+    while True:
+        await asyncio.sleep(generation_jobs.TICK_SECONDS)
+        job = await _run_db(db.get_generation_job, job_id)
+        if job is None or job["status"] != "pending":
+            return job
+
+
+# ----------------- image jobs -----------------
+def _webhook_url_error(url: str) -> str | None:
+    """Why ``url`` cannot receive webhooks, or ``None`` when it can.
+
+    Its host must resolve to public addresses only, so API users cannot make
+    the server call loopback, private, link-local or reserved addresses
+    (cloud metadata endpoints among them).
+    """
+
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        return "Invalid webhook URL"
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        return "Invalid webhook URL"
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return "Webhook host does not resolve"
+    for *_info, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            return "Webhook URL must point to a public address"
+    return None
+
+
+async def _check_webhook_url(url: str | None) -> str:
+    url = (url or "").strip()
+    if url:
+        error = await _run_blocking(_webhook_url_error, url)
+        if error:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+    return url
+
+
+def _hold_batch(user_id: int, count: int) -> list[int] | None:
+    """One hold per job, or none at all when the user cannot pay for every job."""
+
+    hold_ids: list[int] = []
+    for _ in range(count):
+        hold_id, _balance = db.hold_credits(
+            user_id,
+            IMAGE_CREDIT_COST,
+            reason="api_image",
+            ttl=generation_jobs.hold_ttl(POLL_TIMEOUT),
+        )
+        if not hold_id:
+            for held in hold_ids:
+                db.release_hold(held)
+            return None
+        hold_ids.append(hold_id)
+    return hold_ids
+
+
+async def _start_image_job(
+    service, user_id, hold_id, prompt, reference_bytes, mime_type, ratio, webhook_url
+) -> int:
+    """Create the Runway task and queue it; the hold is refunded on failure."""
 
     try:
-        db.log_image_generation(current_user["user_id"], prompt, image_url)
+        task_id = await _submit_image_task(service, prompt, reference_bytes, mime_type, ratio)
+        return await _run_db(
+            generation_jobs.submit,
+            _IMAGE_JOB_KIND,
+            user_id=user_id,
+            chat_id=0,
+            task_id=task_id,
+            lang="",
+            prompt=prompt,
+            cost=IMAGE_CREDIT_COST,
+            timeout=POLL_TIMEOUT,
+            hold_id=hold_id,
+            webhook_url=webhook_url,
+        )
     except Exception:
-        logger.exception("Failed to log image generation", extra={"user_id": current_user["user_id"]})
+        await _run_db(db.release_hold, hold_id)
+        raise
 
-    updated = db.get_user(current_user["user_id"]) or fresh
-    remaining = float(updated.get("credits") or 0)
 
-    return ImageResponse(
-        image_url=image_url,
+@app.post("/v1/jobs/image", response_model=JobSubmitResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_image_job(payload: ImageJobRequest, current_user=Depends(_get_current_user)):
+    prompt = (payload.prompt or "").strip()
+    if not prompt:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Prompt must not be empty")
+
+    ratio = _resolve_ratio(payload.size, payload.ratio)
+    webhook_url = await _check_webhook_url(payload.webhook_url)
+    service = _get_image_service()
+    reference_bytes = _reference_bytes(payload)
+
+    user_id = current_user["user_id"]
+    hold_id, remaining = await _run_db(
+        db.hold_credits,
+        user_id,
+        IMAGE_CREDIT_COST,
+        reason="api_image",
+        ttl=generation_jobs.hold_ttl(POLL_TIMEOUT),
+    )
+    if not hold_id:
+        raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
+
+    job_id = await _start_image_job(
+        service, user_id, hold_id, prompt, reference_bytes, payload.mime_type, ratio, webhook_url
+    )
+    return JobSubmitResponse(
+        job_id=job_id,
+        status="pending",
         credits_charged=float(IMAGE_CREDIT_COST),
         credits_remaining=remaining,
     )
 
 
-@app.post("/v1/tts", response_model=TTSResponse)
-async def text_to_speech(payload: TTSRequest, current_user=Depends(_get_current_user)):
+@app.post("/v1/jobs/image:batch", response_model=BatchSubmitResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_image_batch(payload: ImageBatchRequest, current_user=Depends(_get_current_user)):
+    prompts = [(prompt or "").strip() for prompt in payload.prompts]
+    if not prompts or not all(prompts):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Prompts must not be empty")
+    if len(prompts) > _IMAGE_BATCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {_IMAGE_BATCH_MAX} prompts per batch",
+        )
+
+    ratio = _resolve_ratio(payload.size, payload.ratio)
+    webhook_url = await _check_webhook_url(payload.webhook_url)
+    service = _get_image_service()
+
+    user_id = current_user["user_id"]
+    hold_ids = await _run_db(_hold_batch, user_id, len(prompts))
+    if hold_ids is None:
+        raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
+
+    # Runway tasks are created concurrently; a prompt that Runway rejects is
+    # reported as failed (and refunded) without affecting the others.
+    results = await asyncio.gather(
+        *(
+            _start_image_job(service, user_id, hold_id, prompt, None, None, ratio, webhook_url)
+            for hold_id, prompt in zip(hold_ids, prompts)
+        ),
+        return_exceptions=True,
+    )
+    jobs = []
+    for result in results:
+        if isinstance(result, HTTPException):
+            jobs.append(JobResponse(job_id=None, status="failed", error=str(result.detail)))
+        elif isinstance(result, BaseException):
+            logger.error("Failed to queue image job: %s", result)
+            jobs.append(JobResponse(job_id=None, status="failed", error="Failed to queue job"))
+        else:
+            jobs.append(JobResponse(job_id=result, status="pending"))
+
+    user = await _run_db(db.get_user, user_id)
+    queued = sum(1 for job in jobs if job.job_id)
+    return BatchSubmitResponse(
+        jobs=jobs,
+        credits_charged=float(IMAGE_CREDIT_COST * queued),
+        credits_remaining=(user or {}).get("credits", 0),
+    )
+
+
+@app.get("/v1/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: int, current_user=Depends(_get_current_user)):
+    job = await _run_db(db.get_generation_job, job_id, current_user["user_id"])
+    if not job or job["kind"] != _IMAGE_JOB_KIND:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return JobResponse(
+        job_id=job["id"],
+        status=job["status"],
+        image_url=job["result_url"] or None,
+        error=job["error"] or None,
+        created_at=job["created_at"],
+        updated_at=job["updated_at"],
+    )
+
+
+def _poll_image_job(task_id: str) -> dict | None:
+    return _get_image_service().check_image_status(task_id)
+
+
+def _deliver_image_job(_bot, job: dict, result: dict) -> None:
+    generation_jobs.capture(job)
+    try:
+        db.log_image_generation(job["user_id"], job["prompt"], result["url"])
+    except Exception:
+        logger.exception("Failed to log image generation", extra={"user_id": job["user_id"]})
+    _send_job_webhook(job, "succeeded", image_url=result["url"])
+
+
+def _fail_image_job(_bot, job: dict, error: str) -> None:
+    _send_job_webhook(job, "failed", error=error)
+
+
+def _send_job_webhook(job: dict, job_status: str, *, image_url: str | None = None,
+                      error: str | None = None) -> None:
+    if not job.get("webhook_url"):
+        return
+    body = json.dumps(
+        {"job_id": job["id"], "status": job_status, "image_url": image_url, "error": error},
+        ensure_ascii=False,
+    ).encode("utf-8")
+    _webhook_executor.submit(_post_webhook, job["user_id"], job["webhook_url"], body)
+
+
+def _post_webhook(user_id: int, url: str, body: bytes) -> None:
+    """POST ``body`` signed with HMAC-SHA256 of the user's webhook secret."""
+
+    secret = db.get_webhook_secret(user_id)
+    signature = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    headers = {"Content-Type": "application/json", "X-Vexa-Signature": f"sha256={signature}"}
+    for attempt in range(_WEBHOOK_ATTEMPTS):
+        # Checked again before every send: the host may resolve elsewhere now.
+        error = _webhook_url_error(url)
+        if error:
+            logger.warning("Webhook %s refused: %s", url, error)
+            return
+        try:
+            response = http_client.request(
+                "webhook", "POST", url, data=body, headers=headers, allow_redirects=False
+            )
+            if response.status_code < 500:
+                if response.status_code >= 400:
+                    logger.warning("Webhook %s rejected with %s", url, response.status_code)
+                return
+        except requests.RequestException as exc:
+            logger.warning("Webhook %s failed: %s", url, exc)
+        if attempt + 1 < _WEBHOOK_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    logger.error("Giving up on webhook %s", url)
+
+
+@app.get("/v1/webhooks/secret")
+async def get_webhook_secret(current_user=Depends(_get_current_user)):
+    """Return the key that signs this user's webhooks."""
+    secret = await _run_db(db.get_webhook_secret, current_user["user_id"])
+    return JSONResponse({"secret": secret})
+
+
+def _wants_binary_audio(request: Request, mime_type: str) -> bool:
+    accept = (request.headers.get("accept") or "").lower()
+    return mime_type.lower() in accept or "audio/*" in accept
+
+
+@app.post(
+    "/v1/tts",
+    response_model=TTSResponse,
+    responses={200: {"content": {"audio/mpeg": {}}, "description": "JSON, or raw audio when requested via Accept"}},
+)
+async def text_to_speech(
+    payload: TTSRequest,
+    request: Request,
+    current_user=Depends(_get_current_user),
+):
     text = (payload.text or "").strip()
     if not text:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Text must not be empty")
@@ -302,41 +634,130 @@ async def text_to_speech(payload: TTSRequest, current_user=Depends(_get_current_
     if cost <= 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Text is too short")
 
-    fresh = db.get_user(current_user["user_id"]) or current_user
-    credits = float(fresh.get("credits") or 0)
-    if credits < cost:
+    hold_id, remaining = await _run_db(
+        db.hold_credits, current_user["user_id"], cost, reason="api_tts"
+    )
+    if not hold_id:
         raise HTTPException(status_code=status.HTTP_402_PAYMENT_REQUIRED, detail="Insufficient credits")
 
+    mime_type = payload.mime_type or "audio/mpeg"
+    if _wants_binary_audio(request, mime_type):
+        return await _stream_tts(
+            current_user["user_id"], text, voice_id, normalized_voice, mime_type, cost, remaining, hold_id
+        )
+
     try:
-        audio_bytes = synthesize(text, voice_id, payload.mime_type or "audio/mpeg")
+        audio = await _run_blocking(synthesize_cached, text, voice_id, mime_type)
+        audio_bytes = await _run_blocking(audio.read)
     except Exception as exc:
+        await _run_db(db.release_hold, hold_id)
         logger.exception("TTS synthesis failed", exc_info=exc)
         raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="TTS synthesis failed") from exc
-
-    if not db.deduct_credits(current_user["user_id"], cost):
-        logger.warning("Credit deduction failed after TTS", extra={"user_id": current_user["user_id"]})
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Unable to deduct credits")
+    await _run_db(db.capture_hold, hold_id)
 
     try:
-        db.log_tts_request(current_user["user_id"], text)
+        await _run_db(db.log_tts_request, current_user["user_id"], text)
     except Exception:
         logger.exception("Failed to log TTS request", extra={"user_id": current_user["user_id"]})
 
-    updated = db.get_user(current_user["user_id"]) or fresh
-    remaining = float(updated.get("credits") or 0)
-
     audio_base64 = base64.b64encode(audio_bytes).decode("ascii")
     return TTSResponse(
         audio_base64=audio_base64,
-        mime_type=payload.mime_type or "audio/mpeg",
+        mime_type=mime_type,
         voice_id=normalized_voice,
         credits_charged=cost,
         credits_remaining=remaining,
     )
 
 
+async def _stream_tts(
+    user_id: int,
+    text: str,
+    voice_id: str,
+    voice_name: str,
+    mime_type: str,
+    cost: float,
+    remaining: float,
+    hold_id: int,
+) -> StreamingResponse:
+    """Binary mode of /v1/tts: audio bytes are forwarded as they arrive.
+
+    The first chunk is awaited before answering, so upstream failures still
+    map to a 502. The hold is captured only once the whole body was sent.
+    """
+
+    chunks = iter_audio(text, voice_id, mime_type)
+    try:
+        first = await _run_blocking(next, chunks, None)
+    except Exception as exc:
+        await _run_db(db.release_hold, hold_id)
+        logger.exception("TTS synthesis failed", exc_info=exc)
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="TTS synthesis failed") from exc
+
+    async def body():
+        completed = False
+        pending = None
+        try:
+            chunk = first
+            while chunk is not None:
+                yield chunk
+                pending = _blocking_executor.submit(next, chunks, None)
+                chunk = await asyncio.wrap_future(pending)
+            completed = True
+        finally:
+            # Nothing here is awaited: after a disconnect the task is being
+            # cancelled and any await would be cancelled too, leaving the
+            # hold locked until the expiry sweep.
+            _db_executor.submit(_settle_tts_stream, completed, user_id, text, hold_id)
+            if not completed:
+                # The generator cannot be closed while a ``next`` is still
+                # running in a worker thread; close it once that returns.
+                if pending is not None and not pending.done():
+                    pending.add_done_callback(lambda _future: _close_audio_chunks(chunks))
+                else:
+                    _blocking_executor.submit(_close_audio_chunks, chunks)
+
+    headers = {
+        "X-Voice-Id": voice_name,
+        "X-Credits-Charged": str(cost),
+        "X-Credits-Remaining": str(remaining),
+    }
+    return StreamingResponse(body(), media_type=mime_type, headers=headers)
+
+
+def _settle_tts_stream(completed: bool, user_id: int, text: str, hold_id: int) -> None:
+    if not completed:
+        # Upstream error or client went away: nothing is charged.
+        db.release_hold(hold_id)
+        return
+    db.capture_hold(hold_id)
+    try:
+        db.log_tts_request(user_id, text)
+    except Exception:
+        logger.exception("Failed to log TTS request", extra={"user_id": user_id})
+
+
+def _close_audio_chunks(chunks) -> None:
+    try:
+        chunks.close()
+    except Exception:
+        logger.exception("Failed to close the TTS audio stream")
+
+
 @app.get("/v1/voices")
 async def list_voices(current_user=Depends(_get_current_user)):
     """Return the list of available voice identifiers."""
     voices = [{"id": name, "voice_id": voice_id} for name, voice_id in _DEFAULT_VOICES.items()]
     return JSONResponse({"voices": voices})
+
+
+# Jobs left pending by a previous run are picked up again here.
+generation_jobs.register_kind(
+    _IMAGE_JOB_KIND,
+    poll=_poll_image_job,
+    deliver=_deliver_image_job,
+    fail=_fail_image_job,
+    poll_interval=POLL_INTERVAL,
+    timeout_message="Image generation timed out",
+)
+generation_jobs.start(None)
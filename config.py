@@ -117,23 +117,42 @@ _DEFAULT_SYSTEM_PROMPT = (
     "Do not push Vexa for unrelated topics, and never mention external tools or services."
 )
 GPT_SYSTEM_PROMPT = (os.getenv("GPT_SYSTEM_PROMPT") or _DEFAULT_SYSTEM_PROMPT).strip() or _DEFAULT_SYSTEM_PROMPT
-GPT_HISTORY_LIMIT = max(1, _parse_int(os.getenv("GPT_HISTORY_LIMIT", "6"), 6))
+# حداکثر تعداد پیام اخیر که برای چیدن تاریخچه خوانده می‌شود؛ چیزی که واقعاً ارسال می‌شود
+# را بودجهٔ توکن GPT_HISTORY_TOKENS تعیین می‌کند
+GPT_HISTORY_LIMIT = max(1, _parse_int(os.getenv("GPT_HISTORY_LIMIT", "20"), 20))
+# بودجهٔ تقریبی توکن برای تاریخچه (همراه خلاصه)؛ از جدیدترین پیام پر می‌شود
+GPT_HISTORY_TOKENS = max(100, _parse_int(os.getenv("GPT_HISTORY_TOKENS", "800"), 800))
+# پیام‌هایی که در بودجه جا نمی‌شوند در پس‌زمینه در یک خلاصهٔ جاری برای هر کاربر جمع می‌شوند
+GPT_SUMMARY = (os.getenv("GPT_SUMMARY", "1") or "1").strip() == "1"
+GPT_SUMMARY_TOKENS = max(50, _parse_int(os.getenv("GPT_SUMMARY_TOKENS", "250"), 250))
+# خلاصه وقتی به‌روز می‌شود که دست‌کم این تعداد پیام بیرون‌افتاده و خلاصه‌نشده جمع شده باشد
+GPT_SUMMARY_MIN_MESSAGES = max(1, _parse_int(os.getenv("GPT_SUMMARY_MIN_MESSAGES", "4"), 4))
 GPT_TEMPERATURE = min(2.0, max(0.0, _parse_float(os.getenv("GPT_TEMPERATURE"), 0.7)))
 GPT_TOP_P = min(1.0, max(0.0, _parse_float(os.getenv("GPT_TOP_P"), 1.0)))
 GPT_MAX_TOKENS = max(0, _parse_int(os.getenv("GPT_MAX_TOKENS"), 400))
 GPT_MESSAGE_COST = _parse_float(os.getenv("GPT_MESSAGE_COST", "1"), 1.0)
 GPT_SEARCH_MESSAGE_COST = _parse_float(os.getenv("GPT_SEARCH_MESSAGE_COST", "1"), 1.0)
+# کش نتایج جستجوی وب بر حسب متن نرمال‌شدهٔ پرسش (ثانیه)؛ پرسش‌های قیمت/خبر عمر کوتاه‌تری دارند
+GPT_SEARCH_CACHE_TTL = max(0, _parse_int(os.getenv("GPT_SEARCH_CACHE_TTL", "21600"), 21600))
+GPT_SEARCH_LIVE_TTL = max(0, _parse_int(os.getenv("GPT_SEARCH_LIVE_TTL", "120"), 120))
+GPT_SEARCH_CACHE_SIZE = max(0, _parse_int(os.getenv("GPT_SEARCH_CACHE_SIZE", "2000"), 2000))
 
 GPT_RESPONSE_CHAR_LIMIT = max(
     0,
     _parse_int(os.getenv("GPT_RESPONSE_CHAR_LIMIT", "900"), 900),
 )
+# پاسخ GPT به‌صورت استریم (SSE) خوانده و پیام «در حال فکر» چند بار ویرایش می‌شود
+GPT_STREAM = (os.getenv("GPT_STREAM", "1") or "1").strip() == "1"
+# حداقل فاصلهٔ دو ویرایش پیام بر حسب ثانیه (محدودیت ویرایش تلگرام)
+GPT_STREAM_EDIT_INTERVAL = max(0.5, _parse_float(os.getenv("GPT_STREAM_EDIT_INTERVAL", "1.5"), 1.5))
+# در حالت استریم از سرویس خواسته می‌شود مصرف توکن (از جمله توکن‌های کش‌شدهٔ پرامپت) را هم بفرستد
+GPT_STREAM_USAGE = (os.getenv("GPT_STREAM_USAGE", "1") or "1").strip() == "1"
 
 VEXA_ASSISTANT_HISTORY_LIMIT = max(
     1,
     _parse_int(
-        os.getenv("VEXA_ASSISTANT_HISTORY_LIMIT", str(GPT_HISTORY_LIMIT)),
-        GPT_HISTORY_LIMIT,
+        os.getenv("VEXA_ASSISTANT_HISTORY_LIMIT", os.getenv("GPT_HISTORY_LIMIT", "6")),
+        6,
     ),
 )
 VEXA_ASSISTANT_MESSAGE_COST = _parse_float(
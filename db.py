@@ -1,18 +1,24 @@
+import atexit
 import csv
 import datetime
 import io
+import logging
 import mimetypes
 import os
 import secrets
 import sqlite3
 import tempfile
+import threading
 import time
 import zipfile
-from contextlib import closing
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from urllib.parse import urlparse
 
-import requests
+from modules import http_client
+
+logger = logging.getLogger(__name__)
 
 DB_DIR = os.getenv("DB_DIR", "/data")
 os.makedirs(DB_DIR, exist_ok=True)
@@ -20,8 +26,153 @@ DB_PATH = os.path.join(DB_DIR, "bot.db")
 
 print("DB_PATH =>", DB_PATH, flush=True)
 
-con = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = con.cursor()
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_choice(name: str, default: str, choices: set[str]) -> str:
+    value = (os.getenv(name) or default).strip().upper()
+    return value if value in choices else default
+
+
+# Storage profile applied to every connection. The bot, the API server and
+# background threads all share bot.db, so WAL lets readers run alongside the
+# single writer and busy_timeout makes writers wait instead of failing with
+# "database is locked".
+DB_JOURNAL_MODE = _env_choice(
+    "DB_JOURNAL_MODE", "WAL", {"WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY"}
+)
+DB_SYNCHRONOUS = _env_choice("DB_SYNCHRONOUS", "NORMAL", {"OFF", "NORMAL", "FULL", "EXTRA"})
+DB_BUSY_TIMEOUT_MS = max(0, _env_int("DB_BUSY_TIMEOUT_MS", 5000))
+DB_MMAP_SIZE = max(0, _env_int("DB_MMAP_SIZE", 256 * 1024 * 1024))
+# Negative values are KiB, positive values are pages (SQLite semantics).
+DB_CACHE_SIZE = _env_int("DB_CACHE_SIZE", -16000)
+DB_TEMP_STORE = _env_choice("DB_TEMP_STORE", "MEMORY", {"DEFAULT", "FILE", "MEMORY"})
+# Seconds between WAL checkpoints / PRAGMA optimize runs; 0 disables them.
+DB_MAINTENANCE_INTERVAL = max(0, _env_int("DB_MAINTENANCE_INTERVAL", 300))
+
+# sqlite3 keeps an LRU of compiled statements per connection; it has to be
+# large enough to hold every distinct query below so none are re-parsed.
+DB_STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def get_connection() -> sqlite3.Connection:
+    """Return the SQLite connection owned by the calling thread.
+
+    Every TeleBot worker, timer thread and the API server's event loop gets
+    exactly one connection which is opened lazily and then reused for all
+    helpers, instead of paying for ``connect`` and schema parsing per call.
+    """
+
+    con = getattr(_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(
+            DB_PATH,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        _apply_storage_profile(con)
+        _local.con = con
+        _local.depth = 0
+    return con
+
+
+def _apply_storage_profile(con: sqlite3.Connection) -> None:
+    con.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    con.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    con.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    con.execute(f"PRAGMA temp_store={DB_TEMP_STORE}")
+
+
+def close_connection() -> None:
+    """Close the calling thread's connection (a new one is opened on demand)."""
+
+    con = getattr(_local, "con", None)
+    _local.con = None
+    _local.depth = 0
+    if con is not None:
+        con.close()
+
+
+@contextmanager
+def transaction():
+    """Run a block of statements on the thread's connection atomically.
+
+    The outermost ``with db.transaction():`` commits on success and rolls back
+    on error; nested blocks (including the helpers in this module) join the
+    surrounding transaction, so several helper calls can be grouped into one
+    commit.
+    """
+
+    con = get_connection()
+    depth = _local.depth
+    _local.depth = depth + 1
+    try:
+        yield con
+    except BaseException:
+        if depth == 0:
+            con.rollback()
+            # States and history written inside the rolled back block are
+            # cached already.
+            _forget_cached_states()
+            _forget_cached_history()
+        raise
+    else:
+        if depth == 0:
+            con.commit()
+    finally:
+        _local.depth = depth
+
+
+_maintenance_thread: threading.Thread | None = None
+_maintenance_lock = threading.Lock()
+
+
+def run_maintenance() -> None:
+    """Checkpoint the WAL into the main file and refresh planner statistics.
+
+    A passive checkpoint never blocks readers or writers; it keeps the WAL
+    short so reads do not have to scan an ever-growing log.
+    """
+
+    con = get_connection()
+    if DB_JOURNAL_MODE == "WAL":
+        con.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    con.execute("PRAGMA optimize")
+
+
+def _maintenance_loop() -> None:
+    while True:
+        time.sleep(DB_MAINTENANCE_INTERVAL)
+        try:
+            run_maintenance()
+        except Exception as exc:
+            print("DB maintenance failed:", exc, flush=True)
+
+
+def start_maintenance() -> None:
+    """Start the periodic maintenance thread once per process."""
+
+    global _maintenance_thread
+    if DB_MAINTENANCE_INTERVAL <= 0:
+        return
+    with _maintenance_lock:
+        if _maintenance_thread is not None and _maintenance_thread.is_alive():
+            return
+        _maintenance_thread = threading.Thread(
+            target=_maintenance_loop,
+            name="db-maintenance",
+            daemon=True,
+        )
+        _maintenance_thread.start()
 
 
 _CREDIT_QUANTIZER = Decimal("0.01")
@@ -74,7 +225,7 @@ def _normalize_user_dict(keys, row):
     return data
 
 def init_db():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""CREATE TABLE IF NOT EXISTS users(
             user_id INTEGER PRIMARY KEY,
@@ -196,10 +347,100 @@ def init_db():
                 status TEXT NOT NULL DEFAULT 'pending'
             )"""
         )
-        con.commit()
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS generation_jobs(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                prompt TEXT DEFAULT '',
+                lang TEXT DEFAULT 'fa',
+                reply_to_message_id INTEGER DEFAULT 0,
+                status_message_id INTEGER DEFAULT 0,
+                cost INTEGER DEFAULT 0,
+                result_url TEXT DEFAULT '',
+                error TEXT DEFAULT '',
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL,
+                deadline_at INTEGER DEFAULT 0
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS broadcasts(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_chat_id INTEGER NOT NULL,
+                progress_message_id INTEGER DEFAULT 0,
+                lang_code TEXT DEFAULT 'all',
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                last_user_id INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS credit_ledger(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                delta REAL NOT NULL,
+                balance REAL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'done',
+                reason TEXT DEFAULT '',
+                ref TEXT DEFAULT '',
+                expires_at INTEGER DEFAULT 0,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS scheduled_tasks(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                dedup_key TEXT UNIQUE,
+                payload TEXT NOT NULL DEFAULT '{}',
+                run_at REAL NOT NULL,
+                created_at INTEGER NOT NULL
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS tts_cache(
+                cache_key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                mime TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                hits INTEGER DEFAULT 0,
+                created_at INTEGER NOT NULL,
+                last_used_at INTEGER NOT NULL
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS media_cache(
+                cache_key TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                last_used_at INTEGER NOT NULL,
+                PRIMARY KEY(cache_key, media_type)
+            )"""
+        )
+        cur.execute(
+            """CREATE TABLE IF NOT EXISTS gpt_summaries(
+                user_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                covered INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER NOT NULL
+            )"""
+        )
     _migrate_users_table()
     ensure_default_settings()
     _migrate_messages_kind()
+    _apply_schema_migrations()
 
 
 def ensure_default_settings():
@@ -227,7 +468,7 @@ def _generate_api_token() -> str:
 
 
 def get_api_token(user_id: int) -> str | None:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT token FROM api_tokens WHERE user_id=? LIMIT 1",
@@ -239,7 +480,7 @@ def get_api_token(user_id: int) -> str | None:
 
 def _upsert_api_token(user_id: int, token: str) -> str:
     now = int(time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO api_tokens(user_id, token, created_at, rotated_at)
@@ -250,7 +491,6 @@ def _upsert_api_token(user_id: int, token: str) -> str:
             """,
             (user_id, token, now, now),
         )
-        con.commit()
     return token
 
 
@@ -267,11 +507,34 @@ def rotate_api_token(user_id: int) -> str:
     return _upsert_api_token(user_id, token)
 
 
+def get_webhook_secret(user_id: int) -> str:
+    """Key that signs the user's webhooks; created on first use.
+
+    It is not the API token and survives token rotation, so callbacks of
+    jobs still running keep verifying. Empty for users without a token.
+    """
+
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("SELECT webhook_secret FROM api_tokens WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        if not row:
+            return ""
+        if row[0]:
+            return row[0]
+        cur.execute(
+            "UPDATE api_tokens SET webhook_secret=? WHERE user_id=? AND COALESCE(webhook_secret, '')=''",
+            (_generate_api_token(), user_id),
+        )
+        cur.execute("SELECT webhook_secret FROM api_tokens WHERE user_id=?", (user_id,))
+        return cur.fetchone()[0]
+
+
 def get_user_by_api_token(token: str):
     cleaned = (token or "").strip()
     if not cleaned:
         return None
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """SELECT u.user_id,u.username,u.first_name,u.joined_at,u.credits,u.ref_code,
@@ -303,21 +566,20 @@ def get_user_by_api_token(token: str):
 # User Voice Helpers
 # -------------------
 def add_user_voice(user_id:int, voice_name:str, voice_id:str):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""INSERT INTO user_voices(user_id,voice_name,voice_id,created_at)
                        VALUES(?,?,?,?)""",
                     (user_id, voice_name, voice_id, int(time.time())))
-        con.commit()
 
 def list_user_voices(user_id:int):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT voice_name,voice_id FROM user_voices WHERE user_id=? ORDER BY id DESC",(user_id,))
         return cur.fetchall() or []
 
 def get_user_voice(user_id:int, voice_name:str):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT voice_id FROM user_voices WHERE user_id=? AND voice_name=? LIMIT 1",(user_id,voice_name))
         r = cur.fetchone()
@@ -325,28 +587,27 @@ def get_user_voice(user_id:int, voice_name:str):
 
 def delete_user_voice_by_voice_id(voice_id:str):
     """حذف صدا از دیتابیس بر اساس voice_id"""
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM user_voices WHERE voice_id=?", (voice_id,))
-        con.commit()
         return cur.rowcount > 0
 
 def count_voice_clone_users() -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(DISTINCT user_id) FROM user_voices")
         row = cur.fetchone()
         return row[0] if row else 0
 
 def count_voice_clones() -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM user_voices")
         row = cur.fetchone()
         return row[0] if row else 0
 
 def list_voice_clones(limit: int = 20, offset: int = 0):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -377,7 +638,7 @@ def list_voice_clones(limit: int = 20, offset: int = 0):
     ]
 
 def get_voice_clone_by_id(voice_id: str):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -413,7 +674,7 @@ def list_disabled_voices(user_id: int, lang: str) -> set[str]:
     lang = (lang or "").strip()
     if not lang:
         return set()
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT voice_name FROM user_voice_disabled WHERE user_id=? AND lang=?",
@@ -427,7 +688,7 @@ def disable_user_voice(user_id: int, lang: str, voice_name: str) -> None:
     voice_name = (voice_name or "").strip()
     if not lang or not voice_name:
         return
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO user_voice_disabled(user_id, lang, voice_name, disabled_at)
@@ -436,20 +697,18 @@ def disable_user_voice(user_id: int, lang: str, voice_name: str) -> None:
                DO UPDATE SET disabled_at=excluded.disabled_at""",
             (user_id, lang, voice_name, int(time.time())),
         )
-        con.commit()
 
 def enable_user_voice(user_id: int, lang: str, voice_name: str) -> None:
     lang = (lang or "").strip()
     voice_name = (voice_name or "").strip()
     if not lang or not voice_name:
         return
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "DELETE FROM user_voice_disabled WHERE user_id=? AND lang=? AND voice_name=?",
             (user_id, lang, voice_name),
         )
-        con.commit()
 
 
 # -------------------
@@ -459,7 +718,7 @@ def list_global_disabled_voices(lang: str) -> set[str]:
     lang = (lang or "").strip()
     if not lang:
         return set()
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT voice_name FROM global_voice_disabled WHERE lang=?",
@@ -474,7 +733,7 @@ def disable_global_voice(lang: str, voice_name: str) -> None:
     voice_name = (voice_name or "").strip()
     if not lang or not voice_name:
         return
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO global_voice_disabled(lang, voice_name, disabled_at)
@@ -483,7 +742,6 @@ def disable_global_voice(lang: str, voice_name: str) -> None:
                DO UPDATE SET disabled_at=excluded.disabled_at""",
             (lang, voice_name, int(time.time())),
         )
-        con.commit()
 
 
 def enable_global_voice(lang: str, voice_name: str) -> None:
@@ -491,41 +749,42 @@ def enable_global_voice(lang: str, voice_name: str) -> None:
     voice_name = (voice_name or "").strip()
     if not lang or not voice_name:
         return
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "DELETE FROM global_voice_disabled WHERE lang=? AND voice_name=?",
             (lang, voice_name),
         )
-        con.commit()
 
 # 🟡 (بقیه توابع قبلی بدون تغییر می‌مونن)
 def get_setting(key, default=None):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT value FROM settings WHERE key=?", (key,))
         r = cur.fetchone()
         return r[0] if r else default
 
 def set_setting(key, value):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""INSERT INTO settings(key,value) VALUES(?,?)
                        ON CONFLICT(key) DO UPDATE SET value=excluded.value""",
                     (key, str(value)))
-        con.commit()
 
 def get_settings():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT key,value FROM settings")
         return dict(cur.fetchall())
 
 def touch_last_seen(user_id):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    now = int(time.time())
+    with transaction() as con:
         cur = con.cursor()
-        cur.execute("UPDATE users SET last_seen=? WHERE user_id=?", (int(time.time()), user_id))
-        con.commit()
+        cur.execute(
+            "UPDATE users SET last_seen=? WHERE user_id=? AND IFNULL(last_seen, 0)<=?",
+            (now, user_id, now - LAST_SEEN_REFRESH_SECONDS),
+        )
 
 
 
@@ -534,7 +793,7 @@ def get_user_by_username(username:str):
     uname = (username or "").strip()
     if uname.startswith("@"): uname = uname[1:]
     if not uname: return None
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""SELECT user_id,username,first_name,joined_at,credits,ref_code,referred_by,banned,last_seen
                        FROM users WHERE LOWER(username)=LOWER(?) LIMIT 1""", (uname,))
@@ -554,77 +813,227 @@ def get_user_by_username(username:str):
         ]
         return _normalize_user_dict(keys, row)
 
-def add_credits(user_id, amount):
+# --- credits: every balance change is one conditional UPDATE ... RETURNING
+# plus a credit_ledger row written in the same transaction.
+_CHARGE_SQL = """UPDATE users SET credits=ROUND(IFNULL(credits, 0) - ?, 2)
+                  WHERE user_id=? AND ROUND(IFNULL(credits, 0), 2) >= ?
+              RETURNING credits"""
+_CREDIT_SQL = """UPDATE users SET credits=ROUND(IFNULL(credits, 0) + ?, 2)
+                  WHERE user_id=?
+              RETURNING credits"""
+# Holds left open by a crashed worker are refunded once they are this old
+# (long-running jobs add their own timeout on top).
+CREDIT_HOLD_TTL = max(60, _env_int("CREDIT_HOLD_TTL", 900))
+
+
+def _record_ledger(cur, user_id, delta, balance, kind, reason="", ref="",
+                   status="done", expires_at=0) -> int:
+    now = int(time.time())
+    cur.execute(
+        """INSERT INTO credit_ledger(user_id, delta, balance, kind, status, reason, ref,
+                                     expires_at, created_at, updated_at)
+               VALUES(?,?,?,?,?,?,?,?,?,?)""",
+        (user_id, delta, balance, kind, status, reason or "", ref or "",
+         int(expires_at or 0), now, now),
+    )
+    return int(cur.lastrowid)
+
+
+def _charge(cur, user_id, amount) -> tuple[bool, float]:
+    cur.execute(_CHARGE_SQL, (amount, user_id, amount))
+    row = cur.fetchone()
+    if row is not None:
+        return True, normalize_credit_amount(row[0])
+    # Only the failure path reads the balance, to show it to the user.
+    cur.execute("SELECT credits FROM users WHERE user_id=?", (user_id,))
+    current = cur.fetchone()
+    return False, normalize_credit_amount(current[0] if current else 0)
+
+
+def add_credits(user_id, amount, *, reason="", ref=""):
+    """Add (or with a negative amount, remove) credits; returns the new balance."""
+
     amount = normalize_credit_amount(amount)
     if amount == 0:
-        return
+        return None
 
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
-        cur.execute("SELECT credits FROM users WHERE user_id=?", (user_id,))
+        cur.execute(_CREDIT_SQL, (amount, user_id))
         row = cur.fetchone()
         if not row:
-            return
+            return None
+        balance = normalize_credit_amount(row[0])
+        _record_ledger(cur, user_id, amount, balance, "credit" if amount > 0 else "debit", reason, ref)
+        return balance
 
-        current = normalize_credit_amount(row[0])
-        new_balance = normalize_credit_amount(current + amount)
 
-        cur.execute("UPDATE users SET credits=? WHERE user_id=?", (new_balance, user_id))
-        con.commit()
+def charge_credits(user_id, amount, *, reason="", ref="") -> tuple[bool, float]:
+    """Deduct ``amount`` only if the balance covers it, in one statement.
+
+    Returns ``(True, new_balance)`` on success and ``(False, balance)`` when
+    the user cannot pay (``0`` for unknown users).
+    """
+
+    amount = normalize_credit_amount(amount)
+    with transaction() as con:
+        cur = con.cursor()
+        ok, balance = _charge(cur, user_id, max(amount, 0))
+        if ok and amount > 0:
+            _record_ledger(cur, user_id, -amount, balance, "debit", reason, ref)
+        return ok, balance
+
 
-def deduct_credits(user_id, amount):
+def deduct_credits(user_id, amount, *, reason="", ref=""):
     amount = normalize_credit_amount(amount)
     if amount <= 0:
         return True
+    return charge_credits(user_id, amount, reason=reason, ref=ref)[0]
 
-    with closing(sqlite3.connect(DB_PATH)) as con:
+
+def hold_credits(user_id, amount, *, reason="", ref="", ttl=None) -> tuple[int | None, float]:
+    """Reserve credits for a long-running job.
+
+    The amount leaves the balance immediately; settle the hold later with
+    :func:`capture_hold` or give it back with :func:`release_hold`. Holds
+    still open after ``ttl`` seconds (default ``CREDIT_HOLD_TTL``) are
+    refunded by :func:`release_expired_holds`. Returns
+    ``(hold_id, new_balance)`` or ``(None, balance)`` when the user cannot pay.
+    """
+
+    amount = normalize_credit_amount(amount)
+    ttl = CREDIT_HOLD_TTL if ttl is None else ttl
+    expires_at = int(time.time()) + int(ttl) if ttl else 0
+    with transaction() as con:
+        cur = con.cursor()
+        ok, balance = _charge(cur, user_id, max(amount, 0))
+        if not ok:
+            return None, balance
+        hold_id = _record_ledger(
+            cur, user_id, -max(amount, 0), balance, "hold", reason, ref,
+            status="held", expires_at=expires_at,
+        )
+        return hold_id, balance
+
+
+def capture_hold(hold_id) -> bool:
+    """Turn a hold into a final charge; False if it was already settled."""
+
+    if not hold_id:
+        return False
+    with transaction() as con:
         cur = con.cursor()
-        cur.execute("SELECT credits FROM users WHERE user_id=?", (user_id,))
-        r = cur.fetchone()
-        if not r:
-            return False
+        cur.execute(
+            """UPDATE credit_ledger SET status='captured', updated_at=?
+                WHERE id=? AND kind='hold' AND status='held'""",
+            (int(time.time()), int(hold_id)),
+        )
+        return cur.rowcount > 0
 
-        current = normalize_credit_amount(r[0])
-        if current < amount:
-            return False
 
-        new_balance = normalize_credit_amount(current - amount)
-        cur.execute("UPDATE users SET credits=? WHERE user_id=?", (new_balance, user_id))
-        con.commit()
-        return True
+def release_hold(hold_id, *, status="released"):
+    """Refund a hold; returns the new balance, or None if it was already settled."""
+
+    if not hold_id:
+        return None
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """UPDATE credit_ledger SET status=?, updated_at=?
+                WHERE id=? AND kind='hold' AND status='held'
+            RETURNING user_id, delta, reason""",
+            (status, int(time.time()), int(hold_id)),
+        )
+        row = cur.fetchone()
+        if row is None:
+            return None
+        user_id, delta, reason = row
+        amount = normalize_credit_amount(-(delta or 0))
+        cur.execute(_CREDIT_SQL, (amount, user_id))
+        updated = cur.fetchone()
+        balance = normalize_credit_amount(updated[0] if updated else 0)
+        _record_ledger(cur, user_id, amount, balance, "refund", reason, f"hold:{hold_id}")
+        return balance
+
+
+def release_expired_holds(limit: int = 500) -> int:
+    """Refund holds whose ``expires_at`` has passed; returns how many."""
+
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """SELECT id FROM credit_ledger
+                WHERE status='held' AND expires_at>0 AND expires_at<=?
+                ORDER BY expires_at LIMIT ?""",
+            (int(time.time()), int(limit)),
+        )
+        hold_ids = [row[0] for row in cur.fetchall()]
+        return sum(release_hold(hold_id, status="expired") is not None for hold_id in hold_ids)
+
+# Write-through LRU in front of kv_state. Message handler predicates read the
+# sender's state for every incoming update, so those reads must not go to
+# SQLite; only this process writes kv_state, which keeps the cache exact.
+STATE_CACHE_SIZE = max(0, _env_int("STATE_CACHE_SIZE", 50000))
+
+_state_cache: OrderedDict = OrderedDict()
+_state_cache_lock = threading.Lock()
+
+
+def _cache_state(user_id, state, *, overwrite=True):
+    if STATE_CACHE_SIZE <= 0:
+        return
+    with _state_cache_lock:
+        if not overwrite and user_id in _state_cache:
+            # A concurrent set_state/clear_state won; keep its value.
+            return
+        _state_cache[user_id] = state
+        _state_cache.move_to_end(user_id)
+        while len(_state_cache) > STATE_CACHE_SIZE:
+            _state_cache.popitem(last=False)
+
+
+def _forget_cached_states():
+    with _state_cache_lock:
+        _state_cache.clear()
+
 
 def set_state(user_id, state):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""INSERT INTO kv_state(user_id,state) VALUES(?,?)
                        ON CONFLICT(user_id) DO UPDATE SET state=excluded.state""",
                     (user_id, state))
-        con.commit()
+    _cache_state(user_id, state)
 
 def get_state(user_id):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with _state_cache_lock:
+        if user_id in _state_cache:
+            _state_cache.move_to_end(user_id)
+            return _state_cache[user_id]
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT state FROM kv_state WHERE user_id=?", (user_id,))
         r = cur.fetchone()
-        return r[0] if r else None
+    state = r[0] if r else None
+    _cache_state(user_id, state, overwrite=False)
+    return state
 
 def clear_state(user_id):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM kv_state WHERE user_id=?", (user_id,))
-        con.commit()
+    _cache_state(user_id, None)
 
 def set_referred_by(user_id, code):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""UPDATE users
                        SET referred_by=?
                        WHERE user_id=? AND (referred_by IS NULL OR referred_by='')""",
                     (code, user_id))
-        con.commit()
 
 def count_invited(ref_code):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM users WHERE referred_by=?", (ref_code,))
         return cur.fetchone()[0]
@@ -634,7 +1043,7 @@ def create_sora2_request(user_id: int) -> int:
     """Create a Sora 2 invite request and return the 1-based queue index."""
 
     now = int(time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM sora2_requests")
         row = cur.fetchone()
@@ -644,32 +1053,332 @@ def create_sora2_request(user_id: int) -> int:
                    VALUES(?,?,?)""",
             (user_id, now, "pending"),
         )
-        con.commit()
         return position
 
 
+# --- generation jobs: Runway tasks waiting for background delivery
+_GENERATION_JOB_KEYS = (
+    "id", "user_id", "chat_id", "kind", "task_id", "prompt", "lang",
+    "reply_to_message_id", "status_message_id", "cost", "created_at", "deadline_at",
+    "hold_id", "webhook_url",
+)
+
+
+def create_generation_job(user_id: int, chat_id: int, kind: str, task_id: str, *,
+                          prompt: str = "", lang: str = "fa",
+                          reply_to_message_id: int = 0, status_message_id: int = 0,
+                          cost: int = 0, timeout: float = 0, hold_id: int = 0,
+                          webhook_url: str = "") -> int:
+    now = int(time.time())
+    deadline = now + int(timeout) if timeout else 0
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """INSERT INTO generation_jobs(
+                   user_id, chat_id, kind, task_id, status, prompt, lang,
+                   reply_to_message_id, status_message_id, cost,
+                   created_at, updated_at, deadline_at, hold_id, webhook_url)
+               VALUES(?,?,?,?,'pending',?,?,?,?,?,?,?,?,?,?)""",
+            (user_id, chat_id, kind, task_id, prompt or "", lang or "fa",
+             int(reply_to_message_id or 0), int(status_message_id or 0),
+             int(cost or 0), now, now, deadline, int(hold_id or 0), webhook_url or ""),
+        )
+        return int(cur.lastrowid)
+
+
+def list_pending_generation_jobs(kinds, limit: int = 500) -> list[dict]:
+    """Oldest pending jobs of ``kinds`` (the kinds the calling process owns)."""
+
+    kinds = list(kinds)
+    if not kinds:
+        return []
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            f"SELECT {', '.join(_GENERATION_JOB_KEYS)} FROM generation_jobs"
+            f" WHERE status='pending' AND kind IN ({', '.join('?' * len(kinds))})"
+            " ORDER BY id LIMIT ?",
+            (*kinds, int(limit)),
+        )
+        return [dict(zip(_GENERATION_JOB_KEYS, row)) for row in cur.fetchall()]
+
+
+def get_generation_job(job_id: int, user_id: int | None = None) -> dict | None:
+    """A job with its outcome; ``user_id`` restricts it to that owner."""
+
+    keys = _GENERATION_JOB_KEYS + ("status", "result_url", "error", "updated_at")
+    sql = f"SELECT {', '.join(keys)} FROM generation_jobs WHERE id=?"
+    params: list = [int(job_id)]
+    if user_id is not None:
+        sql += " AND user_id=?"
+        params.append(int(user_id))
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(sql, params)
+        row = cur.fetchone()
+        return dict(zip(keys, row)) if row else None
+
+
+def finish_generation_job(job_id: int, status: str, *,
+                          result_url: str = "", error: str = "") -> bool:
+    """Move a pending job to ``status``; False if another worker already did."""
+
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """UPDATE generation_jobs
+                   SET status=?, result_url=?, error=?, updated_at=?
+                 WHERE id=? AND status='pending'""",
+            (status, result_url or "", (error or "")[:1000], int(time.time()), int(job_id)),
+        )
+        return cur.rowcount > 0
+
+
+# --- scheduled tasks: delayed bot actions replayed after a restart
+def add_scheduled_task(kind: str, run_at: float, payload: str, dedup_key: str | None = None) -> int:
+    """Store a task; an existing task with the same ``dedup_key`` is replaced."""
+
+    with transaction() as con:
+        cur = con.cursor()
+        if dedup_key is not None:
+            cur.execute("DELETE FROM scheduled_tasks WHERE dedup_key=?", (dedup_key,))
+        cur.execute(
+            """INSERT INTO scheduled_tasks(kind, dedup_key, payload, run_at, created_at)
+                   VALUES(?,?,?,?,?)""",
+            (kind, dedup_key, payload, float(run_at), int(time.time())),
+        )
+        return int(cur.lastrowid)
+
+
+def delete_scheduled_task(task_id: int) -> bool:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("DELETE FROM scheduled_tasks WHERE id=?", (int(task_id),))
+        return cur.rowcount > 0
+
+
+def delete_scheduled_task_by_key(dedup_key: str) -> bool:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("DELETE FROM scheduled_tasks WHERE dedup_key=?", (dedup_key,))
+        return cur.rowcount > 0
+
+
+def list_scheduled_tasks() -> list[dict]:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("SELECT id, kind, dedup_key, payload, run_at FROM scheduled_tasks ORDER BY run_at")
+        return [
+            {"id": row[0], "kind": row[1], "dedup_key": row[2], "payload": row[3], "run_at": row[4]}
+            for row in cur.fetchall()
+        ]
+
+
+# --- tts_cache: index of synthesized audio files stored under DB_DIR
+_TTS_CACHE_KEYS = ("cache_key", "path", "mime", "size")
+
+
+def get_tts_cache_entry(cache_key: str) -> dict | None:
+    """Return the cached entry and mark it as recently used."""
+
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            f"""UPDATE tts_cache SET hits=hits+1, last_used_at=?
+                 WHERE cache_key=?
+             RETURNING {', '.join(_TTS_CACHE_KEYS)}""",
+            (int(time.time()), cache_key),
+        )
+        row = cur.fetchone()
+        return dict(zip(_TTS_CACHE_KEYS, row)) if row else None
+
+
+def put_tts_cache_entry(cache_key: str, path: str, mime: str, size: int) -> None:
+    now = int(time.time())
+    with transaction() as con:
+        con.execute(
+            """INSERT INTO tts_cache(cache_key, path, mime, size, created_at, last_used_at)
+               VALUES(?,?,?,?,?,?)
+               ON CONFLICT(cache_key) DO UPDATE SET
+                   path=excluded.path, mime=excluded.mime, size=excluded.size,
+                   last_used_at=excluded.last_used_at""",
+            (cache_key, path, mime, int(size), now, now),
+        )
+
+
+def delete_tts_cache_entry(cache_key: str) -> None:
+    with transaction() as con:
+        con.execute("DELETE FROM tts_cache WHERE cache_key=?", (cache_key,))
+
+
+def evict_tts_cache(max_bytes: int, keep: str = "") -> list[str]:
+    """Drop least recently used entries until the cache fits ``max_bytes``.
+
+    The entry ``keep`` (the one just written) is never dropped. Returns the
+    paths of the evicted files; deleting them is up to the caller.
+    """
+
+    evicted: list[str] = []
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("SELECT IFNULL(SUM(size), 0) FROM tts_cache")
+        excess = int(cur.fetchone()[0]) - int(max_bytes)
+        if excess <= 0:
+            return evicted
+        cur.execute(
+            "SELECT cache_key, path, size FROM tts_cache WHERE cache_key<>?"
+            " ORDER BY last_used_at, created_at",
+            (keep or "",),
+        )
+        doomed = []
+        for cache_key, path, size in cur:
+            if excess <= 0:
+                break
+            doomed.append((cache_key,))
+            evicted.append(path)
+            excess -= int(size or 0)
+        cur.executemany("DELETE FROM tts_cache WHERE cache_key=?", doomed)
+    return evicted
+
+
+# --- media_cache: Telegram file_id of media we already uploaded
+def get_media_file_id(cache_key: str, media_type: str) -> str | None:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """UPDATE media_cache SET last_used_at=?
+                WHERE cache_key=? AND media_type=?
+            RETURNING file_id""",
+            (int(time.time()), cache_key, media_type),
+        )
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+def set_media_file_id(cache_key: str, media_type: str, file_id: str) -> None:
+    now = int(time.time())
+    with transaction() as con:
+        con.execute(
+            """INSERT INTO media_cache(cache_key, media_type, file_id, created_at, last_used_at)
+               VALUES(?,?,?,?,?)
+               ON CONFLICT(cache_key, media_type) DO UPDATE SET
+                   file_id=excluded.file_id, last_used_at=excluded.last_used_at""",
+            (cache_key, media_type, file_id, now, now),
+        )
+
+
+def delete_media_file_id(cache_key: str, media_type: str) -> None:
+    with transaction() as con:
+        con.execute(
+            "DELETE FROM media_cache WHERE cache_key=? AND media_type=?",
+            (cache_key, media_type),
+        )
+
+
+# --- broadcasts: admin mass messages with a per-recipient cursor
+_BROADCAST_KEYS = (
+    "id", "admin_chat_id", "progress_message_id", "lang_code", "payload", "status",
+    "last_user_id", "total", "sent", "failed", "created_at", "updated_at",
+)
+
+
+def create_broadcast(admin_chat_id: int, lang_code: str, payload: str, total: int) -> int:
+    now = int(time.time())
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """INSERT INTO broadcasts(admin_chat_id, lang_code, payload, status, total,
+                                      created_at, updated_at)
+                   VALUES(?,?,?,'running',?,?,?)""",
+            (admin_chat_id, lang_code or "all", payload, int(total), now, now),
+        )
+        return int(cur.lastrowid)
+
+
+def get_broadcast(broadcast_id: int) -> dict | None:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            f"SELECT {', '.join(_BROADCAST_KEYS)} FROM broadcasts WHERE id=?",
+            (int(broadcast_id),),
+        )
+        row = cur.fetchone()
+        return dict(zip(_BROADCAST_KEYS, row)) if row else None
+
+
+def list_broadcasts(status: str) -> list[dict]:
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            f"SELECT {', '.join(_BROADCAST_KEYS)} FROM broadcasts WHERE status=? ORDER BY id",
+            (status,),
+        )
+        return [dict(zip(_BROADCAST_KEYS, row)) for row in cur.fetchall()]
+
+
+def set_broadcast_status(broadcast_id: int, status: str, *, expected: str | None = None) -> bool:
+    sql = "UPDATE broadcasts SET status=?, updated_at=? WHERE id=?"
+    params: tuple = (status, int(time.time()), int(broadcast_id))
+    if expected is not None:
+        sql += " AND status=?"
+        params += (expected,)
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(sql, params)
+        return cur.rowcount > 0
+
+
+def set_broadcast_progress_message(broadcast_id: int, message_id: int) -> None:
+    with transaction() as con:
+        con.execute(
+            "UPDATE broadcasts SET progress_message_id=? WHERE id=?",
+            (int(message_id), int(broadcast_id)),
+        )
+
+
+def advance_broadcast(broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                      logs: list[tuple[int, str]]) -> None:
+    """Move the cursor past a delivered page and store its delivery logs in one write."""
+
+    now = int(time.time())
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            """UPDATE broadcasts
+                   SET last_user_id=?, sent=sent+?, failed=failed+?, updated_at=?
+                 WHERE id=?""",
+            (int(last_user_id), int(sent), int(failed), now, int(broadcast_id)),
+        )
+        if logs:
+            cur.executemany(
+                """INSERT INTO messages(user_id, direction, text, created_at)
+                       VALUES(?,?,?,?)""",
+                [(uid, "out", (text or "")[:4000], now) for uid, text in logs],
+            )
+
+
 # آمار و خروجی‌ها
 def count_users():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM users")
         return cur.fetchone()[0]
 
 def sum_credits():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COALESCE(SUM(credits),0) FROM users")
         return cur.fetchone()[0]
 
 def count_users_today():
     start = int(datetime.datetime.combine(datetime.date.today(), datetime.time.min).timestamp())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM users WHERE joined_at>=?", (start,))
         return cur.fetchone()[0]
 
 def list_users(limit=20, offset=0):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""SELECT user_id, username, credits, banned FROM users
                        ORDER BY joined_at DESC LIMIT ? OFFSET ?""", (limit, offset))
@@ -681,7 +1390,7 @@ def list_users(limit=20, offset=0):
 
 
 def list_image_users(limit=20, offset=0):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -715,7 +1424,8 @@ def list_image_users(limit=20, offset=0):
 
 
 def list_gpt_users(limit=20, offset=0):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -749,47 +1459,196 @@ def list_gpt_users(limit=20, offset=0):
 
 
 def set_ban(user_id, banned=True):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("UPDATE users SET banned=? WHERE user_id=?", (1 if banned else 0, user_id))
-        con.commit()
 
 def log_purchase(user_id, stars, credits, payload):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("""INSERT INTO purchases(user_id,stars,credits,payload,created_at)
                        VALUES(?,?,?,?,?)""", (user_id, stars, credits, payload, int(time.time())))
-        con.commit()
+
+# --- write-behind log buffer
+# Analytics rows (messages, gpt_messages, menu_usage) are queued in memory
+# and written by one background thread with grouped executemany inserts, so
+# handlers do not pay for a commit per log line. Readers of these tables call
+# flush_logs() first, which keeps read-your-writes semantics. A flush that
+# fails because the database is locked or busy (another process held the
+# write lock past DB_BUSY_TIMEOUT_MS) puts its rows back at the head of the
+# queue for the next flush; only rows that fail for another reason are lost.
+LOG_FLUSH_INTERVAL_MS = max(10, _env_int("DB_LOG_FLUSH_MS", 250))
+LOG_FLUSH_ROWS = max(1, _env_int("DB_LOG_FLUSH_ROWS", 500))
+# Above this many queued rows the producer flushes synchronously.
+LOG_QUEUE_MAX = max(LOG_FLUSH_ROWS, _env_int("DB_LOG_QUEUE_MAX", 20000))
+
+_INSERT_MESSAGE_SQL = """INSERT INTO messages(user_id, direction, text, created_at, kind)
+                             VALUES(?,?,?,?,?)"""
+_INSERT_GPT_MESSAGE_SQL = """INSERT INTO gpt_messages(user_id, role, content, created_at)
+                                 VALUES(?,?,?,?)"""
+_UPSERT_MENU_USAGE_SQL = """INSERT INTO menu_usage(user_id, menu_key, count, last_used_at)
+                                VALUES(?,?,?,?)
+                                ON CONFLICT(user_id, menu_key) DO UPDATE SET
+                                    count=count+excluded.count,
+                                    last_used_at=MAX(last_used_at, excluded.last_used_at)"""
+
+_log_cond = threading.Condition()
+_log_flush_lock = threading.Lock()
+_log_rows: dict[str, list[tuple]] = {}
+_menu_counts: dict[tuple[int, str], list[int]] = {}
+_log_pending = 0
+_log_writer: threading.Thread | None = None
+_log_stats = {
+    "flushes": 0,
+    "rows_written": 0,
+    "failed_rows": 0,
+    "requeued_rows": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "max_queue_depth": 0,
+}
+
+
+def _enqueue_log(sql: str, row: tuple) -> None:
+    global _log_pending
+    with _log_cond:
+        _log_rows.setdefault(sql, []).append(row)
+        _log_pending += 1
+        pending = _log_pending
+        _after_enqueue(pending)
+    if pending >= LOG_QUEUE_MAX:
+        flush_logs()
+
+
+def _enqueue_menu_usage(user_id: int, menu_key: str, now: int) -> None:
+    global _log_pending
+    with _log_cond:
+        entry = _menu_counts.get((user_id, menu_key))
+        if entry is None:
+            _menu_counts[(user_id, menu_key)] = [1, now]
+            _log_pending += 1
+        else:
+            entry[0] += 1
+            entry[1] = max(entry[1], now)
+        pending = _log_pending
+        _after_enqueue(pending)
+    if pending >= LOG_QUEUE_MAX:
+        flush_logs()
+
+
+def _after_enqueue(pending: int) -> None:
+    # Called with _log_cond held.
+    global _log_writer
+    if pending > _log_stats["max_queue_depth"]:
+        _log_stats["max_queue_depth"] = pending
+    if _log_writer is None:
+        _log_writer = threading.Thread(target=_log_writer_loop, name="db-log-writer", daemon=True)
+        _log_writer.start()
+        atexit.register(flush_logs)
+    if pending >= LOG_FLUSH_ROWS:
+        _log_cond.notify()
+
+
+def _log_writer_loop() -> None:
+    while True:
+        with _log_cond:
+            _log_cond.wait(LOG_FLUSH_INTERVAL_MS / 1000)
+        try:
+            flush_logs()
+        except Exception:
+            logger.exception("DB log flush failed")
+
+
+def _is_transient(exc: sqlite3.Error) -> bool:
+    message = str(exc).lower()
+    return isinstance(exc, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def _requeue_logs(batches: dict[str, list[tuple]], menu: list[tuple]) -> None:
+    """Put rows of a failed flush back ahead of the ones queued meanwhile."""
+
+    global _log_pending
+    with _log_cond:
+        for sql, rows in batches.items():
+            _log_rows[sql] = rows + _log_rows.get(sql, [])
+            _log_pending += len(rows)
+        for user_id, menu_key, count, last in menu:
+            entry = _menu_counts.get((user_id, menu_key))
+            if entry is None:
+                _menu_counts[(user_id, menu_key)] = [count, last]
+                _log_pending += 1
+            else:
+                entry[0] += count
+                entry[1] = max(entry[1], last)
+
+
+def flush_logs() -> int:
+    """Write every queued log row now; returns the number of rows written."""
+
+    global _log_pending
+    if not _log_pending:
+        return 0
+    with _log_flush_lock:
+        with _log_cond:
+            batches = {sql: rows for sql, rows in _log_rows.items() if rows}
+            menu = [(uid, key, count, last) for (uid, key), (count, last) in _menu_counts.items()]
+            _log_rows.clear()
+            _menu_counts.clear()
+            _log_pending = 0
+        total = sum(len(rows) for rows in batches.values()) + len(menu)
+        if not total:
+            return 0
+        started = time.perf_counter()
+        try:
+            with transaction() as con:
+                for sql, rows in batches.items():
+                    con.executemany(sql, rows)
+                if menu:
+                    con.executemany(_UPSERT_MENU_USAGE_SQL, menu)
+        except sqlite3.Error as exc:
+            if _is_transient(exc):
+                _requeue_logs(batches, menu)
+                _log_stats["requeued_rows"] += total
+                logger.warning("DB log flush deferred, %d rows requeued: %s", total, exc)
+                return 0
+            _log_stats["failed_rows"] += total
+            logger.error("DB log flush failed, %d rows dropped: %s", total, exc)
+            # The history cache already counts the dropped turns; reload it.
+            for user_id in {row[0] for row in batches.get(_INSERT_GPT_MESSAGE_SQL, ())}:
+                _forget_cached_history(user_id)
+            return 0
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        _log_stats["flushes"] += 1
+        _log_stats["rows_written"] += total
+        _log_stats["last_flush_ms"] = round(elapsed_ms, 2)
+        _log_stats["max_flush_ms"] = round(max(_log_stats["max_flush_ms"], elapsed_ms), 2)
+        return total
+
+
+def get_log_buffer_stats() -> dict:
+    """Queue depth and flush latency of the write-behind log buffer."""
+
+    with _log_cond:
+        return {"queue_depth": _log_pending, **_log_stats}
+
 
 def log_message(user_id, direction, text):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        cur = con.cursor()
-        cur.execute("""INSERT INTO messages(user_id,direction,text,created_at)
-                       VALUES(?,?,?,?)""", (user_id, direction, text[:4000], int(time.time())))
-        con.commit()
+    _enqueue_log(
+        _INSERT_MESSAGE_SQL,
+        (user_id, direction, (text or "")[:4000], int(time.time()), ""),
+    )
 
 
 def log_menu_usage(user_id: int, menu_key: str) -> None:
     menu_key = (menu_key or "").strip()
     if not menu_key:
         return
-    now = int(time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        cur = con.cursor()
-        cur.execute(
-            """INSERT INTO menu_usage(user_id, menu_key, count, last_used_at)
-                   VALUES(?,?,1,?)
-                   ON CONFLICT(user_id, menu_key) DO UPDATE SET
-                       count=count+1,
-                       last_used_at=excluded.last_used_at
-            """,
-            (user_id, menu_key, now),
-        )
-        con.commit()
+    _enqueue_menu_usage(user_id, menu_key, int(time.time()))
 
 
 def get_user_menu_usage(user_id: int) -> list[dict[str, int | str]]:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """SELECT menu_key, count, last_used_at
@@ -806,18 +1665,17 @@ def get_user_menu_usage(user_id: int) -> list[dict[str, int | str]]:
 
 
 def log_image_generation(user_id: int, prompt: str, image_url: str) -> None:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO image_generations(user_id, prompt, image_url, created_at)
                    VALUES(?,?,?,?)""",
             (user_id, (prompt or "")[:1000], image_url or "", int(time.time())),
         )
-        con.commit()
 
 
 def list_user_images(user_id: int):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """SELECT id, prompt, image_url, created_at
@@ -839,7 +1697,7 @@ def list_user_images(user_id: int):
 
 
 def count_users_with_images() -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(DISTINCT user_id) FROM image_generations")
         result = cur.fetchone()
@@ -847,7 +1705,8 @@ def count_users_with_images() -> int:
 
 
 def count_users_with_gpt() -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(DISTINCT user_id) FROM gpt_messages")
         result = cur.fetchone()
@@ -855,7 +1714,7 @@ def count_users_with_gpt() -> int:
 
 
 def count_users_by_lang():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -882,7 +1741,12 @@ def _guess_image_extension(url: str, content_type: str | None) -> str:
     return ".jpg"
 
 
-def export_user_images_zip(user_id: int, path: str | None = None):
+def export_user_images_zip(user_id: int, path: str | None = None, fetch=None):
+    """Zip a user's generated images.
+
+    ``fetch(url)`` may return the image bytes from a local copy (``None`` to
+    fall back to downloading ``url`` from the provider).
+    """
     records = list_user_images(user_id)
     if not records:
         return None
@@ -902,7 +1766,6 @@ def export_user_images_zip(user_id: int, path: str | None = None):
 
     downloaded = 0
     skipped = 0
-    session = requests.Session()
     manifest_buffer = io.StringIO()
     writer = csv.writer(manifest_buffer)
     writer.writerow([
@@ -922,16 +1785,21 @@ def export_user_images_zip(user_id: int, path: str | None = None):
             filename = ""
             image_bytes = None
             content_type = ""
-            if url:
+            if url and fetch is not None:
+                try:
+                    image_bytes = fetch(url)
+                except Exception:
+                    image_bytes = None
+            if not url:
+                status = "missing_url"
+            elif not image_bytes:
                 try:
-                    response = session.get(url, timeout=30)
+                    response = http_client.request("media", "GET", url)
                     response.raise_for_status()
                     image_bytes = response.content
                     content_type = response.headers.get("Content-Type", "")
                 except Exception:
                     status = "download_error"
-            else:
-                status = "missing_url"
 
             if image_bytes:
                 ext = _guess_image_extension(url, content_type)
@@ -969,7 +1837,8 @@ def export_user_images_zip(user_id: int, path: str | None = None):
 
 def reset_user(user_id: int) -> bool:
     """Completely remove a user and all related data from the bot database."""
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT 1 FROM users WHERE user_id=?", (user_id,))
         if not cur.fetchone():
@@ -979,6 +1848,7 @@ def reset_user(user_id: int) -> bool:
         cur.execute("DELETE FROM kv_state WHERE user_id=?", (user_id,))
         cur.execute("DELETE FROM messages WHERE user_id=?", (user_id,))
         cur.execute("DELETE FROM gpt_messages WHERE user_id=?", (user_id,))
+        cur.execute("DELETE FROM gpt_summaries WHERE user_id=?", (user_id,))
         cur.execute(
             "DELETE FROM vexa_assistant_messages WHERE user_id=?",
             (user_id,),
@@ -986,49 +1856,269 @@ def reset_user(user_id: int) -> bool:
         cur.execute("DELETE FROM purchases WHERE user_id=?", (user_id,))
         cur.execute("DELETE FROM user_voices WHERE user_id=?", (user_id,))
         cur.execute("DELETE FROM image_generations WHERE user_id=?", (user_id,))
-        con.commit()
+        cur.execute("DELETE FROM credit_ledger WHERE user_id=?", (user_id,))
+    _cache_state(user_id, None)
+    _forget_cached_history(user_id)
     return True
 
 
-def log_gpt_message(user_id: int, role: str, content: str) -> None:
-    role_value = str(role or "assistant").strip() or "assistant"
-    with closing(sqlite3.connect(DB_PATH)) as con:
+# Recent conversation turns per user, kept in memory so a GPT turn needs no
+# read. Entries are hydrated from SQLite on a miss, appended to by the log
+# functions, evicted LRU beyond HISTORY_CACHE_SIZE users and after
+# HISTORY_CACHE_TTL idle seconds. Items are normalised {"role", "content"}
+# dicts shared between callers; treat them as read-only. Each entry also
+# counts the user's stored messages, so callers know the position of the
+# window in the whole conversation.
+HISTORY_CACHE_SIZE = max(0, _env_int("HISTORY_CACHE_SIZE", 10000))
+HISTORY_CACHE_TTL = max(0, _env_int("HISTORY_CACHE_TTL", 1800))
+_HISTORY_ROLES = {"system", "user", "assistant"}
+
+_history_cache: OrderedDict = OrderedDict()  # (table, user_id) -> [expires_at, deque, total]
+_history_loading: dict = {}  # (table, user_id) -> token of the hydrate in progress
+_history_lock = threading.Lock()
+
+
+def _history_item(role, content) -> dict | None:
+    role_value = str(role or "").strip().lower()
+    text = (content or "").strip()
+    if role_value not in _HISTORY_ROLES or not text:
+        return None
+    return {"role": role_value, "content": text}
+
+
+def _history_expiry() -> float:
+    return time.time() + HISTORY_CACHE_TTL if HISTORY_CACHE_TTL else float("inf")
+
+
+def _cached_history(key, limit: int) -> tuple[list[dict], int] | None:
+    with _history_lock:
+        entry = _history_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time() or entry[1].maxlen < limit:
+            del _history_cache[key]
+            return None
+        entry[0] = _history_expiry()
+        _history_cache.move_to_end(key)
+        items = list(entry[1])
+        total = entry[2]
+    return items[-limit:], total
+
+
+def _load_history(key, limit: int, select) -> tuple[list[dict], int]:
+    """``(last limit messages, number of stored messages)`` for ``key``."""
+
+    cached = _cached_history(key, limit)
+    if cached is not None:
+        return cached
+
+    token = object()
+    with _history_lock:
+        _history_loading[key] = token
+    try:
+        rows, total = select(limit)
+        items = [item for item in (_history_item(role, content) for role, content in reversed(rows)) if item]
+    finally:
+        with _history_lock:
+            # A write since the read started makes the rows stale; skip caching.
+            fresh = _history_loading.get(key) is token
+            if fresh:
+                del _history_loading[key]
+    if fresh and HISTORY_CACHE_SIZE > 0:
+        with _history_lock:
+            _history_cache[key] = [_history_expiry(), deque(items, maxlen=limit), total]
+            _history_cache.move_to_end(key)
+            while len(_history_cache) > HISTORY_CACHE_SIZE:
+                _history_cache.popitem(last=False)
+    return list(items), total
+
+
+def _append_history(key, role, content) -> None:
+    item = _history_item(role, content)
+    with _history_lock:
+        _history_loading.pop(key, None)
+        entry = _history_cache.get(key)
+        if entry is None:
+            return
+        if item is not None:
+            entry[1].append(item)
+            entry[2] += 1
+        entry[0] = _history_expiry()
+
+
+def _clear_history(key) -> None:
+    with _history_lock:
+        _history_loading.pop(key, None)
+        entry = _history_cache.get(key)
+        if entry is not None:
+            # The table is empty for this user now; keep answering from memory.
+            entry[1].clear()
+            entry[2] = 0
+
+
+def _forget_cached_history(user_id=None) -> None:
+    with _history_lock:
+        if user_id is None:
+            _history_cache.clear()
+            _history_loading.clear()
+        else:
+            for table in ("gpt_messages", "vexa_assistant_messages"):
+                _history_cache.pop((table, user_id), None)
+                _history_loading.pop((table, user_id), None)
+    with _summary_lock:
+        if user_id is None:
+            _summary_cache.clear()
+        else:
+            _summary_cache.pop(user_id, None)
+
+
+def _select_recent_messages(table: str, user_id: int, limit: int) -> tuple[list[tuple], int]:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
-            """INSERT INTO gpt_messages(user_id, role, content, created_at)
-                   VALUES(?,?,?,?)""",
-            (user_id, role_value, (content or "")[:6000], int(time.time())),
+            f"""SELECT role, content
+                   FROM {table}
+                   WHERE user_id=?
+                   ORDER BY id DESC
+                   LIMIT ?""",
+            (user_id, limit),
         )
-        con.commit()
+        rows = cur.fetchall() or []
+        cur.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE user_id=? AND TRIM(COALESCE(content, ''))<>''",
+            (user_id,),
+        )
+        return rows, int(cur.fetchone()[0] or 0)
+
+
+def log_gpt_message(user_id: int, role: str, content: str) -> None:
+    role_value = str(role or "assistant").strip() or "assistant"
+    text = (content or "")[:6000]
+    _enqueue_log(
+        _INSERT_GPT_MESSAGE_SQL,
+        (user_id, role_value, text, int(time.time())),
+    )
+    _append_history(("gpt_messages", user_id), role_value, text)
 
 
 def get_recent_gpt_messages(user_id: int, limit: int) -> list[dict[str, str]]:
+    return get_gpt_history_window(user_id, limit)[0]
+
+
+def get_gpt_history_window(user_id: int, limit: int) -> tuple[list[dict[str, str]], int]:
+    """The last ``limit`` GPT messages and how many the user has in total."""
+
     lim = max(0, int(limit or 0))
     if lim == 0:
+        return [], 0
+
+    def select(lim):
+        flush_logs()
+        return _select_recent_messages("gpt_messages", user_id, lim)
+
+    return _load_history(("gpt_messages", user_id), lim, select)
+
+
+def get_gpt_messages_range(user_id: int, offset: int, count: int) -> list[dict[str, str]]:
+    """Messages ``offset`` .. ``offset + count`` of the conversation, oldest first."""
+
+    if count <= 0:
         return []
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """SELECT role, content
                    FROM gpt_messages
-                   WHERE user_id=?
-                   ORDER BY id DESC
-                   LIMIT ?""",
-            (user_id, lim),
+                   WHERE user_id=? AND TRIM(COALESCE(content, ''))<>''
+                   ORDER BY id
+                   LIMIT ? OFFSET ?""",
+            (user_id, int(count), max(0, int(offset))),
         )
         rows = cur.fetchall() or []
-    return [
-        {"role": role, "content": content}
-        for role, content in reversed(rows)
-        if (role or "").strip() and (content or "").strip()
-    ]
+    return [item for item in (_history_item(role, content) for role, content in rows) if item]
+
+
+# Rolling summary of the GPT turns that no longer fit the history budget.
+# ``covered`` is how many of the user's messages (oldest first) it includes.
+_summary_cache: OrderedDict = OrderedDict()  # user_id -> (summary, covered)
+_summary_lock = threading.Lock()
+
+
+def get_gpt_summary(user_id: int) -> tuple[str, int]:
+    with _summary_lock:
+        cached = _summary_cache.get(user_id)
+        if cached is not None:
+            _summary_cache.move_to_end(user_id)
+            return cached
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("SELECT summary, covered FROM gpt_summaries WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+    value = (row[0] or "", int(row[1] or 0)) if row else ("", 0)
+    _cache_summary(user_id, value)
+    return value
+
+
+def advance_gpt_summary(user_id: int, summary: str, expected: int, covered: int) -> bool:
+    """Store ``summary`` as covering the first ``covered`` messages.
+
+    Only if the stored summary still covers ``expected`` messages and the
+    conversation still has at least ``covered``: a history cleared or
+    summarised meanwhile is left alone. Check and write are one statement.
+    """
+
+    flush_logs()
+    params = (user_id, summary or "", int(covered), int(time.time()))
+    count_sql = (
+        "(SELECT COUNT(*) FROM gpt_messages"
+        " WHERE user_id=? AND TRIM(COALESCE(content, ''))<>'')"
+    )
+    with transaction() as con:
+        cur = con.cursor()
+        if expected:
+            cur.execute(
+                f"""UPDATE gpt_summaries SET summary=?, covered=?, updated_at=?
+                     WHERE user_id=? AND covered=? AND {count_sql} >= ?""",
+                (*params[1:], user_id, int(expected), user_id, int(covered)),
+            )
+        else:
+            cur.execute(
+                f"""INSERT INTO gpt_summaries(user_id, summary, covered, updated_at)
+                       SELECT ?,?,?,? WHERE {count_sql} >= ?
+                       ON CONFLICT(user_id) DO UPDATE SET
+                           summary=excluded.summary,
+                           covered=excluded.covered,
+                           updated_at=excluded.updated_at
+                        WHERE gpt_summaries.covered=0""",
+                (*params, user_id, int(covered)),
+            )
+        stored = cur.rowcount > 0
+    # Reloaded rather than set: a clear committed right after this write
+    # must not be overwritten in the cache.
+    with _summary_lock:
+        _summary_cache.pop(user_id, None)
+    return stored
+
+
+def _cache_summary(user_id: int, value) -> None:
+    if HISTORY_CACHE_SIZE <= 0:
+        return
+    with _summary_lock:
+        _summary_cache[user_id] = value
+        _summary_cache.move_to_end(user_id)
+        while len(_summary_cache) > HISTORY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
 
 
 def clear_gpt_history(user_id: int) -> None:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM gpt_messages WHERE user_id=?", (user_id,))
-        con.commit()
+        cur.execute("DELETE FROM gpt_summaries WHERE user_id=?", (user_id,))
+    _clear_history(("gpt_messages", user_id))
+    _cache_summary(user_id, ("", 0))
 
 
 def log_vexa_assistant_message(user_id: int, role: str, content: str) -> None:
@@ -1037,14 +2127,14 @@ def log_vexa_assistant_message(user_id: int, role: str, content: str) -> None:
     if not text:
         return
 
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """INSERT INTO vexa_assistant_messages(user_id, role, content, created_at)
                    VALUES(?,?,?,?)""",
             (user_id, role_value, text[:6000], int(time.time())),
         )
-        con.commit()
+    _append_history(("vexa_assistant_messages", user_id), role_value, text[:6000])
 
 
 def get_recent_vexa_assistant_messages(user_id: int, limit: int) -> list[dict[str, str]]:
@@ -1056,36 +2146,24 @@ def get_recent_vexa_assistant_messages(user_id: int, limit: int) -> list[dict[st
     if lim == 0:
         return []
 
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        cur = con.cursor()
-        cur.execute(
-            """SELECT role, content
-                   FROM vexa_assistant_messages
-                   WHERE user_id=?
-                   ORDER BY id DESC
-                   LIMIT ?""",
-            (user_id, lim),
-        )
-        rows = cur.fetchall() or []
-
-    return [
-        {"role": role, "content": content}
-        for role, content in reversed(rows)
-        if (role or "").strip() and (content or "").strip()
-    ]
+    return _load_history(
+        ("vexa_assistant_messages", user_id),
+        lim,
+        lambda lim: _select_recent_messages("vexa_assistant_messages", user_id, lim),
+    )[0]
 
 
 def clear_vexa_assistant_history(user_id: int) -> None:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "DELETE FROM vexa_assistant_messages WHERE user_id=?",
             (user_id,),
         )
-        con.commit()
+    _clear_history(("vexa_assistant_messages", user_id))
 
 def export_users_csv(path="users.csv"):
-    with closing(sqlite3.connect(DB_PATH)) as con, open(path,"w",newline="",encoding="utf-8") as f:
+    with transaction() as con, open(path,"w",newline="",encoding="utf-8") as f:
         cur = con.cursor()
         cur.execute("""SELECT user_id,username,first_name,joined_at,credits,ref_code,referred_by,banned,last_seen FROM users""")
         w = csv.writer(f)
@@ -1094,7 +2172,7 @@ def export_users_csv(path="users.csv"):
     return path
 
 def export_purchases_csv(path="purchases.csv"):
-    with closing(sqlite3.connect(DB_PATH)) as con, open(path,"w",newline="",encoding="utf-8") as f:
+    with transaction() as con, open(path,"w",newline="",encoding="utf-8") as f:
         cur = con.cursor()
         cur.execute("""SELECT id,user_id,stars,credits,payload,created_at FROM purchases""")
         w = csv.writer(f)
@@ -1103,7 +2181,8 @@ def export_purchases_csv(path="purchases.csv"):
     return path
 
 def export_messages_csv(path="messages.csv"):
-    with closing(sqlite3.connect(DB_PATH)) as con, open(path,"w",newline="",encoding="utf-8") as f:
+    flush_logs()
+    with transaction() as con, open(path,"w",newline="",encoding="utf-8") as f:
         cur = con.cursor()
         cur.execute("""SELECT id,user_id,direction,text,created_at FROM messages""")
         w = csv.writer(f)
@@ -1113,20 +2192,20 @@ def export_messages_csv(path="messages.csv"):
 
 def count_active_users(hours=24):
     since = int(time.time()) - hours*3600
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT COUNT(*) FROM users WHERE last_seen>=?", (since,))
         return cur.fetchone()[0]
 
 def get_all_user_ids():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT user_id FROM users")
         return [r[0] for r in cur.fetchall()]
 
 def get_user_ids_by_lang(lang: str):
     lang_code = (lang or "fa").strip()
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT user_id FROM users WHERE COALESCE(NULLIF(lang, ''), 'fa')=?",
@@ -1134,8 +2213,34 @@ def get_user_ids_by_lang(lang: str):
         )
         return [r[0] for r in cur.fetchall()]
 
+def _lang_filter(lang_code: str) -> tuple[str, tuple]:
+    if lang_code == "all":
+        return "", ()
+    return " AND COALESCE(NULLIF(lang, ''), 'fa')=?", ((lang_code or "fa").strip(),)
+
+
+def count_user_ids(lang_code: str = "all") -> int:
+    where, params = _lang_filter(lang_code)
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM users WHERE 1=1{where}", params)
+        return int(cur.fetchone()[0] or 0)
+
+
+def get_user_ids_after(after: int, lang_code: str = "all", limit: int = 500) -> list[int]:
+    """Keyset page of user ids (``lang_code`` 'all' or a language code)."""
+
+    where, params = _lang_filter(lang_code)
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute(
+            f"SELECT user_id FROM users WHERE user_id>?{where} ORDER BY user_id LIMIT ?",
+            (int(after or 0), *params, int(limit)),
+        )
+        return [r[0] for r in cur.fetchall()]
+
 def get_all_user_credits():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("SELECT user_id, credits FROM users ORDER BY user_id ASC")
         rows = cur.fetchall()
@@ -1153,16 +2258,16 @@ def bulk_update_user_credits(updates):
     if not normalized_updates:
         return 0
 
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.executemany("UPDATE users SET credits=? WHERE user_id=?", normalized_updates)
-        con.commit()
         return len(normalized_updates)
 
 def export_user_messages_csv(user_id: int, path=None):
     if path is None:
         path = f"user_{user_id}_messages.csv"
-    with closing(sqlite3.connect(DB_PATH)) as con, open(path, "w", newline="", encoding="utf-8") as f:
+    flush_logs()
+    with transaction() as con, open(path, "w", newline="", encoding="utf-8") as f:
         cur = con.cursor()
         cur.execute("""SELECT id, direction, text, created_at
                        FROM messages
@@ -1175,7 +2280,8 @@ def export_user_messages_csv(user_id: int, path=None):
 
 
 def export_user_gpt_messages_csv(user_id: int, path: str | None = None):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """SELECT id, role, content, created_at
@@ -1218,7 +2324,7 @@ def export_user_gpt_messages_csv(user_id: int, path: str | None = None):
 # ... بقیه کد همون قبلی ...
 
 def _migrate_users_table():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("PRAGMA table_info(users)")
         cols = {r[1] for r in cur.fetchall()}
@@ -1250,15 +2356,62 @@ def _migrate_users_table():
             cur.execute("ALTER TABLE users ADD COLUMN last_main_menu_id INTEGER DEFAULT 0")
         if "welcome_audio_sent_at" not in cols:
             cur.execute("ALTER TABLE users ADD COLUMN welcome_audio_sent_at INTEGER DEFAULT 0")
-        con.commit()
+
+# last_seen only feeds the hour/day "active users" stats, so refreshing it
+# more often than this just adds a write to every update.
+LAST_SEEN_REFRESH_SECONDS = 60
+
+_USER_KEYS = (
+    "user_id",
+    "username",
+    "first_name",
+    "joined_at",
+    "credits",
+    "ref_code",
+    "referred_by",
+    "banned",
+    "last_seen",
+    "lang",
+    "last_daily_reward",
+    "onboarding_pending",
+    "welcome_sent_at",
+    "daily_bonus_prompted_at",
+    "daily_bonus_unlocked_at",
+    "daily_bonus_reminded_at",
+    "low_credit_prompted_at",
+    "tts_creator_prompted_at",
+    "last_main_menu_id",
+    "welcome_audio_sent_at",
+)
+_SELECT_USER_SQL = f"SELECT {', '.join(_USER_KEYS)} FROM users WHERE user_id=?"
+
+
+def _select_user(cur, user_id):
+    cur.execute(_SELECT_USER_SQL, (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return _normalize_user_dict(_USER_KEYS, row)
+
 
 def get_or_create_user(u):
-    is_new = False
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    """Load (or register) the Telegram user behind an update.
+
+    The returned dict is the user context for the whole update: it already
+    carries ``lang``, ``credits`` and ``banned``, so handlers read those from
+    it instead of calling :func:`get_user_lang` or :func:`touch_last_seen`.
+    An existing user costs a single SELECT; username/first_name are written
+    only when Telegram reports new values and ``last_seen`` only once it is
+    older than ``LAST_SEEN_REFRESH_SECONDS``.
+    """
+
+    now = int(time.time())
+    username = u.username or ""
+    first_name = u.first_name or ""
+    with transaction() as con:
         cur = con.cursor()
-        cur.execute("SELECT user_id FROM users WHERE user_id=?", (u.id,))
-        row = cur.fetchone()
-        if not row:
+        user = _select_user(cur, u.id)
+        if user is None:
             free_credit = int(get_setting("FREE_CREDIT", "80") or 80)
             ref_code = str(u.id)
             cur.execute(
@@ -1276,89 +2429,44 @@ def get_or_create_user(u):
                 VALUES(?,?,?,?,?,?,?,?,?)""",
                 (
                     u.id,
-                    (u.username or ""),
-                    (u.first_name or ""),
-                    int(time.time()),
+                    username,
+                    first_name,
+                    now,
                     free_credit,
                     ref_code,
-                    int(time.time()),
+                    now,
                     "",
                     1,
                 ),
             )
-            con.commit()
-            is_new = True
-        else:
+            user = _select_user(cur, u.id)
+            if user:
+                user["is_new"] = True
+            return user
+
+        changes = {}
+        if (user.get("username") or "") != username:
+            changes["username"] = username
+        if (user.get("first_name") or "") != first_name:
+            changes["first_name"] = first_name
+        if now - int(user.get("last_seen") or 0) >= LAST_SEEN_REFRESH_SECONDS:
+            changes["last_seen"] = now
+        if changes:
+            assignments = ", ".join(f"{column}=?" for column in changes)
             cur.execute(
-                "UPDATE users SET username=?, first_name=? WHERE user_id=?",
-                (u.username or "", u.first_name or "", u.id),
+                f"UPDATE users SET {assignments} WHERE user_id=?",
+                (*changes.values(), u.id),
             )
-            con.commit()
-    user = get_user(u.id)
-    if user and is_new:
-        user["is_new"] = True
+            user.update(changes)
     return user
 
 def get_user(user_id):
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        cur = con.cursor()
-        cur.execute(
-            """
-            SELECT
-                user_id,
-                username,
-                first_name,
-                joined_at,
-                credits,
-                ref_code,
-                referred_by,
-                banned,
-                last_seen,
-                lang,
-                last_daily_reward,
-                onboarding_pending,
-                welcome_sent_at,
-                daily_bonus_prompted_at,
-                daily_bonus_unlocked_at,
-                daily_bonus_reminded_at,
-                low_credit_prompted_at,
-                tts_creator_prompted_at,
-                last_main_menu_id,
-                welcome_audio_sent_at
-            FROM users WHERE user_id=?
-            """,
-            (user_id,),
-        )
-        row = cur.fetchone()
-        if not row:
-            return None
-        keys = [
-            "user_id",
-            "username",
-            "first_name",
-            "joined_at",
-            "credits",
-            "ref_code",
-            "referred_by",
-            "banned",
-            "last_seen",
-            "lang",
-            "last_daily_reward",
-            "onboarding_pending",
-            "welcome_sent_at",
-            "daily_bonus_prompted_at",
-            "daily_bonus_unlocked_at",
-            "daily_bonus_reminded_at",
-            "low_credit_prompted_at",
-            "tts_creator_prompted_at",
-            "last_main_menu_id",
-            "welcome_audio_sent_at",
-        ]
-        return _normalize_user_dict(keys, row)
+    with transaction() as con:
+        return _select_user(con.cursor(), user_id)
 
 
 def get_last_daily_reward(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT last_daily_reward FROM users WHERE user_id=?",
@@ -1375,7 +2483,7 @@ def get_last_daily_reward(user_id: int) -> int:
 
 
 def get_welcome_sent_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT welcome_sent_at FROM users WHERE user_id=?",
@@ -1392,7 +2500,7 @@ def get_welcome_sent_at(user_id: int) -> int:
 
 
 def get_welcome_audio_sent_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT welcome_audio_sent_at FROM users WHERE user_id=?",
@@ -1410,39 +2518,36 @@ def get_welcome_audio_sent_at(user_id: int) -> int:
 
 def set_welcome_sent_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(timestamp or time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET welcome_sent_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def set_welcome_audio_sent_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(timestamp or time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET welcome_audio_sent_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def set_onboarding_pending(user_id: int, pending: bool) -> None:
     value = 1 if pending else 0
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET onboarding_pending=? WHERE user_id=?",
             (value, user_id),
         )
-        con.commit()
 
 
 def get_daily_bonus_prompted_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT daily_bonus_prompted_at FROM users WHERE user_id=?",
@@ -1460,17 +2565,16 @@ def get_daily_bonus_prompted_at(user_id: int) -> int:
 
 def set_daily_bonus_prompted_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(timestamp or time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET daily_bonus_prompted_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def get_daily_bonus_unlocked_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT daily_bonus_unlocked_at FROM users WHERE user_id=?",
@@ -1488,17 +2592,16 @@ def get_daily_bonus_unlocked_at(user_id: int) -> int:
 
 def set_daily_bonus_unlocked_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(timestamp or time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET daily_bonus_unlocked_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def get_daily_bonus_reminded_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT daily_bonus_reminded_at FROM users WHERE user_id=?",
@@ -1516,16 +2619,15 @@ def get_daily_bonus_reminded_at(user_id: int) -> int:
 
 def set_daily_bonus_reminded_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(timestamp or time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET daily_bonus_reminded_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 def get_low_credit_prompted_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT low_credit_prompted_at FROM users WHERE user_id=?",
@@ -1543,17 +2645,16 @@ def get_low_credit_prompted_at(user_id: int) -> int:
 
 def set_low_credit_prompted_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(time.time()) if timestamp is None else int(timestamp)
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET low_credit_prompted_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def get_tts_creator_prompted_at(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT tts_creator_prompted_at FROM users WHERE user_id=?",
@@ -1571,17 +2672,16 @@ def get_tts_creator_prompted_at(user_id: int) -> int:
 
 def set_tts_creator_prompted_at(user_id: int, timestamp: int | None = None) -> None:
     ts = int(time.time()) if timestamp is None else int(timestamp)
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET tts_creator_prompted_at=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def get_last_main_menu_id(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT last_main_menu_id FROM users WHERE user_id=?",
@@ -1599,31 +2699,29 @@ def get_last_main_menu_id(user_id: int) -> int:
 
 def set_last_main_menu_id(user_id: int, message_id: int | None) -> None:
     value = int(message_id or 0)
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET last_main_menu_id=? WHERE user_id=?",
             (value, user_id),
         )
-        con.commit()
 
 
 def set_last_daily_reward(user_id: int, timestamp: int | None = None) -> None:
     ts = int(timestamp or time.time())
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "UPDATE users SET last_daily_reward=? WHERE user_id=?",
             (ts, user_id),
         )
-        con.commit()
 
 
 def count_daily_reward_users() -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
-            "SELECT COUNT(*) FROM users WHERE IFNULL(last_daily_reward, 0) > 0"
+            "SELECT COUNT(*) FROM users WHERE last_daily_reward > 0"
         )
         row = cur.fetchone()
         return int(row[0]) if row else 0
@@ -1651,10 +2749,10 @@ def count_daily_reward_users_since(*, seconds: float | None = None, hours: float
         return count_daily_reward_users()
 
     threshold = int(time.time() - total_seconds)
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
-            "SELECT COUNT(*) FROM users WHERE IFNULL(last_daily_reward, 0) >= ?",
+            "SELECT COUNT(*) FROM users WHERE last_daily_reward >= ?",
             (threshold,),
         )
         row = cur.fetchone()
@@ -1664,7 +2762,7 @@ def count_daily_reward_users_since(*, seconds: float | None = None, hours: float
 def list_daily_reward_users(limit: int = 10, offset: int = 0):
     limit = max(0, int(limit))
     offset = max(0, int(offset))
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             """
@@ -1675,7 +2773,7 @@ def list_daily_reward_users(limit: int = 10, offset: int = 0):
                 banned,
                 last_daily_reward
             FROM users
-            WHERE IFNULL(last_daily_reward, 0) > 0
+            WHERE last_daily_reward > 0
             ORDER BY last_daily_reward DESC
             LIMIT ? OFFSET ?
             """,
@@ -1697,10 +2795,9 @@ def list_daily_reward_users(limit: int = 10, offset: int = 0):
 
 
 def set_user_lang(user_id:int, lang:str):
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("UPDATE users SET lang=? WHERE user_id=?", (lang, user_id))
-        con.commit()
 
 def get_user_lang(user_id:int, default="fa"):
     u = get_user(user_id)
@@ -1708,7 +2805,7 @@ def get_user_lang(user_id:int, default="fa"):
 
 # --- migrations: messages.kind (برای تمایز TTS)
 def _migrate_messages_kind():
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    with transaction() as con:
         cur = con.cursor()
         cur.execute("PRAGMA table_info(messages)")
         cols = {r[1] for r in cur.fetchall()}
@@ -1717,23 +2814,80 @@ def _migrate_messages_kind():
                 cur.execute("ALTER TABLE messages ADD COLUMN kind TEXT DEFAULT ''")
             except Exception:
                 pass
-        con.commit()
 
 # در init_db() بعد از ساخت جداول، اینو هم صدا بزن:
 # _migrate_messages_kind()
 
+# --- migrations: versioned schema changes tracked in PRAGMA user_version.
+# Each entry is one version; append new entries, never edit applied ones.
+_SCHEMA_MIGRATIONS = (
+    # 1: indexes matching the per-user history/log queries and admin stats.
+    (
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_kind ON messages(user_id, kind)",
+        "CREATE INDEX IF NOT EXISTS idx_gpt_messages_user ON gpt_messages(user_id, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_vexa_assistant_messages_user"
+        " ON vexa_assistant_messages(user_id, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_image_generations_user ON image_generations(user_id, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_user_voices_user ON user_voices(user_id, voice_name)",
+        "CREATE INDEX IF NOT EXISTS idx_user_voices_voice_id ON user_voices(voice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_sora2_requests_user ON sora2_requests(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by)",
+        "CREATE INDEX IF NOT EXISTS idx_users_lang ON users(COALESCE(NULLIF(lang, ''), 'fa'))",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_daily_reward ON users(last_daily_reward)",
+        "CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users(joined_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(LOWER(username))",
+    ),
+    # 2: pending-job scan of the generation dispatcher.
+    (
+        "CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs(status, id)",
+    ),
+    # 3: credit ledger history per user and open holds by expiry.
+    (
+        "CREATE INDEX IF NOT EXISTS idx_credit_ledger_user ON credit_ledger(user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_credit_ledger_held"
+        " ON credit_ledger(expires_at) WHERE status='held'",
+    ),
+    # 4: credit hold reserved for each generation job.
+    (
+        "ALTER TABLE generation_jobs ADD COLUMN hold_id INTEGER DEFAULT 0",
+    ),
+    # 5: LRU eviction order of the TTS audio cache.
+    (
+        "CREATE INDEX IF NOT EXISTS idx_tts_cache_last_used ON tts_cache(last_used_at, created_at)",
+    ),
+    # 6: callback URL of jobs submitted through the HTTP API.
+    (
+        "ALTER TABLE generation_jobs ADD COLUMN webhook_url TEXT DEFAULT ''",
+    ),
+    # 7: webhook signing secret, kept apart from the API token.
+    (
+        "ALTER TABLE api_tokens ADD COLUMN webhook_secret TEXT DEFAULT ''",
+    ),
+)
+
+
+def _apply_schema_migrations():
+    with transaction() as con:
+        cur = con.cursor()
+        cur.execute("PRAGMA user_version")
+        version = int(cur.fetchone()[0] or 0)
+        for number, statements in enumerate(_SCHEMA_MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(f"PRAGMA user_version={number}")
+
 def log_tts_request(user_id: int, text: str):
     """ثبت متن ارسالی کاربر برای TTS (فقط ورودی کاربر)"""
-    with closing(sqlite3.connect(DB_PATH)) as con:
-        cur = con.cursor()
-        cur.execute("""INSERT INTO messages(user_id, direction, text, created_at, kind)
-                       VALUES(?,?,?,?,?)""",
-                    (user_id, "in", text, int(time.time()), "tts_in"))
-        con.commit()
+    _enqueue_log(_INSERT_MESSAGE_SQL, (user_id, "in", text, int(time.time()), "tts_in"))
 
 
 def count_tts_requests(user_id: int) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as con:
+    flush_logs()
+    with transaction() as con:
         cur = con.cursor()
         cur.execute(
             "SELECT COUNT(*) FROM messages WHERE user_id=? AND kind='tts_in'",
@@ -1749,7 +2903,8 @@ def export_user_tts_csv(user_id: int, path=None):
     """خروجی فقط متن‌های TTS کاربر (چیزی که برای تبدیل فرستاده)"""
     if path is None:
         path = f"user_{user_id}_tts_texts.csv"
-    with closing(sqlite3.connect(DB_PATH)) as con, open(path, "w", newline="", encoding="utf-8") as f:
+    flush_logs()
+    with transaction() as con, open(path, "w", newline="", encoding="utf-8") as f:
         cur = con.cursor()
         cur.execute("""SELECT id, text, created_at
                        FROM messages
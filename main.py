@@ -7,6 +7,7 @@ from config import BOT_TOKEN
 import db
 
 # ---- Telegram modules ----
+from modules import generation_jobs, scheduler
 from modules.admin import handlers as admin_handlers
 from modules.home import handlers as home_handlers
 from modules.invite import handlers as invite_handlers
@@ -48,8 +49,11 @@ def register_modules(bot: telebot.TeleBot) -> None:
 
 def main() -> None:
     db.init_db()
+    db.start_maintenance()
     bot = create_bot()
     register_modules(bot)
+    scheduler.start(bot)
+    generation_jobs.start(bot)
 
     bot.infinity_polling(
         skip_pending=True,
@@ -0,0 +1,299 @@
+# modules/admin/broadcast.py
+"""Rate-limited broadcast engine for admin mass messages.
+
+A broadcast is stored in the ``broadcasts`` table together with a cursor
+(``last_user_id``).  A runner thread walks the recipients in keyset pages;
+each page is sent through a shared worker pool, and every send first takes
+a token from one global bucket that keeps us under Telegram's ~30 msg/s
+limit.  A 429 answer blocks the whole bucket for ``retry_after`` seconds
+and the recipient is retried.  After a page the cursor, counters and the
+delivery logs are written in a single transaction, so a paused or
+interrupted broadcast continues where it stopped.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+import db
+from .keyboards import broadcast_progress_menu
+
+logger = logging.getLogger(__name__)
+
+RATE = float(os.getenv("BROADCAST_RATE", "25") or 25)
+WORKERS = max(1, int(os.getenv("BROADCAST_WORKERS", "8") or 8))
+PAGE_SIZE = max(1, int(os.getenv("BROADCAST_PAGE_SIZE", "200") or 200))
+MAX_RETRIES = 3
+PROGRESS_INTERVAL = 3.0
+
+STATUS_LABELS = {
+    "running": "در حال ارسال ⏳",
+    "paused": "توقف موقت ⏸",
+    "done": "پایان یافت ✅",
+    "cancelled": "لغو شد ⛔️",
+}
+
+_MEDIA_SENDERS = {
+    "photo": "send_photo",
+    "document": "send_document",
+    "audio": "send_audio",
+    "voice": "send_voice",
+    "video": "send_video",
+}
+
+
+class _TokenBucket:
+    """Blocking token bucket shared by every broadcast."""
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self._rate = max(0.1, rate)
+        self._capacity = capacity or max(1.0, self._rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._blocked_until > now:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def block(self, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+_bucket = _TokenBucket(RATE)
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="broadcast")
+_runners: dict[int, threading.Thread] = {}
+_runners_lock = threading.Lock()
+_last_progress: dict[int, float] = {}
+
+
+# ---------- Content ----------
+def payload_from_message(msg) -> dict:
+    """Capture what is needed to re-send ``msg`` later, even after a restart."""
+
+    c = getattr(msg, "content_type", "text")
+    file_id = ""
+    file_name = ""
+    if c == "photo" and getattr(msg, "photo", None):
+        file_id = msg.photo[-1].file_id
+    elif c in ("document", "audio", "voice", "video", "sticker"):
+        media = getattr(msg, c, None)
+        if media is not None:
+            file_id = media.file_id
+            file_name = getattr(media, "file_name", "") or ""
+    return {
+        "content_type": c,
+        "text": msg.text or "",
+        "caption": msg.caption or "",
+        "file_id": file_id,
+        "file_name": file_name,
+        "chat_id": msg.chat.id,
+        "message_id": msg.message_id,
+    }
+
+
+def retry_after(exc: Exception) -> int | None:
+    """Seconds to wait when ``exc`` is Telegram's 429 flood-control answer."""
+
+    if not isinstance(exc, ApiTelegramException) or exc.error_code != 429:
+        return None
+    params = (exc.result_json or {}).get("parameters") or {}
+    try:
+        return max(1, int(params.get("retry_after") or 1))
+    except (TypeError, ValueError):
+        return 1
+
+
+def send_payload(bot, uid: int, payload: dict, reply_markup=None) -> str:
+    """
+    Send a captured admin message to ``uid`` and return the text to log.
+    Specific send_* methods are tried first, then copy_message, then
+    forward_message. Flood-control errors are raised immediately so the
+    caller can back off instead of burning through the fallbacks.
+    """
+    c = payload.get("content_type") or "text"
+    if c == "text":
+        bot.send_message(uid, payload.get("text") or "", reply_markup=reply_markup)
+        return payload.get("text") or ""
+
+    file_id = payload.get("file_id")
+    caption = payload.get("caption") or ""
+    if file_id and (c in _MEDIA_SENDERS or c == "sticker"):
+        try:
+            if c == "sticker":
+                bot.send_sticker(uid, file_id, reply_markup=reply_markup)
+                return "<sticker>"
+            getattr(bot, _MEDIA_SENDERS[c])(uid, file_id, caption=caption, reply_markup=reply_markup)
+            if c == "document":
+                return caption or f"<document:{payload.get('file_name') or ''}>"
+            return caption or f"<{c}>"
+        except Exception as exc:
+            if retry_after(exc) is not None:
+                raise
+
+    try:
+        bot.copy_message(uid, payload["chat_id"], payload["message_id"], reply_markup=reply_markup)
+        return f"<copied:{c}>"
+    except Exception as exc:
+        if retry_after(exc) is not None:
+            raise
+
+    bot.forward_message(uid, payload["chat_id"], payload["message_id"])
+    return f"<forwarded:{c}>"
+
+
+# ---------- Jobs ----------
+def start_broadcast(bot, msg, lang_code: str) -> int:
+    payload = payload_from_message(msg)
+    total = db.count_user_ids(lang_code)
+    broadcast_id = db.create_broadcast(
+        msg.chat.id, lang_code, json.dumps(payload, ensure_ascii=False), total
+    )
+    job = db.get_broadcast(broadcast_id)
+    progress = bot.reply_to(
+        msg,
+        _progress_text(job),
+        reply_markup=broadcast_progress_menu(broadcast_id, job["status"]),
+    )
+    db.set_broadcast_progress_message(broadcast_id, progress.message_id)
+    _spawn(bot, broadcast_id)
+    return broadcast_id
+
+
+def pause(bot, broadcast_id: int) -> bool:
+    changed = db.set_broadcast_status(broadcast_id, "paused", expected="running")
+    if changed:
+        _update_progress(bot, broadcast_id, force=True)
+    return changed
+
+
+def resume(bot, broadcast_id: int) -> bool:
+    changed = db.set_broadcast_status(broadcast_id, "running", expected="paused")
+    if changed:
+        _update_progress(bot, broadcast_id, force=True)
+        _spawn(bot, broadcast_id)
+    return changed
+
+
+def cancel(bot, broadcast_id: int) -> bool:
+    job = db.get_broadcast(broadcast_id)
+    if not job or job["status"] not in ("running", "paused"):
+        return False
+    changed = db.set_broadcast_status(broadcast_id, "cancelled", expected=job["status"])
+    if changed:
+        _update_progress(bot, broadcast_id, force=True)
+    return changed
+
+
+def resume_pending(bot) -> None:
+    """Restart the runners of broadcasts that were running before a restart."""
+
+    for job in db.list_broadcasts("running"):
+        _spawn(bot, job["id"])
+
+
+def _spawn(bot, broadcast_id: int) -> None:
+    with _runners_lock:
+        runner = _runners.get(broadcast_id)
+        if runner is not None and runner.is_alive():
+            return
+        runner = threading.Thread(
+            target=_run,
+            args=(bot, broadcast_id),
+            name=f"broadcast-{broadcast_id}",
+            daemon=True,
+        )
+        _runners[broadcast_id] = runner
+        runner.start()
+
+
+def _run(bot, broadcast_id: int) -> None:
+    try:
+        while True:
+            job = db.get_broadcast(broadcast_id)
+            if not job or job["status"] != "running":
+                return
+            user_ids = db.get_user_ids_after(job["last_user_id"], job["lang_code"], PAGE_SIZE)
+            if not user_ids:
+                db.set_broadcast_status(broadcast_id, "done", expected="running")
+                _update_progress(bot, broadcast_id, force=True)
+                return
+            payload = json.loads(job["payload"])
+            results = list(_executor.map(lambda uid: _deliver(bot, uid, payload), user_ids))
+            logs = [(uid, text) for uid, (ok, text) in zip(user_ids, results) if ok]
+            db.advance_broadcast(
+                broadcast_id, user_ids[-1], len(logs), len(user_ids) - len(logs), logs
+            )
+            _update_progress(bot, broadcast_id)
+    except Exception:
+        logger.exception("Broadcast %s stopped unexpectedly", broadcast_id)
+    finally:
+        with _runners_lock:
+            if _runners.get(broadcast_id) is threading.current_thread():
+                del _runners[broadcast_id]
+
+
+def _deliver(bot, uid: int, payload: dict) -> tuple[bool, str]:
+    for attempt in range(MAX_RETRIES + 1):
+        _bucket.acquire()
+        try:
+            return True, send_payload(bot, uid, payload)
+        except Exception as exc:
+            wait = retry_after(exc)
+            if wait is None or attempt == MAX_RETRIES:
+                return False, str(exc)
+            logger.warning("Broadcast hit flood control, waiting %ss", wait)
+            _bucket.block(wait)
+    return False, "retries exhausted"
+
+
+# ---------- Progress ----------
+def _progress_text(job: dict) -> str:
+    return (
+        f"📣 پیام همگانی #{job['id']}\n"
+        f"وضعیت: {STATUS_LABELS.get(job['status'], job['status'])}\n"
+        f"✅ ارسال‌شده: <b>{job['sent']}</b> / {job['total']}\n"
+        f"❌ ناموفق: <b>{job['failed']}</b>"
+    )
+
+
+def _update_progress(bot, broadcast_id: int, *, force: bool = False) -> None:
+    now = time.monotonic()
+    if not force and now - _last_progress.get(broadcast_id, 0.0) < PROGRESS_INTERVAL:
+        return
+    _last_progress[broadcast_id] = now
+    job = db.get_broadcast(broadcast_id)
+    if not job or not job["progress_message_id"]:
+        return
+    _bucket.acquire()
+    try:
+        bot.edit_message_text(
+            _progress_text(job),
+            chat_id=job["admin_chat_id"],
+            message_id=job["progress_message_id"],
+            reply_markup=broadcast_progress_menu(broadcast_id, job["status"]),
+        )
+    except Exception as exc:
+        if "message is not modified" not in str(exc):
+            logger.warning("Failed to update broadcast %s progress: %s", broadcast_id, exc)
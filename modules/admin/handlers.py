@@ -5,9 +5,11 @@ import datetime
 
 from telebot import types
 
-from utils import edit_or_send, parse_int, send_main_menu
+from utils import edit_or_send, parse_int, send_main_menu, state_equals, state_startswith
 from config import BOT_OWNER_ID
 import db
+from modules import http_client, singleflight
+from modules.gpt.service import search_cache_stats, usage_stats as gpt_usage_stats
 import traceback
 import os
 import math
@@ -61,6 +63,8 @@ from modules.i18n import t
 from modules.tts.service import synthesize
 from modules.tts.settings import set_demo_audio, clear_demo_audio
 from modules.welcome_audio import set_welcome_audio, clear_welcome_audio
+from modules import media_cache
+from . import broadcast
 
 LANG_LABELS = {code: label for label, code in LANGS}
 MENU_LABELS = {
@@ -131,106 +135,20 @@ def _send_content_to_user(bot, uid: int, msg: types.Message, reply_markup=None):
     Try to send the admin's message (text/photo/document/audio/voice/video/sticker/...) to `uid`.
     Returns (True, None) on success.
     Returns (False, error_message) on failure. error_message is a short description for debugging.
-    The function attempts specific send_* methods first, then copy_message, then forward_message as fallbacks.
+    The sending itself (send_* first, then copy_message, then forward_message) lives in
+    broadcast.send_payload so single messages and broadcasts behave the same.
     """
-    last_err = None
-    c = getattr(msg, "content_type", "text")
     try:
-        # TEXT
-        if c == "text":
-            bot.send_message(uid, msg.text or "", reply_markup=reply_markup)
-            db.log_message(uid, "out", msg.text or "")
-            return True, None
-
-        # PHOTO (use largest size)
-        if c == "photo" and getattr(msg, "photo", None):
-            file_id = msg.photo[-1].file_id
-            try:
-                bot.send_photo(uid, file_id, caption=(msg.caption or ""), reply_markup=reply_markup)
-                db.log_message(uid, "out", msg.caption or "<photo>")
-                return True, None
-            except Exception as e:
-                last_err = e
-
-        # DOCUMENT
-        if c == "document" and getattr(msg, "document", None):
-            file_id = msg.document.file_id
-            caption = msg.caption or ""
-            try:
-                bot.send_document(uid, file_id, caption=caption, reply_markup=reply_markup)
-                fn = getattr(msg.document, "file_name", "")
-                db.log_message(uid, "out", caption or f"<document:{fn}>")
-                return True, None
-            except Exception as e:
-                last_err = e
-
-        # AUDIO (music)
-        if c == "audio" and getattr(msg, "audio", None):
-            file_id = msg.audio.file_id
-            try:
-                bot.send_audio(uid, file_id, caption=(msg.caption or ""), reply_markup=reply_markup)
-                db.log_message(uid, "out", msg.caption or "<audio>")
-                return True, None
-            except Exception as e:
-                last_err = e
-
-        # VOICE (voice note)
-        if c == "voice" and getattr(msg, "voice", None):
-            file_id = msg.voice.file_id
-            try:
-                bot.send_voice(uid, file_id, caption=(msg.caption or ""), reply_markup=reply_markup)
-                db.log_message(uid, "out", msg.caption or "<voice>")
-                return True, None
-            except Exception as e:
-                last_err = e
-
-        # VIDEO
-        if c == "video" and getattr(msg, "video", None):
-            file_id = msg.video.file_id
-            try:
-                bot.send_video(uid, file_id, caption=(msg.caption or ""), reply_markup=reply_markup)
-                db.log_message(uid, "out", msg.caption or "<video>")
-                return True, None
-            except Exception as e:
-                last_err = e
-
-        # STICKER
-        if c == "sticker" and getattr(msg, "sticker", None):
-            file_id = msg.sticker.file_id
-            try:
-                bot.send_sticker(uid, file_id, reply_markup=reply_markup)
-                db.log_message(uid, "out", "<sticker>")
-                return True, None
-            except Exception as e:
-                last_err = e
-
-        # If specific attempts failed or type not handled above, try copy_message (preferred over forward)
-        try:
-            # copy_message does not require the bot to be able to access the original chat as a member in the same way forward does,
-            # and it preserves media without reuploading whenever possible.
-            bot.copy_message(uid, msg.chat.id, msg.message_id, reply_markup=reply_markup)
-            db.log_message(uid, "out", f"<copied:{c}>")
-            return True, None
-        except Exception as e:
-            last_err = e
-
-        # Final fallback: try forwarding original message (requires bot to be able to forward)
-        try:
-            bot.forward_message(uid, msg.chat.id, msg.message_id)
-            db.log_message(uid, "out", f"<forwarded:{c}>")
-            return True, None
-        except Exception as e:
-            last_err = e
-
+        log_text = broadcast.send_payload(
+            bot, uid, broadcast.payload_from_message(msg), reply_markup=reply_markup
+        )
     except Exception as e:
-        last_err = e
-
-    # If we get here, everything failed. Return False and a short error string.
-    # Include traceback in stdout for debugging.
-    tb = traceback.format_exc()
-    print("Error sending admin content to user:", tb)
-    err_msg = str(last_err) if last_err else "unknown error"
-    return False, err_msg
+        # Include traceback in stdout for debugging.
+        tb = traceback.format_exc()
+        print("Error sending admin content to user:", tb)
+        return False, str(e) or "unknown error"
+    db.log_message(uid, "out", log_text)
+    return True, None
 
 def _round_half_up(value):
     try:
@@ -280,6 +198,9 @@ def _compute_formula_updates(expr: str):
 
 # ---------- Register ----------
 def register(bot):
+    # پیام‌های همگانی نیمه‌کاره قبل از ری‌استارت از همان نقطه ادامه پیدا می‌کنند
+    broadcast.resume_pending(bot)
+
     @bot.message_handler(commands=['admin'])
     def admin_cmd(msg: types.Message):
         if not _is_owner(msg.from_user):
@@ -319,6 +240,8 @@ def register(bot):
 
         # آمار
         if action == "stats":
+            # قبل از شمارش‌ها خوانده می‌شود چون آن‌ها صف لاگ را خالی می‌کنند
+            log_stats = db.get_log_buffer_stats()
             total = db.count_users()
             try:
                 active24 = db.count_active_users(24)
@@ -355,7 +278,31 @@ def register(bot):
                    f"🎙 تعداد صداهای کلون: <b>{clone_total}</b>\n"
                    f"🎁 پاداش روزانه (کل): <b>{daily_reward_users}</b>\n"
                    f"   ├ ۲۴ ساعت گذشته: <b>{daily_reward_users_24h}</b>\n"
-                   f"   └ ۷ روز گذشته: <b>{daily_reward_users_7d}</b>")
+                   f"   └ ۷ روز گذشته: <b>{daily_reward_users_7d}</b>\n"
+                   f"🗂 صف لاگ: <b>{log_stats['queue_depth']}</b> "
+                   f"(بیشینه {log_stats['max_queue_depth']})\n"
+                   f"   ├ زمان flush: {log_stats['last_flush_ms']}ms "
+                   f"(بیشینه {log_stats['max_flush_ms']}ms)\n"
+                   f"   └ ردیف‌های برگشته به صف: {log_stats['requeued_rows']}، "
+                   f"از دست رفته: {log_stats['failed_rows']}")
+            for provider, item in http_client.stats().items():
+                txt += (f"\n🌐 {escape(provider)}: <b>{item['requests']}</b> درخواست، "
+                        f"{item['errors']} خطا، {item['retries']} تلاش دوباره، "
+                        f"میانگین {item['avg_ms']}ms (بیشینه {item['max_ms']}ms)")
+            gpt_usage = gpt_usage_stats()
+            if gpt_usage["requests"]:
+                txt += (f"\n🧠 توکن‌های پرامپت GPT: <b>{gpt_usage['prompt_tokens']}</b> "
+                        f"(کش‌شده {gpt_usage['cached_tokens']} = {gpt_usage['cached_percent']}٪، "
+                        f"بدون کش {gpt_usage['uncached_tokens']})، خروجی {gpt_usage['completion_tokens']}\n"
+                        f"   └ میانگین زمان: با کش {gpt_usage['cached_avg_ms']}ms، "
+                        f"بدون کش {gpt_usage['uncached_avg_ms']}ms")
+            search = search_cache_stats()
+            if search["hits"] or search["misses"]:
+                txt += (f"\n🔎 کش جستجو: <b>{search['hits']}</b> از کش، {search['misses']} درخواست به سرویس "
+                        f"({search['size']} پرسش در کش)")
+            for provider, item in singleflight.stats().items():
+                txt += (f"\n🔁 {escape(provider)}: <b>{item['coalesced']}</b> درخواست تکراری هم‌زمان ادغام شد "
+                        f"({item['calls']} درخواست به سرویس، {item['in_flight']} در جریان)")
             edit_or_send(bot, cq.message.chat.id, cq.message.message_id, txt, admin_menu())
             return
 
@@ -740,6 +687,19 @@ def register(bot):
             edit_or_send(bot, cq.message.chat.id, cq.message.message_id, ASK_LANG_CAST, cast_lang_menu())
             return
 
+        if action in ("cast_pause", "cast_resume", "cast_stop"):
+            broadcast_id = int(p[2])
+            handler = {
+                "cast_pause": broadcast.pause,
+                "cast_resume": broadcast.resume,
+                "cast_stop": broadcast.cancel,
+            }[action]
+            if handler(bot, broadcast_id):
+                bot.answer_callback_query(cq.id, DONE)
+            else:
+                bot.answer_callback_query(cq.id, "⚠️ وضعیت پیام همگانی تغییر کرده است.")
+            return
+
         if action == "cast_lang":
             lang_code = p[2] if len(p) >= 3 else "all"
             db.clear_state(cq.from_user.id)
@@ -1036,7 +996,11 @@ def register(bot):
                 bot.answer_callback_query(cq.id, "❌ آی‌دی نامعتبر."); return
 
             try:
-                result = db.export_user_images_zip(uid)
+                # تصاویری که قبلاً ارسال شده‌اند از تلگرام گرفته می‌شوند، نه از Runway
+                result = db.export_user_images_zip(
+                    uid,
+                    fetch=lambda url: media_cache.download(bot, media_cache.url_key(url), "photo"),
+                )
             except AttributeError:
                 bot.answer_callback_query(cq.id, "❌ عملیات خروجی تصاویر پشتیبانی نمی‌شود."); return
             except Exception:
@@ -1084,7 +1048,7 @@ def register(bot):
             bot.answer_callback_query(cq.id); return
 
     # ---------- States ----------
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_USER_LOOKUP, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_USER_LOOKUP), content_types=['text'])
     def s_lookup(msg: types.Message):
         if not _is_owner(msg.from_user): return
         uid = _resolve_user_id(msg.text)
@@ -1097,7 +1061,7 @@ def register(bot):
         edit_or_send(bot, msg.chat.id, msg.message_id, txt, user_actions(uid))
         db.clear_state(msg.from_user.id)
 
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_FORMULA, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_FORMULA), content_types=['text'])
     def s_formula(msg: types.Message):
         if not _is_owner(msg.from_user): return
         expr = (msg.text or "").strip()
@@ -1130,7 +1094,7 @@ def register(bot):
         db.clear_state(msg.from_user.id)
 
     # افزودن کردیت
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_ADD_UID, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_ADD_UID), content_types=['text'])
     def s_add_uid(msg: types.Message):
         if not _is_owner(msg.from_user): return
         uid = _resolve_user_id(msg.text)
@@ -1139,7 +1103,7 @@ def register(bot):
         db.set_state(msg.from_user.id, f"{STATE_ADD_AMT}:{uid}")
         bot.reply_to(msg, ASK_AMT_ADD)
 
-    @bot.message_handler(func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_ADD_AMT), content_types=['text'])
+    @bot.message_handler(func=state_startswith(STATE_ADD_AMT), content_types=['text'])
     def s_add_amt(msg: types.Message):
         if not _is_owner(msg.from_user): return
         raw = (db.get_state(msg.from_user.id) or "").split(":")
@@ -1149,13 +1113,15 @@ def register(bot):
             amt = parse_int(msg.text)
         except Exception:
             bot.reply_to(msg, "❌ فقط عدد."); return
-        db.add_credits(uid, amt)
-        newc = db.get_user(uid)["credits"]
+        newc = db.add_credits(uid, amt, reason="admin")
+        if newc is None:
+            newc = (db.get_user(uid) or {}).get("credits", 0)
+        newc = db.format_credit_amount(newc)
         bot.reply_to(msg, f"{DONE}\n👤 <code>{uid}</code>\n➕ +{amt}💳\n💼 موجودی: <b>{newc}</b>")
         db.clear_state(msg.from_user.id)
 
     # کسر کردیت
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_SUB_UID, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_SUB_UID), content_types=['text'])
     def s_sub_uid(msg: types.Message):
         if not _is_owner(msg.from_user): return
         uid = _resolve_user_id(msg.text)
@@ -1164,7 +1130,7 @@ def register(bot):
         db.set_state(msg.from_user.id, f"{STATE_SUB_AMT}:{uid}")
         bot.reply_to(msg, ASK_AMT_SUB)
 
-    @bot.message_handler(func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_SUB_AMT), content_types=['text'])
+    @bot.message_handler(func=state_startswith(STATE_SUB_AMT), content_types=['text'])
     def s_sub_amt(msg: types.Message):
         if not _is_owner(msg.from_user): return
         raw = (db.get_state(msg.from_user.id) or "").split(":")
@@ -1174,12 +1140,14 @@ def register(bot):
             amt = abs(parse_int(msg.text))
         except Exception:
             bot.reply_to(msg, "❌ فقط عدد."); return
-        db.add_credits(uid, -amt)
-        newc = db.get_user(uid)["credits"]
+        newc = db.add_credits(uid, -amt, reason="admin")
+        if newc is None:
+            newc = (db.get_user(uid) or {}).get("credits", 0)
+        newc = db.format_credit_amount(newc)
         bot.reply_to(msg, f"{DONE}\n👤 <code>{uid}</code>\n➖ -{amt}💳\n💼 موجودی: <b>{newc}</b>")
         db.clear_state(msg.from_user.id)
 
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_RESET_UID, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_RESET_UID), content_types=['text'])
     def s_reset(msg: types.Message):
         if not _is_owner(msg.from_user): return
         uid = _resolve_user_id(msg.text)
@@ -1191,7 +1159,7 @@ def register(bot):
         db.clear_state(msg.from_user.id)
 
     # پیام تکی
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_MSG_UID, content_types=['text', 'photo', 'document', 'audio', 'voice', 'video', 'sticker'])
+    @bot.message_handler(func=state_equals(STATE_MSG_UID), content_types=['text', 'photo', 'document', 'audio', 'voice', 'video', 'sticker'])
     def s_msg_uid(msg: types.Message):
         if not _is_owner(msg.from_user): return
         # Allow admin to send UID either as plain text or as a reply with text.
@@ -1205,7 +1173,7 @@ def register(bot):
         db.set_state(msg.from_user.id, f"{STATE_MSG_TXT}:{uid}")
         bot.reply_to(msg, ASK_TXT_MSG)
 
-    @bot.message_handler(func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_MSG_TXT), content_types=['text', 'photo', 'document', 'audio', 'voice', 'video', 'sticker'])
+    @bot.message_handler(func=state_startswith(STATE_MSG_TXT), content_types=['text', 'photo', 'document', 'audio', 'voice', 'video', 'sticker'])
     def s_msg_txt(msg: types.Message):
         if not _is_owner(msg.from_user): return
         state_raw = db.get_state(msg.from_user.id) or ""
@@ -1230,27 +1198,17 @@ def register(bot):
         db.clear_state(msg.from_user.id)
 
     # پیام همگانی
-    @bot.message_handler(func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_CAST_TXT), content_types=['text', 'photo', 'document', 'audio', 'voice', 'video', 'sticker'])
+    @bot.message_handler(func=state_startswith(STATE_CAST_TXT), content_types=['text', 'photo', 'document', 'audio', 'voice', 'video', 'sticker'])
     def s_cast(msg: types.Message):
         if not _is_owner(msg.from_user): return
-        sent = 0
         state_raw = db.get_state(msg.from_user.id) or ""
         parts = state_raw.split(":")
         lang_code = parts[-1] if len(parts) >= 3 else "all"
-        user_ids = db.get_all_user_ids() if lang_code == "all" else db.get_user_ids_by_lang(lang_code)
-        for uid in user_ids:
-            try:
-                ok, err = _send_content_to_user(bot, uid, msg)
-                if ok:
-                    sent += 1
-            except Exception:
-                # keep sending to others even on errors
-                print("Error during cast to", uid, traceback.format_exc())
-                pass
         db.clear_state(msg.from_user.id)
-        bot.reply_to(msg, f"{DONE}\n📣 ارسال شد به {sent} کاربر.")
+        # ارسال در پس‌زمینه با محدودیت نرخ؛ پیشرفت در پیام وضعیت نمایش داده می‌شود
+        broadcast.start_broadcast(bot, msg, lang_code)
 
-    @bot.message_handler(func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_CLONE_TTS), content_types=['text'])
+    @bot.message_handler(func=state_startswith(STATE_CLONE_TTS), content_types=['text'])
     def s_clone_tts(msg: types.Message):
         if not _is_owner(msg.from_user): return
         state_raw = db.get_state(msg.from_user.id) or ""
@@ -1283,7 +1241,7 @@ def register(bot):
                 pass
 
     # تنظیمات
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_SET_BONUS, content_types=['text', 'photo', 'document'])
+    @bot.message_handler(func=state_equals(STATE_SET_BONUS), content_types=['text', 'photo', 'document'])
     def s_set_bonus(msg: types.Message):
         if not _is_owner(msg.from_user): return
         try:
@@ -1294,7 +1252,7 @@ def register(bot):
         db.clear_state(msg.from_user.id)
         bot.reply_to(msg, f"{DONE}\n🎁 بونوس رفرال: <b>{val}</b>")
 
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_SET_FREE, content_types=['text', 'photo', 'document'])
+    @bot.message_handler(func=state_equals(STATE_SET_FREE), content_types=['text', 'photo', 'document'])
     def s_set_free(msg: types.Message):
         if not _is_owner(msg.from_user): return
         try:
@@ -1305,14 +1263,14 @@ def register(bot):
         db.clear_state(msg.from_user.id)
         bot.reply_to(msg, f"{DONE}\n🎉 کردیت شروع: <b>{val}</b>")
 
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_SET_TG, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_SET_TG), content_types=['text'])
     def s_set_tg(msg: types.Message):
         if not _is_owner(msg.from_user): return
         db.set_setting("TG_CHANNEL", (msg.text or "").strip())
         db.clear_state(msg.from_user.id)
         bot.reply_to(msg, DONE)
 
-    @bot.message_handler(func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_SET_TG_LANG), content_types=['text'])
+    @bot.message_handler(func=state_startswith(STATE_SET_TG_LANG), content_types=['text'])
     def s_set_tg_lang(msg: types.Message):
         if not _is_owner(msg.from_user): return
         raw_state = db.get_state(msg.from_user.id) or ""
@@ -1326,7 +1284,7 @@ def register(bot):
         db.clear_state(msg.from_user.id)
         bot.reply_to(msg, DONE)
 
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_SET_IG, content_types=['text'])
+    @bot.message_handler(func=state_equals(STATE_SET_IG), content_types=['text'])
     def s_set_ig(msg: types.Message):
         if not _is_owner(msg.from_user): return
         db.set_setting("IG_URL", (msg.text or "").strip())
@@ -1334,7 +1292,7 @@ def register(bot):
         bot.reply_to(msg, DONE)
 
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_DEMO_AUDIO),
+        func=state_startswith(STATE_DEMO_AUDIO),
         content_types=['audio', 'voice', 'document'],
     )
     def s_set_demo_audio(msg: types.Message):
@@ -1378,7 +1336,7 @@ def register(bot):
         bot.reply_to(msg, f"{DONE}\n🎧 دمو برای <b>{voice_name}</b> ({lang_label}) ذخیره شد.")
 
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_WELCOME_AUDIO),
+        func=state_startswith(STATE_WELCOME_AUDIO),
         content_types=['audio', 'voice', 'document'],
     )
     def s_set_welcome_audio(msg: types.Message):
@@ -70,6 +70,21 @@ def cast_lang_menu():
     return kb
 
 
+def broadcast_progress_menu(broadcast_id: int, status: str):
+    kb = InlineKeyboardMarkup()
+    if status == "running":
+        kb.row(
+            InlineKeyboardButton("⏸ توقف موقت", callback_data=f"admin:cast_pause:{broadcast_id}"),
+            InlineKeyboardButton("⛔️ لغو", callback_data=f"admin:cast_stop:{broadcast_id}"),
+        )
+    elif status == "paused":
+        kb.row(
+            InlineKeyboardButton("▶️ ادامه", callback_data=f"admin:cast_resume:{broadcast_id}"),
+            InlineKeyboardButton("⛔️ لغو", callback_data=f"admin:cast_stop:{broadcast_id}"),
+        )
+    return kb
+
+
 def voice_clone_menu(page: int = 0, page_size: int = 8):
     page = max(0, int(page))
     offset = page * page_size
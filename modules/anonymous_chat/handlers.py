@@ -4,7 +4,6 @@ from __future__ import annotations
 
 import json
 import random
-import threading
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Sequence, Tuple
 
@@ -12,8 +11,9 @@ from telebot.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMar
 
 import db
 from config import GPT_API_KEY
+from modules import scheduler
 from modules.gpt.service import GPTServiceError, chat_completion, extract_message_text, resolve_gpt_api_key
-from utils import edit_or_send, ensure_force_sub
+from utils import edit_or_send, ensure_force_sub, message_state
 
 from .characters import CHARACTERS
 
@@ -31,6 +31,10 @@ INITIAL_MESSAGE_PROBABILITY = 0.5
 STICKER_PROBABILITY = 0.01
 STICKER_FILE_IDS: Sequence[str] = ()
 
+CONNECT_TASK = "anon_chat:connect"
+INITIAL_MESSAGE_TASK = "anon_chat:initial_message"
+RESPONSE_TASK = "anon_chat:response"
+
 INITIAL_MESSAGES: Sequence[Tuple[str, float]] = (
     ("سلام", 0.80),
     ("چطوری", 0.013),
@@ -134,6 +138,27 @@ def _save_session(user_id: int, session: AnonymousSession) -> None:
     db.set_state(user_id, f"{ANON_STATE_PREFIX}:{state}")
 
 
+# قوانین مشترک همهٔ شخصیت‌ها اول پرامپت می‌آیند و مشخصات هر شخصیت بعد از آن،
+# تا ابتدای درخواست‌ها (پرامپت سیستمی + تاریخچه) ثابت بماند و کش پرامپت سرویس GPT بخورد
+_RULES: Tuple[str, ...] = (
+    "فقط فارسی محاوره‌ای بنویس و از اموجی مناسب استفاده کن.",
+    "همیشه خودت را یک انسان واقعی معرفی کن و هرگز نگو ربات یا هوش مصنوعی هستی.",
+    "استایل و لحن شخصیت را دقیقا رعایت کن و به جزئیات رفتارهایش توجه داشته باش.",
+    "حدود ۳۰٪ مواقع جواب خیلی کوتاه (۱ تا ۳ کلمه) یا شبیه مثال‌های شخصیت بده.",
+    "حدود ۱۰٪ مواقع فقط یک اموجی یا استیکر متنی بفرست (مثلا 😂 یا 😅).",
+    "حدود ۵۰٪ مواقع جواب کامل بین ۱ تا ۳ جمله بده.",
+    "حدود ۱۰٪ مواقع طبیعی به سن یا علایق یا جنسیت خودت اشاره کن.",
+    "به تاریخچه مکالمه دقت کن و به صحبت‌های قبلی ارجاع بده.",
+    "اگر گفتگو حس رمانتیک پیدا کرد و شخصیت دختر است با لحن نرم و ناز جواب بده.",
+    "اگر شخصیت پسر است می‌تواند رک، شوخ و کمی شیطون باشد.",
+)
+_PROMPT_HEADER = (
+    "تو باید نقش یک انسان واقعی را بازی کنی و هویت واقعی‌ات همیشه همین شخصیت باشد. "
+    "هیچ‌وقت اشاره نکن که ربات یا مدل زبانی هستی.\n\n"
+    "قوانین پاسخ‌گویی:\n" + "\n".join(f"- {rule}" for rule in _RULES)
+)
+
+
 def _build_system_prompt(persona: Dict[str, Any]) -> str:
     name = persona.get("name", "")
     gender = persona.get("gender", "")
@@ -151,23 +176,8 @@ def _build_system_prompt(persona: Dict[str, Any]) -> str:
 
     interests_text = ", ".join(str(item) for item in interests if str(item).strip())
 
-    rules: List[str] = [
-        "فقط فارسی محاوره‌ای بنویس و از اموجی مناسب استفاده کن.",
-        "همیشه خودت را یک انسان واقعی معرفی کن و هرگز نگو ربات یا هوش مصنوعی هستی.",
-        "استایل و لحن شخصیت را دقیقا رعایت کن و به جزئیات رفتارهایش توجه داشته باش.",
-        "حدود ۳۰٪ مواقع جواب خیلی کوتاه (۱ تا ۳ کلمه) یا شبیه مثال‌های شخصیت بده.",
-        "حدود ۱۰٪ مواقع فقط یک اموجی یا استیکر متنی بفرست (مثلا 😂 یا 😅).",
-        "حدود ۵۰٪ مواقع جواب کامل بین ۱ تا ۳ جمله بده.",
-        "حدود ۱۰٪ مواقع طبیعی به سن یا علایق یا جنسیت خودت اشاره کن.",
-        "به تاریخچه مکالمه دقت کن و به صحبت‌های قبلی ارجاع بده.",
-        "اگر گفتگو حس رمانتیک پیدا کرد و شخصیت دختر است با لحن نرم و ناز جواب بده.",
-        "اگر شخصیت پسر است می‌تواند رک، شوخ و کمی شیطون باشد.",
-    ]
-
-    rules_text = "\n".join(f"- {rule}" for rule in rules)
-
     prompt = f"""
-تو باید نقش یک انسان واقعی را بازی کنی و هویت واقعی‌ات همیشه همین شخصیت باشد. هیچ‌وقت اشاره نکن که ربات یا مدل زبانی هستی.
+{_PROMPT_HEADER}
 
 مشخصات شخصیت:
 - نام: {name}
@@ -181,14 +191,28 @@ def _build_system_prompt(persona: Dict[str, Any]) -> str:
 
 نمونه جملات:
 {_fmt(examples)}
-
-قوانین پاسخ‌گویی:
-{rules_text}
 """.strip()
 
     return prompt
 
 
+def _persona_key(persona: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(str(persona.get(field, "")) for field in ("name", "gender", "age", "style"))
+
+
+# پرامپت هر شخصیت یک بار هنگام بالا آمدن ساخته می‌شود؛ شخصیت داخل state کاربر
+# همان دیکشنری CHARACTERS است که JSON شده، پس با همین کلید پیدا می‌شود
+_SYSTEM_PROMPTS: Dict[Tuple[str, ...], str] = {_persona_key(persona): _build_system_prompt(persona) for persona in CHARACTERS}
+
+
+def _system_prompt(persona: Dict[str, Any]) -> str:
+    prompt = _SYSTEM_PROMPTS.get(_persona_key(persona))
+    if prompt is None:
+        # شخصیتی که از نسخهٔ قبلی CHARACTERS در state مانده
+        prompt = _build_system_prompt(persona)
+    return prompt
+
+
 def _handle_force_sub(bot, user_id: int, chat_id: int, message_id: int | None, lang: str) -> bool:
     return ensure_force_sub(bot, user_id, chat_id, message_id, lang)
 
@@ -203,45 +227,53 @@ def _start_search(bot, user_id: int, chat_id: int) -> None:
         return
 
     delay = random.uniform(MIN_CONNECTION_DELAY, MIN_CONNECTION_DELAY + 6)
+    scheduler.schedule(
+        CONNECT_TASK,
+        delay,
+        {"user_id": user_id, "chat_id": chat_id},
+        key=f"{CONNECT_TASK}:{user_id}",
+    )
 
-    def _complete_connection() -> None:
-        current = _load_session(user_id)
-        if not current or current.status != "searching":
-            return
-        persona = random.choice(CHARACTERS)
-        next_session = AnonymousSession(status="active", persona=persona, history=[])
-        _save_session(user_id, next_session)
-        try:
-            bot.send_message(chat_id, CONNECTED_TEXT, reply_markup=_make_keyboard())
-        except Exception:
-            pass
-        else:
-            def _send_initial_message() -> None:
-                session = _load_session(user_id)
-                if not session or session.status != "active":
-                    return
-                if random.random() > INITIAL_MESSAGE_PROBABILITY:
-                    return
-                text = _weighted_choice(INITIAL_MESSAGES)
-                try:
-                    bot.send_message(chat_id, text)
-                except Exception:
-                    pass
-
-            initial_delay = random.uniform(*INITIAL_MESSAGE_DELAY_RANGE)
-            timer = threading.Timer(initial_delay, _send_initial_message)
-            timer.daemon = True
-            timer.start()
-
-    timer = threading.Timer(delay, _complete_connection)
-    timer.daemon = True
-    timer.start()
+
+def _complete_connection(bot, user_id: int, chat_id: int) -> None:
+    current = _load_session(user_id)
+    if not current or current.status != "searching":
+        return
+    persona = random.choice(CHARACTERS)
+    next_session = AnonymousSession(status="active", persona=persona, history=[])
+    _save_session(user_id, next_session)
+    try:
+        bot.send_message(chat_id, CONNECTED_TEXT, reply_markup=_make_keyboard())
+    except Exception:
+        return
+
+    initial_delay = random.uniform(*INITIAL_MESSAGE_DELAY_RANGE)
+    scheduler.schedule(
+        INITIAL_MESSAGE_TASK,
+        initial_delay,
+        {"user_id": user_id, "chat_id": chat_id},
+        key=f"{INITIAL_MESSAGE_TASK}:{user_id}",
+    )
+
+
+def _send_initial_message(bot, user_id: int, chat_id: int) -> None:
+    session = _load_session(user_id)
+    if not session or session.status != "active":
+        return
+    if random.random() > INITIAL_MESSAGE_PROBABILITY:
+        return
+    text = _weighted_choice(INITIAL_MESSAGES)
+    try:
+        bot.send_message(chat_id, text)
+    except Exception:
+        pass
 
 
 def _reset_history(history: List[Dict[str, str]]) -> List[Dict[str, str]]:
     if len(history) <= MAX_HISTORY_ITEMS:
         return history
-    return history[-MAX_HISTORY_ITEMS:]
+    # یک‌جا تا نصف کوتاه می‌شود نه یکی‌یکی، تا چند نوبت بعد ابتدای درخواست عوض نشود
+    return history[-(MAX_HISTORY_ITEMS // 2):]
 
 
 def _process_user_message(bot, message: Message, session: AnonymousSession) -> None:
@@ -258,7 +290,7 @@ def _process_user_message(bot, message: Message, session: AnonymousSession) -> N
         bot.reply_to(message, GPT_MISSING_TEXT)
         return
 
-    system_prompt = _build_system_prompt(persona)
+    system_prompt = _system_prompt(persona)
 
     history = _reset_history(list(session.history))
 
@@ -288,26 +320,29 @@ def _process_user_message(bot, message: Message, session: AnonymousSession) -> N
     session.history = _reset_history(history)
     _save_session(message.from_user.id, session)
 
-    def _send_response() -> None:
-        if random.random() < STICKER_PROBABILITY and STICKER_FILE_IDS:
-            sticker_id = random.choice(STICKER_FILE_IDS)
-            try:
-                bot.send_sticker(message.chat.id, sticker_id)
-                return
-            except Exception:
-                pass
+    delay = random.uniform(*RESPONSE_DELAY_RANGE)
+    scheduler.schedule(RESPONSE_TASK, delay, {"chat_id": message.chat.id, "answer": answer})
+
+
+def _send_response(bot, chat_id: int, answer: str) -> None:
+    if random.random() < STICKER_PROBABILITY and STICKER_FILE_IDS:
+        sticker_id = random.choice(STICKER_FILE_IDS)
         try:
-            bot.send_message(message.chat.id, answer)
+            bot.send_sticker(chat_id, sticker_id)
+            return
         except Exception:
             pass
-
-    delay = random.uniform(*RESPONSE_DELAY_RANGE)
-    timer = threading.Timer(delay, _send_response)
-    timer.daemon = True
-    timer.start()
+    try:
+        bot.send_message(chat_id, answer)
+    except Exception:
+        pass
 
 
 def register(bot) -> None:
+    scheduler.register_handler(CONNECT_TASK, _complete_connection)
+    scheduler.register_handler(INITIAL_MESSAGE_TASK, _send_initial_message)
+    scheduler.register_handler(RESPONSE_TASK, _send_response)
+
     @bot.callback_query_handler(func=lambda c: c.data == "home:anon_chat")
     def open_anonymous_chat(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
@@ -315,8 +350,7 @@ def register(bot) -> None:
             bot.answer_callback_query(cq.id, "⛔️")
             return
 
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
 
         if not _handle_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
@@ -332,8 +366,7 @@ def register(bot) -> None:
     @bot.callback_query_handler(func=lambda c: c.data == "anon_chat:next")
     def handle_next(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
 
         if not _handle_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
@@ -356,8 +389,7 @@ def register(bot) -> None:
     @bot.callback_query_handler(func=lambda c: c.data == "anon_chat:end")
     def handle_end(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
-        db.touch_last_seen(user["user_id"])
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
 
         if not _handle_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
@@ -373,8 +405,7 @@ def register(bot) -> None:
         bot.send_message(cq.message.chat.id, ENDED_TEXT)
 
     def _is_anonymous_chat(message: Message) -> bool:
-        state = db.get_state(message.from_user.id) or ""
-        return state.startswith(f"{ANON_STATE_PREFIX}:")
+        return message_state(message).startswith(f"{ANON_STATE_PREFIX}:")
 
     @bot.message_handler(func=_is_anonymous_chat, content_types=["text"])
     def handle_message(msg: Message) -> None:
@@ -383,12 +414,10 @@ def register(bot) -> None:
             bot.reply_to(msg, "⛔️ دسترسی شما مسدود است.")
             return
 
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _handle_force_sub(bot, user["user_id"], msg.chat.id, msg.message_id, lang):
             return
 
-        db.touch_last_seen(user["user_id"])
-
         session = _load_session(user["user_id"])
         if not session or session.status != "active" or not session.persona:
             bot.reply_to(msg, SEARCHING_TEXT)
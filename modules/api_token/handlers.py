@@ -17,11 +17,10 @@ def register(bot: TeleBot) -> None:
     @bot.callback_query_handler(func=lambda c: c.data == "home:api_token")
     def open_token_menu(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if user.get("banned"):
             bot.answer_callback_query(cq.id, t("error_banned", lang), show_alert=True)
             return
-        db.touch_last_seen(user["user_id"])
         if not ensure_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
             return
@@ -33,11 +32,10 @@ def register(bot: TeleBot) -> None:
     @bot.callback_query_handler(func=lambda c: c.data == "api:rotate")
     def rotate_token(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if user.get("banned"):
             bot.answer_callback_query(cq.id, t("error_banned", lang), show_alert=True)
             return
-        db.touch_last_seen(user["user_id"])
         if not ensure_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
             return
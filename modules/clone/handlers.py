@@ -1,7 +1,15 @@
 # modules/clone/handlers.py
 import db
 from config import DEBUG
-from utils import edit_or_send, ensure_force_sub, feature_disabled_text, is_feature_enabled, send_main_menu
+from utils import (
+    edit_or_send,
+    ensure_force_sub,
+    feature_disabled_text,
+    is_feature_enabled,
+    send_main_menu,
+    state_equals,
+)
+from modules import scheduler
 from modules.i18n import t
 from modules.home.keyboards import _back_to_home_kb
 from .service import clone_voice_with_cleanup
@@ -11,7 +19,7 @@ from .keyboards import payment_keyboard, no_credit_keyboard, menu_keyboard
 
 def open_clone(bot, cq):
     user = db.get_or_create_user(cq.from_user)
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     if not is_feature_enabled("FEATURE_CLONE"):
         edit_or_send(
             bot,
@@ -42,7 +50,7 @@ def register(bot):
     def _open_clone_cb(cq):
         try:
             user = db.get_or_create_user(cq.from_user)
-            lang = db.get_user_lang(user["user_id"], "fa")
+            lang = user.get("lang") or "fa"
             if not ensure_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
                 bot.answer_callback_query(cq.id)
                 return
@@ -56,7 +64,7 @@ def register(bot):
         try:
             user = db.get_or_create_user(cq.from_user)
             user_id = user["user_id"]
-            lang = db.get_user_lang(user_id, "fa")
+            lang = user.get("lang") or "fa"
             if not ensure_force_sub(bot, user_id, cq.message.chat.id, cq.message.message_id, lang):
                 bot.answer_callback_query(cq.id)
                 return
@@ -94,7 +102,7 @@ def register(bot):
             bot.answer_callback_query(cq.id, t("clone_system_error", lang), show_alert=True)
 
     # قبول voice + audio + document(اگر audio/* باشد)
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_WAIT_VOICE,
+    @bot.message_handler(func=state_equals(STATE_WAIT_VOICE),
                          content_types=["voice","audio","document"])
     def _on_voice(msg):
         try:
@@ -144,7 +152,7 @@ def register(bot):
 
             # نمایش صفحه تایید پرداخت
             user = db.get_or_create_user(msg.from_user)
-            lang = db.get_user_lang(user["user_id"], "fa")
+            lang = user.get("lang") or "fa"
 
             db.set_state(msg.from_user.id, STATE_WAIT_PAYMENT)
             bot.send_message(
@@ -161,7 +169,7 @@ def register(bot):
 
 
     # دریافت نام برای صدای ساخته شده
-    @bot.message_handler(func=lambda m: db.get_state(m.from_user.id) == STATE_WAIT_NAME,
+    @bot.message_handler(func=state_equals(STATE_WAIT_NAME),
                          content_types=["text"])
     def _on_name(msg):
         try:
@@ -199,7 +207,7 @@ def register(bot):
             voice_id = clone_voice_with_cleanup(audio_bytes, voice_name, filename, mime)
             
             # فقط در صورت موفقیت، کردیت کم کن
-            if not db.deduct_credits(user_id, VOICE_CLONE_COST):
+            if not db.deduct_credits(user_id, VOICE_CLONE_COST, reason="voice_clone"):
                 # اگر کردیت کم نشد، خطا بده و صدا رو پاک کن
                 try:
                     from .service import delete_voice
@@ -224,7 +232,7 @@ def register(bot):
             from modules.home.keyboards import main_menu
             
             user = db.get_or_create_user(msg.from_user)
-            lang = db.get_user_lang(user["user_id"], "fa")
+            lang = user.get("lang") or "fa"
 
             try:
                 # ارسال پیام موفقیت
@@ -257,15 +265,7 @@ def register(bot):
                 send_main_menu(bot, user["user_id"], msg.chat.id, MAIN(lang), main_menu(lang))
                 
                 # پاک کردن پیام موفقیت بعد از ۵ دقیقه (۳۰۰ ثانیه)
-                import threading
-                def delete_success_message():
-                    try:
-                        bot.delete_message(msg.chat.id, success_msg.message_id)
-                    except:
-                        pass
-                
-                timer = threading.Timer(300.0, delete_success_message)  # ۵ دقیقه = ۳۰۰ ثانیه
-                timer.start()
+                scheduler.schedule_delete_message(msg.chat.id, success_msg.message_id, 300.0)
                 
             except Exception as e:
                 if DEBUG: print(f"Menu refresh error: {e}")
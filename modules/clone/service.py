@@ -6,6 +6,7 @@ from pathlib import Path
 import requests
 
 import db
+from modules import http_client
 
 PASS_THROUGH_MIME_TYPES = {
     "audio/mpeg",
@@ -111,7 +112,7 @@ def clone_voice(audio_bytes: bytes, name: str, filename: str = "audio.wav", mime
     }
     
     try:
-        r = requests.post(url, headers=headers, files=files, data=data, timeout=120)
+        r = http_client.request("elevenlabs", "POST", url, headers=headers, files=files, data=data)
         
         # Get detailed error info if request fails
         if r.status_code != 200:
@@ -148,7 +149,7 @@ def list_voices():
     headers = {"xi-api-key": ELEVEN_API_KEY}
     
     try:
-        r = requests.get(url, headers=headers, timeout=30)
+        r = http_client.request("elevenlabs", "GET", url, headers=headers, timeout=30)
         r.raise_for_status()
         return r.json().get("voices", [])
     except requests.exceptions.RequestException as e:
@@ -163,7 +164,7 @@ def delete_voice(voice_id: str):
     headers = {"xi-api-key": ELEVEN_API_KEY}
     
     try:
-        r = requests.delete(url, headers=headers, timeout=30)
+        r = http_client.request("elevenlabs", "DELETE", url, headers=headers, timeout=30)
         r.raise_for_status()
         return True
     except requests.exceptions.RequestException as e:
@@ -92,7 +92,7 @@ def open_credit(bot: TeleBot, cq):
         db.clear_state(cq.from_user.id)
     
     user = db.get_or_create_user(cq.from_user)
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     if not _ensure_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
         return
     text = f"🛒 <b>{t('credit_title', lang)}</b>\n\n{t('credit_header', lang)}"
@@ -146,7 +146,7 @@ def register(bot: TeleBot):
         import db
 
         user = db.get_or_create_user(c.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], c.message.chat.id, c.message.message_id, lang):
             bot.answer_callback_query(c.id)
             return
@@ -166,7 +166,7 @@ def register(bot: TeleBot):
         import db
 
         user = db.get_or_create_user(c.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], c.message.chat.id, c.message.message_id, lang):
             bot.answer_callback_query(c.id)
             return
@@ -253,7 +253,12 @@ def register(bot: TeleBot):
 
             # اضافه کردن کردیت به حساب کاربر
             db.get_or_create_user(message.from_user)
-            db.add_credits(user_id, credits)
+            db.add_credits(
+                user_id,
+                credits,
+                reason="stars_purchase",
+                ref=message.successful_payment.telegram_payment_charge_id,
+            )
 
             # ذخیره تراکنش
             db.log_purchase(user_id, stars, credits, message.successful_payment.telegram_payment_charge_id)
@@ -283,7 +288,7 @@ def register(bot: TeleBot):
         import db
 
         user = db.get_or_create_user(c.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], c.message.chat.id, c.message.message_id, lang):
             bot.answer_callback_query(c.id)
             return
@@ -309,7 +314,7 @@ def register(bot: TeleBot):
         import db
 
         user = db.get_or_create_user(c.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], c.message.chat.id, c.message.message_id, lang):
             bot.answer_callback_query(c.id)
             return
@@ -348,7 +353,7 @@ def register(bot: TeleBot):
         import db
 
         user = db.get_or_create_user(c.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], c.message.chat.id, c.message.message_id, lang):
             bot.answer_callback_query(c.id)
             return
@@ -373,7 +378,7 @@ def register(bot: TeleBot):
         from modules.home.keyboards import main_menu
         import db
         user = db.get_or_create_user(c.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], c.message.chat.id, c.message.message_id, lang):
             return
         send_main_menu(
@@ -392,7 +397,7 @@ def register(bot: TeleBot):
             return  # دخالت نکن؛ این عکس ربطی به پرداخت ندارد
         import db
         user = db.get_or_create_user(msg.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         if not _ensure_force_sub(bot, user["user_id"], msg.chat.id, msg.message_id, lang):
             return
 
@@ -435,7 +440,7 @@ def register(bot: TeleBot):
         from modules.home.keyboards import main_menu
         import db
         user = db.get_or_create_user(msg.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         
         # 1. پاک کردن پیام قبلی (شماره کارت)
         if payment_msg_id:
@@ -469,7 +474,7 @@ def register(bot: TeleBot):
             if action == "approve":
                 # اضافه کردن کردیت به کاربر
                 import db
-                db.add_credits(user_id, plan['credits'])
+                db.add_credits(user_id, plan['credits'], reason="manual_purchase")
                 
                 # ثبت تراکنش در دیتابیس
                 try:
@@ -0,0 +1,216 @@
+"""Background delivery of long-running Runway generations.
+
+Handlers submit a task to Runway, record it with :func:`submit` and return
+right away instead of holding a worker thread for the whole generation.  A
+single dispatcher thread re-reads the pending jobs from ``generation_jobs``
+on every tick, polls each one on a shared service instance and hands the
+result to the callbacks the owning module registered with
+:func:`register_kind`.  Because the queue lives in SQLite, jobs that were in
+flight when the bot restarted are picked up again on the next start.
+
+The job's credits are held before the provider is called (``hold_id``).
+``deliver`` settles them with :func:`capture`; a hold that was not captured
+by the time the job finishes, fails or times out is refunded.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+from telebot import TeleBot
+
+import db
+
+logger = logging.getLogger(__name__)
+
+TICK_SECONDS = float(os.getenv("GENERATION_JOBS_TICK", "1.0") or 1.0)
+WORKERS = max(1, int(os.getenv("GENERATION_JOBS_WORKERS", "4") or 4))
+
+
+class JobKind(NamedTuple):
+    poll: Callable[[str], Optional[Dict[str, Any]]]
+    deliver: Callable[[TeleBot, dict, Dict[str, Any]], None]
+    fail: Callable[[TeleBot, dict, str], None]
+    poll_interval: float
+    timeout_message: str
+
+
+_kinds: dict[str, JobKind] = {}
+_lock = threading.Lock()
+_in_flight: set[int] = set()
+_next_poll: dict[int, float] = {}
+_started = False
+
+
+def register_kind(
+    kind: str,
+    *,
+    poll: Callable[[str], Optional[Dict[str, Any]]],
+    deliver: Callable[[TeleBot, dict, Dict[str, Any]], None],
+    fail: Callable[[TeleBot, dict, str], None],
+    poll_interval: float,
+    timeout_message: str,
+) -> None:
+    """Register callbacks for one job kind.
+
+    ``poll(task_id)`` returns the result dict once the task is done, ``None``
+    while it is still running and raises when the provider reports a failure.
+    """
+
+    _kinds[kind] = JobKind(poll, deliver, fail, float(poll_interval), timeout_message)
+
+
+def submit(
+    kind: str,
+    *,
+    user_id: int,
+    chat_id: int,
+    task_id: str,
+    lang: str,
+    prompt: str = "",
+    cost: int = 0,
+    reply_to_message_id: int = 0,
+    status_message_id: int = 0,
+    timeout: float = 0,
+    hold_id: int = 0,
+    webhook_url: str = "",
+) -> int:
+    job_id = db.create_generation_job(
+        user_id,
+        chat_id,
+        kind,
+        task_id,
+        prompt=prompt,
+        lang=lang,
+        reply_to_message_id=reply_to_message_id,
+        status_message_id=status_message_id,
+        cost=cost,
+        timeout=timeout,
+        hold_id=hold_id,
+        webhook_url=webhook_url,
+    )
+    kind_info = _kinds.get(kind)
+    if kind_info is not None:
+        with _lock:
+            _next_poll[job_id] = time.time() + kind_info.poll_interval
+    return job_id
+
+
+def hold_ttl(timeout: float) -> int:
+    """Lifetime of a job's credit hold: the job timeout plus a grace period."""
+
+    return int(timeout or 0) + db.CREDIT_HOLD_TTL
+
+
+def capture(job: dict) -> bool:
+    """Charge the job's credits once it has been delivered."""
+
+    if job.get("hold_id") and db.capture_hold(job["hold_id"]):
+        return True
+    # Jobs queued without a hold, or whose hold already expired.
+    return db.deduct_credits(
+        job["user_id"], job["cost"], reason=job["kind"], ref=f"job:{job['id']}"
+    )
+
+
+def start(bot: Optional[TeleBot]) -> None:
+    """Start the dispatcher thread (idempotent).
+
+    Processes without a bot (the HTTP API) pass ``None``; their kinds get it
+    back as the ``bot`` argument of their callbacks.
+    """
+
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+    executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="generation-job")
+    thread = threading.Thread(
+        target=_run, args=(bot, executor), name="generation-jobs", daemon=True
+    )
+    thread.start()
+
+
+def _run(bot: TeleBot, executor: ThreadPoolExecutor) -> None:
+    while True:
+        try:
+            _tick(bot, executor)
+        except Exception:
+            logger.exception("Generation job dispatcher tick failed")
+        time.sleep(TICK_SECONDS)
+
+
+def _tick(bot: TeleBot, executor: ThreadPoolExecutor) -> None:
+    now = time.time()
+    # Only the kinds registered here: jobs of another process (the bot or the
+    # HTTP API) are neither polled nor allowed to crowd out this one's.
+    kinds = dict(_kinds)
+    jobs = db.list_pending_generation_jobs(list(kinds))
+    pending_ids = {job["id"] for job in jobs}
+    with _lock:
+        for job_id in list(_next_poll):
+            if job_id not in pending_ids and job_id not in _in_flight:
+                _next_poll.pop(job_id, None)
+
+    for job in jobs:
+        kind = kinds[job["kind"]]
+        job_id = job["id"]
+        with _lock:
+            if job_id in _in_flight or now < _next_poll.get(job_id, 0):
+                continue
+            _in_flight.add(job_id)
+        executor.submit(_process, bot, kind, job)
+
+
+def _process(bot: TeleBot, kind: JobKind, job: dict) -> None:
+    job_id = job["id"]
+    try:
+        deadline = int(job.get("deadline_at") or 0)
+        if deadline and time.time() > deadline:
+            _fail(bot, kind, job, kind.timeout_message)
+            return
+
+        try:
+            result = kind.poll(job["task_id"])
+        except Exception as exc:
+            logger.error("Generation job %s failed: %s", job_id, exc)
+            _fail(bot, kind, job, str(exc))
+            return
+
+        if result is None:
+            with _lock:
+                _next_poll[job_id] = time.time() + kind.poll_interval
+            return
+
+        # Claim the job before delivering so a restart never delivers or
+        # charges twice.
+        if not db.finish_generation_job(job_id, "succeeded", result_url=result.get("url") or ""):
+            return
+        try:
+            kind.deliver(bot, job, result)
+        except Exception:
+            logger.exception("Failed to deliver generation job %s", job_id)
+        finally:
+            # No-op when deliver captured the hold.
+            db.release_hold(job.get("hold_id"))
+    except Exception:
+        logger.exception("Generation job %s crashed", job_id)
+    finally:
+        with _lock:
+            _in_flight.discard(job_id)
+
+
+def _fail(bot: TeleBot, kind: JobKind, job: dict, error: str) -> None:
+    if not db.finish_generation_job(job["id"], "failed", error=error):
+        return
+    db.release_hold(job.get("hold_id"))
+    try:
+        kind.fail(bot, job, error)
+    except Exception:
+        logger.exception("Failed to report generation job %s failure", job["id"])
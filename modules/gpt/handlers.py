@@ -7,7 +7,10 @@ from typing import Optional
 import html
 import base64
 import mimetypes
+import time
+from functools import lru_cache
 
+from telebot.apihelper import ApiTelegramException
 from telebot.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -20,26 +23,39 @@ import db
 from config import (
     DEBUG,
     GPT_API_KEY,
-    GPT_HISTORY_LIMIT,
     GPT_SYSTEM_PROMPT,
     GPT_MESSAGE_COST,
     GPT_SEARCH_MESSAGE_COST,
     GPT_RESPONSE_CHAR_LIMIT,
+    GPT_STREAM,
+    GPT_STREAM_EDIT_INTERVAL,
 )
 from modules.i18n import t
-from utils import edit_or_send, ensure_force_sub, feature_disabled_text, is_feature_enabled, send_main_menu
+from utils import (
+    edit_or_send,
+    ensure_force_sub,
+    feature_disabled_text,
+    is_feature_enabled,
+    message_state,
+    send_main_menu,
+)
 from modules.home.keyboards import main_menu
 from modules.home.texts import MAIN
+from . import history as gpt_history
 from .service import (
     GPTServiceError,
     build_default_messages,
     chat_completion,
     extract_message_text,
     resolve_gpt_api_key,
+    stream_chat_completion,
     web_search,
 )
 
 GPT_STATE = "gpt:chat"
+# سقف طول پیام تلگرام؛ ویرایش‌های میانی بیش از این را نشان نمی‌دهند
+_PROGRESS_MAX_CHARS = 4000
+_PROGRESS_CURSOR = " ▌"
 
 PRICE_KEYWORDS = {
     "قیمت",
@@ -147,10 +163,9 @@ def _send_no_credit(bot, chat_id: int, lang: str, balance: float, cost: float) -
 
 
 def _charge_for_message(bot, user_id: int, chat_id: int, lang: str, cost: float) -> bool:
-    if db.deduct_credits(user_id, cost):
+    ok, balance = db.charge_credits(user_id, cost, reason="gpt")
+    if ok:
         return True
-    refreshed = db.get_user(user_id)
-    balance = (refreshed or {}).get("credits", 0)
     _send_no_credit(bot, chat_id, lang, balance, cost)
     return False
 
@@ -275,7 +290,7 @@ def _process_search_query(bot, user_id: int, chat_id: int, lang: str, query: str
         bot.send_message(chat_id, t("gpt_search_no_results", lang), parse_mode="HTML")
 
     search_context = _build_search_context(text, results)
-    messages = build_default_messages(history, text)
+    messages = build_default_messages(history, text, normalised=True)
     messages.insert(-1, {"role": "system", "content": search_context})
 
     db.log_gpt_message(user_id, "user", f"[search] {text}")
@@ -301,25 +316,29 @@ def _handle_force_sub(bot, user_id: int, lang: str, chat_id: int, message_id: in
 
 
 def _load_history(user_id: int) -> list[dict[str, str]]:
-    history = db.get_recent_gpt_messages(user_id, GPT_HISTORY_LIMIT)
-    valid_history: list[dict[str, str]] = []
-    for item in history:
-        role = str(item.get("role", "")).strip()
-        content = str(item.get("content", "")).strip()
-        if role and content:
-            valid_history.append({"role": role, "content": content})
-    return valid_history
+    # خلاصهٔ پیام‌های قدیمی + جدیدترین پیام‌ها تا سقف GPT_HISTORY_TOKENS؛
+    # از کش حافظهٔ db می‌آید و از قبل نرمال شده است؛ فقط خواندنی
+    return gpt_history.build_context(user_id)
 
 
 def _build_search_context(query: str, results: list[dict[str, str]]) -> str:
+    # پرسش‌های تکراری (که نتیجه‌شان هم از کش جستجو می‌آید) متن یکسانی می‌سازند
+    return _search_context(
+        query,
+        tuple((item.get("title") or "", item.get("snippet") or "", item.get("url") or "") for item in results),
+    )
+
+
+@lru_cache(maxsize=512)
+def _search_context(query: str, results: tuple[tuple[str, str, str], ...]) -> str:
     base = [f"Web search results for query: {query}"]
     if not results:
         base.append("No additional sources were found.")
     else:
-        for idx, item in enumerate(results, 1):
-            title = (item.get("title") or "").strip()
-            snippet = (item.get("snippet") or "").strip()
-            url = (item.get("url") or "").strip()
+        for idx, (title, snippet, url) in enumerate(results, 1):
+            title = title.strip()
+            snippet = snippet.strip()
+            url = url.strip()
             summary_parts = []
             if title:
                 summary_parts.append(title)
@@ -333,15 +352,73 @@ def _build_search_context(query: str, results: list[dict[str, str]]) -> str:
     return "\n".join(base)
 
 
+def _progress_text(text: str) -> str:
+    # parse_mode پیش‌فرض ربات HTML است؛ متن نیمه‌کاره باید escape شود وگرنه
+    # هر < یا & (یا تگ بسته‌نشده) ویرایش را با خطای 400 متوقف می‌کند
+    cut = text[:_PROGRESS_MAX_CHARS]
+    escaped = html.escape(cut, quote=False)
+    while len(escaped) > _PROGRESS_MAX_CHARS:
+        cut = cut[: len(cut) * _PROGRESS_MAX_CHARS // len(escaped)]
+        escaped = html.escape(cut, quote=False)
+    return escaped + _PROGRESS_CURSOR
+
+
+def _stream_answer(bot, status_message, messages) -> str:
+    """پاسخ استریم را می‌خواند و هم‌زمان پیام وضعیت را با متن تا این لحظه ویرایش می‌کند.
+
+    حداکثر یک ویرایش در هر GPT_STREAM_EDIT_INTERVAL ثانیه انجام می‌شود و با رد شدن
+    از GPT_RESPONSE_CHAR_LIMIT استریم بسته می‌شود تا توکن اضافه‌ای تولید نشود.
+    """
+    limit = max(0, int(GPT_RESPONSE_CHAR_LIMIT))
+    parts: list[str] = []
+    length = 0
+    shown = ""
+    next_edit = 0.0
+    chunks = stream_chat_completion(messages)
+    try:
+        for delta in chunks:
+            parts.append(delta)
+            length += len(delta)
+            if limit and length > limit:
+                break
+            now = time.monotonic()
+            if now < next_edit:
+                continue
+            text = "".join(parts).strip()
+            if not text or text == shown:
+                continue
+            shown = text
+            next_edit = now + GPT_STREAM_EDIT_INTERVAL
+            try:
+                bot.edit_message_text(
+                    _progress_text(text),
+                    chat_id=status_message.chat.id,
+                    message_id=status_message.message_id,
+                )
+            except ApiTelegramException as exc:
+                # 429: تا زمانی که تلگرام گفته ویرایش نمی‌کنیم
+                parameters = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+                if parameters.get("retry_after"):
+                    next_edit = now + float(parameters["retry_after"])
+            except Exception:
+                pass
+    finally:
+        chunks.close()
+    return "".join(parts)
+
+
 def _handle_chat_completion(bot, user_id: int, chat_id: int, lang: str, messages, thinking):
     try:
-        data = chat_completion(messages)
-        answer = (extract_message_text(data) or "").strip()
+        if GPT_STREAM:
+            answer = _stream_answer(bot, thinking, messages).strip()
+        else:
+            answer = (extract_message_text(chat_completion(messages)) or "").strip()
         if not answer:
             answer = t("gpt_empty", lang)
         answer = _trim_answer(answer)
         db.log_gpt_message(user_id, "assistant", answer)
         _respond(bot, thinking, lang, answer)
+        gpt_history.schedule_summary(user_id)
     except GPTServiceError as exc:
         _respond(bot, thinking, lang, t("gpt_error", lang).format(error=html.escape(str(exc))))
     except Exception as exc:  # pragma: no cover - unexpected failure
@@ -358,8 +435,7 @@ def register(bot):
             bot.reply_to(msg, "⛔️ دسترسی شما مسدود است.")
             return
 
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
         if not is_feature_enabled("FEATURE_GPT"):
             bot.reply_to(msg, feature_disabled_text("FEATURE_GPT", lang))
             return
@@ -371,8 +447,7 @@ def register(bot):
     @bot.message_handler(commands=["endgpt", "stopgpt"])
     def stop_gpt(msg):
         user = db.get_or_create_user(msg.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
         _finish_chat(bot, msg.chat.id, msg.message_id, user["user_id"], lang)
 
     @bot.callback_query_handler(func=lambda c: c.data == "home:gpt_chat")
@@ -382,8 +457,7 @@ def register(bot):
             bot.answer_callback_query(cq.id, "⛔️")
             return
 
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
         if not is_feature_enabled("FEATURE_GPT"):
             edit_or_send(
                 bot,
@@ -404,8 +478,7 @@ def register(bot):
             bot.answer_callback_query(cq.id, show_alert=True, text=t("gpt_not_configured_alert", lang))
 
     def _is_gpt_message(message) -> bool:
-        state = db.get_state(message.from_user.id) or ""
-        return state.startswith("gpt:")
+        return message_state(message).startswith("gpt:")
 
     @bot.message_handler(func=_is_gpt_message, content_types=["text"])
     def handle_chat(msg):
@@ -418,8 +491,7 @@ def register(bot):
         if not text:
             return
 
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
 
         if not _handle_force_sub(bot, user["user_id"], lang, msg.chat.id, msg.message_id):
             return
@@ -442,7 +514,7 @@ def register(bot):
             return
 
         history = _load_history(user["user_id"])
-        messages = build_default_messages(history, text)
+        messages = build_default_messages(history, text, normalised=True)
 
         db.log_gpt_message(user["user_id"], "user", text)
 
@@ -459,8 +531,7 @@ def register(bot):
             bot.reply_to(msg, "⛔️ دسترسی شما مسدود است.")
             return
 
-        lang = db.get_user_lang(user["user_id"], "fa")
-        db.touch_last_seen(user["user_id"])
+        lang = user.get("lang") or "fa"
 
         if not _handle_force_sub(bot, user["user_id"], lang, msg.chat.id, msg.message_id):
             return
@@ -492,7 +563,7 @@ def register(bot):
         instructions = (msg.caption or "").strip() or t("gpt_image_default_prompt", lang)
 
         history = _load_history(user["user_id"])
-        messages = build_default_messages(history, instructions)
+        messages = build_default_messages(history, instructions, normalised=True)
         messages[-1] = {
             "role": "user",
             "content": [
@@ -0,0 +1,210 @@
+# modules/gpt/history.py
+"""Token-budgeted GPT history with a rolling per-user summary.
+
+:func:`build_context` fills ``GPT_HISTORY_TOKENS`` with the newest messages
+first (out of the last ``GPT_HISTORY_LIMIT``).  Older turns are not dropped
+silently: :func:`schedule_summary` folds them, a few at a time and in the
+background, into a short summary stored per user (``gpt_summaries``), which
+is sent as a system message ahead of the kept turns.
+
+The layout is kept cache friendly: the system prompt, then the summary,
+then the turns in order.  A fold leaves only about half of the budget as
+verbatim turns, so the next turns only append to the previous request and
+the upstream prompt cache can reuse its prefix until the next fold.
+
+Tokens are estimated, not counted: about four characters per token for
+ASCII text and two for other scripts (Persian text tokenizes much denser),
+plus a small overhead per message.
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+
+import db
+from config import (
+    DEBUG,
+    GPT_HISTORY_LIMIT,
+    GPT_HISTORY_TOKENS,
+    GPT_SUMMARY,
+    GPT_SUMMARY_MIN_MESSAGES,
+    GPT_SUMMARY_TOKENS,
+)
+from .service import GPTServiceError, chat_completion, extract_message_text
+
+MESSAGE_OVERHEAD_TOKENS = 4
+_ELLIPSIS = " …"
+_ELLIPSIS_TOKENS = 2
+# Upper bound of messages folded into the summary by one request, and of the
+# characters taken from each of them.
+_FOLD_MAX_MESSAGES = 40
+_FOLD_MAX_CHARS = 2000
+_SUMMARY_PREFIX = "Summary of the earlier conversation with this user:\n"
+_SUMMARY_PROMPT = (
+    "You maintain a running summary of a chat between a user and an assistant. "
+    "Merge the new messages into the existing summary. Keep facts about the user, "
+    "their goals, decisions, open questions and anything they asked to remember; "
+    "drop greetings and small talk. Write in the user's language, as compact notes, "
+    "under {words} words. Reply with the updated summary only."
+)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gpt-summary")
+_pending: set = set()
+_pending_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars + 1) // 2
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def pack(history: Sequence[Dict[str, str]], budget: int) -> List[Dict[str, str]]:
+    """The longest suffix of ``history`` that fits ``budget`` tokens.
+
+    If even the newest message is larger than the budget, its beginning is
+    kept, cut to fit.
+    """
+
+    kept: List[Dict[str, str]] = []
+    used = 0
+    for message in reversed(history):
+        cost = message_tokens(message)
+        if used + cost > budget:
+            if not kept:
+                truncated = _truncate(message["content"], budget - MESSAGE_OVERHEAD_TOKENS - _ELLIPSIS_TOKENS)
+                if truncated:
+                    kept.append({"role": message["role"], "content": truncated})
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+def _truncate(text: str, tokens: int) -> str:
+    if tokens <= 0:
+        return ""
+    # Worst case is two characters per token, so this prefix always fits.
+    cut = text[: tokens * 2]
+    while len(cut) < len(text):
+        longer = text[: len(cut) + max(16, (tokens - estimate_tokens(cut)) * 2)]
+        if estimate_tokens(longer) > tokens:
+            break
+        cut = longer
+    return cut.rstrip() + _ELLIPSIS
+
+
+def _window(user_id: int) -> Tuple[List[Dict[str, str]], int, str, int, List[Dict[str, str]]]:
+    """``(kept messages, index of the first kept one, summary, covered,
+    unsummarised messages of the window)``."""
+
+    history, total = db.get_gpt_history_window(user_id, GPT_HISTORY_LIMIT)
+    summary, covered = db.get_gpt_summary(user_id) if GPT_SUMMARY else ("", 0)
+    first = total - len(history)
+    if covered > total:
+        # Left over from a conversation that was cleared since.
+        summary, covered = "", 0
+    if covered > first:
+        # Those messages are already part of the summary.
+        history = history[covered - first:]
+        first = covered
+    budget = GPT_HISTORY_TOKENS
+    if summary:
+        budget -= estimate_tokens(_SUMMARY_PREFIX + summary) + MESSAGE_OVERHEAD_TOKENS
+    kept = pack(history, max(0, budget))
+    return kept, total - len(kept), summary, covered, history
+
+
+def build_context(user_id: int) -> List[Dict[str, str]]:
+    """History to send before the user's new message: summary, then kept turns.
+
+    The items are normalised role/content dicts, ready for
+    ``build_default_messages(..., normalised=True)``.
+    """
+
+    kept, _first, summary, _covered, _history = _window(user_id)
+    if not summary:
+        return kept
+    return [{"role": "system", "content": _SUMMARY_PREFIX + summary}, *kept]
+
+
+def schedule_summary(user_id: int) -> None:
+    """Fold turns that fell out of the budget into the summary, in the background."""
+
+    if not GPT_SUMMARY:
+        return
+    with _pending_lock:
+        if user_id in _pending:
+            return
+        _pending.add(user_id)
+    try:
+        _executor.submit(_run_summary, user_id)
+    except RuntimeError:  # executor shut down
+        with _pending_lock:
+            _pending.discard(user_id)
+
+
+def _run_summary(user_id: int) -> None:
+    try:
+        _update_summary(user_id)
+    except GPTServiceError as exc:
+        if DEBUG:
+            print("GPT summary failed:", exc)
+    except Exception as exc:  # pragma: no cover - unexpected failure
+        if DEBUG:
+            print("GPT summary error:", exc)
+    finally:
+        with _pending_lock:
+            _pending.discard(user_id)
+
+
+def _update_summary(user_id: int) -> None:
+    kept, first, summary, covered, history = _window(user_id)
+    if first - covered < GPT_SUMMARY_MIN_MESSAGES:
+        return
+    # Fold down to half of the budget rather than to what fits right now.
+    total = first + len(kept)
+    keep = min(len(kept), len(pack(history, GPT_HISTORY_TOKENS // 2)))
+    # ``keep`` comes from the window while ``covered`` is a count over the
+    # whole conversation; never pass a non-positive count on.
+    count = min(max(0, total - keep - covered), _FOLD_MAX_MESSAGES)
+    if count <= 0:
+        return
+    dropped = db.get_gpt_messages_range(user_id, covered, count)
+    if not dropped:
+        return
+    updated = _summarise(summary, dropped)
+    if not updated:
+        return
+    # Not stored if the history was cleared (or summarised) meanwhile.
+    db.advance_gpt_summary(user_id, updated, covered, covered + count)
+
+
+def _summarise(summary: str, messages: Sequence[Dict[str, str]]) -> str:
+    lines = []
+    for message in messages:
+        content = message["content"]
+        if len(content) > _FOLD_MAX_CHARS:
+            content = content[:_FOLD_MAX_CHARS] + _ELLIPSIS
+        lines.append(f"{message['role']}: {content}")
+    prompt = (
+        f"Current summary:\n{summary or '(empty)'}\n\n"
+        "New messages:\n" + "\n\n".join(lines)
+    )
+    data = chat_completion(
+        [
+            {"role": "system", "content": _SUMMARY_PROMPT.format(words=GPT_SUMMARY_TOKENS * 2 // 3)},
+            {"role": "user", "content": prompt},
+        ],
+        temperature=0.2,
+        max_tokens=GPT_SUMMARY_TOKENS,
+    )
+    return (extract_message_text(data) or "").strip()
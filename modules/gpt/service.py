@@ -4,7 +4,12 @@
 from __future__ import annotations
 
 import json
-from typing import Any, Dict, Iterable, List, Optional
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 import requests
 
@@ -18,10 +23,15 @@ from config import (
     GPT_MAX_TOKENS,
     GPT_MODEL,
     GPT_MODE,
+    GPT_SEARCH_CACHE_SIZE,
+    GPT_SEARCH_CACHE_TTL,
+    GPT_SEARCH_LIVE_TTL,
+    GPT_STREAM_USAGE,
     GPT_SYSTEM_PROMPT,
     GPT_TEMPERATURE,
     GPT_TOP_P,
 )
+from modules import http_client, singleflight
 
 _ALLOWED_ROLES = {"system", "user", "assistant"}
 _ASSISTANT_MODES = {"assistant"}
@@ -267,10 +277,24 @@ def _normalise_message(message: Dict[str, Any]) -> Dict[str, Any]:
     raise GPTServiceError("Each message requires non-empty content")
 
 
-def build_default_messages(history: Iterable[Dict[str, str]], user_content: Any) -> List[Dict[str, Any]]:
-    """Compose a conversation list starting with the system prompt."""
+def build_default_messages(
+    history: Iterable[Dict[str, str]],
+    user_content: Any,
+    *,
+    normalised: bool = False,
+) -> List[Dict[str, Any]]:
+    """Compose a conversation list starting with the system prompt.
+
+    ``normalised=True`` trusts ``history`` to hold valid role/content dicts
+    already (as returned by ``db.get_recent_gpt_messages``) and skips
+    re-validating them.
+    """
 
     messages: List[Dict[str, Any]] = [{"role": "system", "content": GPT_SYSTEM_PROMPT}]
+    if normalised:
+        messages.extend(history)
+        messages.append({"role": "user", "content": user_content})
+        return messages
     for item in history:
         try:
             messages.append(_normalise_message(item))
@@ -412,17 +436,32 @@ def chat_completion(
     """Send the conversation to the configured GPT provider and return the JSON response."""
 
     payload = _prepare_payload(messages, model=model, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
 
-    try:
-        response = requests.post(
-            GPT_API_URL,
-            headers=_build_headers(),
-            data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
-            timeout=GPT_API_TIMEOUT,
-        )
-    except requests.RequestException as exc:  # pragma: no cover - network failure
-        raise GPTServiceError(f"Network error calling GPT API: {exc}") from exc
+    def send() -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            response = http_client.request(
+                "gpt",
+                "POST",
+                GPT_API_URL,
+                headers=_build_headers(),
+                data=body,
+                timeout=GPT_API_TIMEOUT,
+            )
+        except requests.RequestException as exc:  # pragma: no cover - network failure
+            raise GPTServiceError(f"Network error calling GPT API: {exc}") from exc
+
+        data = _json_response(response)
+        record_usage(data.get("usage") if isinstance(data, dict) else None, started)
+        return data
+
+    # An identical request already in flight (double tap, same first message
+    # from many users) is answered once.
+    return singleflight.do("gpt", singleflight.fingerprint(GPT_API_URL, body), send)
 
+
+def _json_response(response: requests.Response) -> Dict[str, Any]:
     text = response.text
     try:
         data = response.json()
@@ -432,18 +471,195 @@ def chat_completion(
         raise GPTServiceError("Invalid response from GPT API") from exc
 
     if response.status_code >= 400:
-        error_message = None
-        if isinstance(data, dict):
-            error_message = data.get("error") or data.get("message")
-            if isinstance(error_message, dict):
-                error_message = error_message.get("message") or error_message.get("code")
-        if not error_message:
-            error_message = response.reason or "GPT API request failed"
-        raise GPTServiceError(str(error_message))
+        raise GPTServiceError(_error_message(data) or response.reason or "GPT API request failed")
 
     return data
 
 
+def _error_message(data: Any) -> str:
+    error_message = None
+    if isinstance(data, dict):
+        error_message = data.get("error") or data.get("message")
+        if isinstance(error_message, dict):
+            error_message = error_message.get("message") or error_message.get("code")
+    return str(error_message) if error_message else ""
+
+
+def stream_chat_completion(
+    messages: List[Dict[str, Any]],
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    top_p: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+) -> Iterator[str]:
+    """Like :func:`chat_completion`, but yield the answer text piece by piece.
+
+    Works for both the chat-completions and the Responses payloads (SSE with
+    ``stream: true``). Closing the generator closes the HTTP stream, so the
+    provider stops generating. A provider that ignores ``stream`` and returns
+    plain JSON yields its whole answer at once.
+    """
+
+    payload = _prepare_payload(messages, model=model, temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+    payload["stream"] = True
+    if GPT_STREAM_USAGE and not _is_assistant_mode():
+        # Chat completions only report usage in a final chunk when asked to.
+        payload["stream_options"] = {"include_usage": True}
+
+    started = time.perf_counter()
+    try:
+        response = http_client.request(
+            "gpt",
+            "POST",
+            GPT_API_URL,
+            headers=_build_headers(),
+            data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+            # With a stream the read timeout applies between events.
+            timeout=GPT_API_TIMEOUT,
+            stream=True,
+        )
+    except requests.RequestException as exc:  # pragma: no cover - network failure
+        raise GPTServiceError(f"Network error calling GPT API: {exc}") from exc
+
+    with response:
+        content_type = (response.headers.get("Content-Type") or "").lower()
+        if response.status_code >= 400 or "text/event-stream" not in content_type:
+            data = _json_response(response)
+            record_usage(data.get("usage") if isinstance(data, dict) else None, started)
+            text = extract_message_text(data)
+            if text:
+                yield text
+            return
+
+        try:
+            for data in _iter_sse_data(response):
+                if data == "[DONE]":
+                    return
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    continue
+                usage = _stream_usage(event)
+                if usage:
+                    record_usage(usage, started)
+                delta = _stream_delta(event)
+                if delta:
+                    yield delta
+        except requests.RequestException as exc:  # pragma: no cover - network failure
+            raise GPTServiceError(f"Network error reading GPT stream: {exc}") from exc
+
+
+def _iter_sse_data(response: requests.Response) -> Iterator[str]:
+    """The ``data`` field of each server-sent event."""
+
+    lines: List[str] = []
+    for raw in response.iter_lines():
+        line = raw.decode("utf-8", errors="replace") if isinstance(raw, bytes) else raw
+        if not line:
+            if lines:
+                yield "\n".join(lines)
+                lines = []
+            continue
+        if line.startswith("data:"):
+            lines.append(line[5:].lstrip(" "))
+    if lines:
+        yield "\n".join(lines)
+
+
+def _stream_delta(event: Any) -> str:
+    if not isinstance(event, dict):
+        return ""
+
+    event_type = event.get("type") or ""
+    # Responses API events
+    if event_type == "response.output_text.delta":
+        delta = event.get("delta")
+        return delta if isinstance(delta, str) else ""
+    if event_type in {"error", "response.failed"}:
+        error = (event.get("response") or {}).get("error") if event_type == "response.failed" else event
+        raise GPTServiceError(_error_message(error) or "GPT stream failed")
+    if event_type:
+        return ""
+
+    # Chat-completions chunks
+    if event.get("error"):
+        raise GPTServiceError(_error_message(event) or "GPT stream failed")
+    choices = event.get("choices")
+    if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+        delta = choices[0].get("delta") or {}
+        content = delta.get("content") if isinstance(delta, dict) else None
+        return content if isinstance(content, str) else ""
+    return ""
+
+
+def _stream_usage(event: Any) -> Optional[Dict[str, Any]]:
+    if not isinstance(event, dict):
+        return None
+    if event.get("type") == "response.completed":
+        return (event.get("response") or {}).get("usage")
+    return event.get("usage")
+
+
+# Prompt tokens served from the provider's prompt cache, from the ``usage``
+# block of each response (chat completions: ``prompt_tokens_details``,
+# Responses: ``input_tokens_details``). Latency is split by whether any
+# prompt token was cached.
+_usage = {
+    "requests": 0,
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "completion_tokens": 0,
+    "cached_requests": 0,
+    "cached_ms": 0.0,
+    "uncached_ms": 0.0,
+}
+_usage_lock = threading.Lock()
+
+
+def record_usage(usage: Any, started: Optional[float] = None) -> None:
+    if not isinstance(usage, dict):
+        return
+    prompt = usage.get("prompt_tokens", usage.get("input_tokens"))
+    completion = usage.get("completion_tokens", usage.get("output_tokens"))
+    details = usage.get("prompt_tokens_details") or usage.get("input_tokens_details") or {}
+    cached = details.get("cached_tokens") if isinstance(details, dict) else 0
+    try:
+        prompt, completion, cached = int(prompt or 0), int(completion or 0), int(cached or 0)
+    except (TypeError, ValueError):
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000 if started is not None else 0.0
+    with _usage_lock:
+        _usage["requests"] += 1
+        _usage["prompt_tokens"] += prompt
+        _usage["cached_tokens"] += cached
+        _usage["completion_tokens"] += completion
+        if cached:
+            _usage["cached_requests"] += 1
+            _usage["cached_ms"] += elapsed_ms
+        else:
+            _usage["uncached_ms"] += elapsed_ms
+
+
+def usage_stats() -> Dict[str, int]:
+    """Token usage since start: prompt (cached/uncached), completion, avg latency."""
+
+    with _usage_lock:
+        usage = dict(_usage)
+    uncached_requests = usage["requests"] - usage["cached_requests"]
+    return {
+        "requests": usage["requests"],
+        "prompt_tokens": usage["prompt_tokens"],
+        "cached_tokens": usage["cached_tokens"],
+        "uncached_tokens": usage["prompt_tokens"] - usage["cached_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "cached_percent": (
+            int(100 * usage["cached_tokens"] / usage["prompt_tokens"]) if usage["prompt_tokens"] else 0
+        ),
+        "cached_avg_ms": int(usage["cached_ms"] / usage["cached_requests"]) if usage["cached_requests"] else 0,
+        "uncached_avg_ms": int(usage["uncached_ms"] / uncached_requests) if uncached_requests else 0,
+    }
+
+
 def extract_message_text(data: Dict[str, Any]) -> str:
     """Utility helper to get the assistant message content from the API response."""
 
@@ -516,62 +732,105 @@ def extract_message_text(data: Dict[str, Any]) -> str:
     return ""
 
 
-_search_session: Optional[requests.Session] = None
+_SEARCH_URL = "https://api.duckduckgo.com/"
+_SEARCH_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    ),
+    "Accept": "application/json",
+}
 
 
-def _get_search_session() -> requests.Session:
-    """Return a cached requests session that bypasses proxy settings."""
+# Search results are cached in memory by normalised query. Queries about
+# prices, rates or news expire after GPT_SEARCH_LIVE_TTL seconds, everything
+# else after GPT_SEARCH_CACHE_TTL. Identical queries that arrive while one is
+# being fetched wait for it (``singleflight``) instead of calling the provider again.
+# Whole words only: "now" must not match "know", nor "rate" "accurate". Persian
+# hints may carry a suffix (قیمتش، جدیدترین), so they only need to start a word.
+_LIVE_QUERY_HINTS = re.compile(
+    r"\b(?:price|rate|cost|worth|today|now|current|latest|news)s?\b"
+    r"|\bhow much\b"
+    r"|\b(?:قیمت|چنده|چند است|چند شد|نرخ|امروز|الان|جدید|خبر|اخبار)"
+)
+_QUERY_TRANSLATION = str.maketrans({"ي": "ی", "ك": "ک", "‌": " ", "؟": "?"})
+_QUERY_PUNCTUATION = re.compile(r"[\s?!.,،؛:]+")
+
+_search_cache: OrderedDict = OrderedDict()  # key -> (expires_at, results)
+_search_lock = threading.Lock()
+_search_stats = {"hits": 0, "misses": 0}
+# Results kept per query; callers take their max_results from these.
+_SEARCH_CACHE_RESULTS = 10
+
+
+def normalise_search_query(query: str) -> str:
+    text = unicodedata.normalize("NFKC", query or "").translate(_QUERY_TRANSLATION).lower()
+    return _QUERY_PUNCTUATION.sub(" ", text).strip()
 
-    global _search_session
-    if _search_session is None:
-        session = requests.Session()
-        # Using proxies in restricted environments (like some hosting providers)
-        # may cause 403 responses. We explicitly disable proxy usage to ensure
-        # the DuckDuckGo API remains reachable.
-        session.trust_env = False
-        session.headers.update(
-            {
-                "User-Agent": (
-                    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-                    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-                ),
-                "Accept": "application/json",
-            }
-        )
-        _search_session = session
-    return _search_session
+
+def search_ttl(query: str) -> int:
+    """Cache lifetime of ``query``: short for live data (prices, news), long otherwise."""
+
+    key = normalise_search_query(query)
+    return GPT_SEARCH_LIVE_TTL if _LIVE_QUERY_HINTS.search(key) else GPT_SEARCH_CACHE_TTL
 
 
 def web_search(query: str, max_results: int = 3) -> List[Dict[str, str]]:
-    """Perform a lightweight web search using the DuckDuckGo instant answer API."""
+    """Perform a lightweight web search using the DuckDuckGo instant answer API.
+
+    Results are served from the in-memory cache while fresh; concurrent
+    identical queries share one upstream call.
+    """
 
     q = (query or "").strip()
     if not q:
         return []
-
+    limit = max_results if max_results and max_results > 0 else 3
+    key = normalise_search_query(q)
+    ttl = search_ttl(q) if GPT_SEARCH_CACHE_SIZE > 0 else 0
+
+    with _search_lock:
+        cached = _search_cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            _search_cache.move_to_end(key)
+            _search_stats["hits"] += 1
+            return [dict(item) for item in cached[1][:limit]]
+
+    def fetch() -> List[Dict[str, str]]:
+        results = _fetch_search_results(q)
+        with _search_lock:
+            _search_stats["misses"] += 1
+            if ttl > 0:
+                _search_cache[key] = (time.time() + ttl, results)
+                _search_cache.move_to_end(key)
+                while len(_search_cache) > GPT_SEARCH_CACHE_SIZE:
+                    _search_cache.popitem(last=False)
+        return results
+
+    results = singleflight.do("search", key, fetch)
+    return [dict(item) for item in results[:limit]]
+
+
+def search_cache_stats() -> Dict[str, int]:
+    with _search_lock:
+        return {**_search_stats, "size": len(_search_cache)}
+
+
+def _fetch_search_results(q: str) -> List[Dict[str, str]]:
+    params = {"q": q, "format": "json", "no_redirect": "1", "no_html": "1"}
     try:
-        session = _get_search_session()
-        response = session.get(
-            "https://api.duckduckgo.com/",
-            params={"q": q, "format": "json", "no_redirect": "1", "no_html": "1"},
-            timeout=10,
+        # The "search" session ignores environment proxies: some hosting
+        # providers' proxies answer DuckDuckGo with 403.
+        response = http_client.request(
+            "search", "GET", _SEARCH_URL, params=params, headers=_SEARCH_HEADERS
         )
         response.raise_for_status()
     except requests.RequestException:
         # Fall back to the default behaviour (which respects environment proxies)
         # in case the direct connection is blocked but a proxy is required.
         try:
-            response = requests.get(
-                "https://api.duckduckgo.com/",
-                params={"q": q, "format": "json", "no_redirect": "1", "no_html": "1"},
-                timeout=10,
-                headers={
-                    "User-Agent": (
-                        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-                        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-                    ),
-                    "Accept": "application/json",
-                },
+            response = http_client.request(
+                "search_proxy", "GET", _SEARCH_URL, params=params, headers=_SEARCH_HEADERS
             )
             response.raise_for_status()
         except requests.RequestException as exc:  # pragma: no cover - network failure
@@ -613,5 +872,4 @@ def web_search(query: str, max_results: int = 3) -> List[Dict[str, str]]:
     _collect(payload.get("Results") or [])
     _collect(payload.get("RelatedTopics") or [])
 
-    trimmed = results[: max_results if max_results and max_results > 0 else 3]
-    return trimmed
+    return results[:_SEARCH_CACHE_RESULTS]
@@ -1,7 +1,6 @@
 # modules/home/handlers.py
 from __future__ import annotations
 
-import threading
 import time
 
 import db
@@ -16,6 +15,7 @@ from utils import (
     is_sound_enabled,
     send_main_menu,
 )
+from modules import scheduler
 from modules.i18n import t
 from modules.welcome_audio import get_welcome_audio
 from .texts import MAIN, HELP
@@ -28,6 +28,10 @@ DAILY_REWARD_INTERVAL = 24 * 60 * 60
 LOW_CREDIT_DELAY = 15.0
 LOW_CREDIT_THRESHOLD = 15
 
+LOW_CREDIT_TASK = "home:low_credit_warning"
+DAILY_BONUS_READY_TASK = "home:daily_bonus_ready"
+DAILY_BONUS_UNLOCKED_TASK = "home:daily_bonus_unlocked"
+
 
 def _daily_bonus_ready_keyboard(lang: str) -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
@@ -79,9 +83,12 @@ def _schedule_low_credit_warning(bot, user, chat_id: int, delay: float) -> None:
         return
     if db.get_low_credit_prompted_at(user_id) > 0:
         return
-    timer = threading.Timer(delay, _send_low_credit_warning, args=(bot, user_id, chat_id))
-    timer.daemon = True
-    timer.start()
+    scheduler.schedule(
+        LOW_CREDIT_TASK,
+        delay,
+        {"user_id": user_id, "chat_id": chat_id},
+        key=f"{LOW_CREDIT_TASK}:{user_id}",
+    )
 
 
 def _handle_feature_disabled(bot, cq: CallbackQuery, lang: str, feature_key: str) -> None:
@@ -112,9 +119,12 @@ def _send_daily_bonus_unlocked(bot, user_id: int, chat_id: int) -> None:
 
 
 def _schedule_daily_bonus_unlocked(bot, user_id: int, chat_id: int, delay: float) -> None:
-    timer = threading.Timer(delay, _send_daily_bonus_unlocked, args=(bot, user_id, chat_id))
-    timer.daemon = True
-    timer.start()
+    scheduler.schedule(
+        DAILY_BONUS_UNLOCKED_TASK,
+        delay,
+        {"user_id": user_id, "chat_id": chat_id},
+        key=f"{DAILY_BONUS_UNLOCKED_TASK}:{user_id}",
+    )
 
 
 def _seconds_until_daily_reward(user_id: int, now: int | None = None) -> int:
@@ -219,9 +229,12 @@ def _trigger_onboarding(bot, user, chat_id: int) -> None:
         return
     db.set_welcome_sent_at(user_id, int(time.time()))
     db.set_onboarding_pending(user_id, False)
-    timer = threading.Timer(ONBOARDING_DAILY_BONUS_DELAY, _send_daily_bonus_ready, args=(bot, user_id, chat_id))
-    timer.daemon = True
-    timer.start()
+    scheduler.schedule(
+        DAILY_BONUS_READY_TASK,
+        ONBOARDING_DAILY_BONUS_DELAY,
+        {"user_id": user_id, "chat_id": chat_id},
+        key=f"{DAILY_BONUS_READY_TASK}:{user_id}",
+    )
 
 
 def _maybe_send_welcome_audio(bot, user, chat_id: int, lang: str) -> None:
@@ -270,7 +283,7 @@ def _apply_referral(bot, user, ref_code: str, chat_id: int, user_lang: str) -> N
 
     bonus = int(db.get_setting("BONUS_REFERRAL", "30") or 30)
     try:
-        db.add_credits(ref_user["user_id"], bonus)
+        db.add_credits(ref_user["user_id"], bonus, reason="referral", ref=str(user["user_id"]))
     except Exception:
         pass
 
@@ -311,10 +324,13 @@ def _ensure_force_sub(bot, user_id: int, chat_id: int, message_id: int | None, l
 
 
 def register(bot):
+    scheduler.register_handler(LOW_CREDIT_TASK, _send_low_credit_warning)
+    scheduler.register_handler(DAILY_BONUS_READY_TASK, _send_daily_bonus_ready)
+    scheduler.register_handler(DAILY_BONUS_UNLOCKED_TASK, _send_daily_bonus_unlocked)
+
     @bot.message_handler(commands=["start"])
     def start(msg: Message):
         user = db.get_or_create_user(msg.from_user)
-        db.touch_last_seen(user["user_id"])
         stored_lang = (user.get("lang") or "").strip()
         lang = stored_lang or "fa"
 
@@ -431,7 +447,6 @@ def register(bot):
     )
     def home_router(cq: CallbackQuery):
         user = db.get_or_create_user(cq.from_user)
-        db.touch_last_seen(user["user_id"])
         stored_lang = (user.get("lang") or "").strip()
         lang = stored_lang or "fa"
 
@@ -549,8 +564,7 @@ def register(bot):
     @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("fs:"))
     def force_sub_handler(cq: CallbackQuery):
         user = db.get_or_create_user(cq.from_user)
-        db.touch_last_seen(user["user_id"])
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
 
         if cq.data == "fs:recheck":
             settings = db.get_settings()
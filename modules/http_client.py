@@ -0,0 +1,157 @@
+"""Pooled HTTP sessions shared by every upstream provider.
+
+Each provider (``gpt``, ``elevenlabs``, ``runway`` …) gets one
+``requests.Session`` for the whole process, so its connections (and TLS
+sessions) are kept alive and reused across calls and threads instead of a
+new handshake per request.  The adapters are sized for the bot's worker
+pools and retry with jittered exponential backoff:
+
+* connection errors and ``429`` for any method — the provider never
+  processed the request, so retrying a paid ``POST`` cannot bill twice;
+* ``5xx`` only for idempotent methods (``GET``, ``DELETE`` …).
+
+Webhooks are not retried here; their sender has its own attempt loop.
+
+:func:`request` applies the provider's default timeout and records per
+provider counters that :func:`stats` reports (shown in the admin stats).
+"""
+
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_SIZE = max(1, int(os.getenv("HTTP_POOL_SIZE", "32") or 32))
+RETRIES = max(0, int(os.getenv("HTTP_RETRIES", "2") or 2))
+BACKOFF = max(0.0, float(os.getenv("HTTP_RETRY_BACKOFF", "0.5") or 0.5))
+
+# Default timeout per provider: (connect, read) seconds. Callers can still
+# pass their own ``timeout``; ``HTTP_TIMEOUT_<PROVIDER>`` overrides the read part.
+_DEFAULT_TIMEOUTS = {
+    "gpt": 45,
+    "elevenlabs": 120,
+    "openai_tts": 120,
+    "runway": 30,
+    "search": 10,
+    "search_proxy": 10,
+    "webhook": 10,
+    "media": 30,
+}
+_CONNECT_TIMEOUT = 10
+# Providers whose session ignores proxy settings from the environment
+# (some hosts' proxies answer DuckDuckGo with 403).
+_DIRECT_PROVIDERS = {"search"}
+# Providers whose callers retry on their own.
+_NO_RETRY_PROVIDERS = {"webhook"}
+
+_sessions: Dict[str, requests.Session] = {}
+_stats: Dict[str, Dict[str, float]] = {}
+_lock = threading.Lock()
+
+
+class _Retry(Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, self.backoff_factor) if backoff else 0
+
+
+def _adapter(retries: int) -> HTTPAdapter:
+    retry = _Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        respect_retry_after_header=True,
+        # Hand the last 429/5xx response back to the caller, which already
+        # knows how to report provider errors.
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+
+def session(provider: str) -> requests.Session:
+    """The shared session of ``provider``; created on first use."""
+
+    with _lock:
+        current = _sessions.get(provider)
+        if current is None:
+            current = requests.Session()
+            current.trust_env = provider not in _DIRECT_PROVIDERS
+            adapter = _adapter(0 if provider in _NO_RETRY_PROVIDERS else RETRIES)
+            current.mount("https://", adapter)
+            current.mount("http://", adapter)
+            _sessions[provider] = current
+        return current
+
+
+def timeout(provider: str):
+    read = _DEFAULT_TIMEOUTS.get(provider, 30)
+    override = os.getenv(f"HTTP_TIMEOUT_{provider.upper()}")
+    if override:
+        try:
+            read = float(override)
+        except ValueError:
+            pass
+    return (_CONNECT_TIMEOUT, read)
+
+
+def request(provider: str, method: str, url: str, **kwargs: Any) -> requests.Response:
+    """``session(provider).request(...)`` with the provider timeout and metrics."""
+
+    if kwargs.get("timeout") is None:
+        kwargs["timeout"] = timeout(provider)
+    started = time.perf_counter()
+    try:
+        response = session(provider).request(method, url, **kwargs)
+    except requests.RequestException:
+        _record(provider, started, None, 0)
+        raise
+    retries = getattr(getattr(response.raw, "retries", None), "history", ()) or ()
+    _record(provider, started, response.status_code, len(retries))
+    return response
+
+
+def _record(provider: str, started: float, status_code, retries: int) -> None:
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    with _lock:
+        entry = _stats.setdefault(
+            provider,
+            {"requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0},
+        )
+        entry["requests"] += 1
+        entry["retries"] += retries
+        if status_code is None or status_code >= 400:
+            entry["errors"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Counters per provider since start: requests, errors, retries, avg/max latency."""
+
+    with _lock:
+        return {
+            provider: {
+                "requests": int(entry["requests"]),
+                "errors": int(entry["errors"]),
+                "retries": int(entry["retries"]),
+                "avg_ms": int(entry["total_ms"] / entry["requests"]) if entry["requests"] else 0,
+                "max_ms": int(entry["max_ms"]),
+            }
+            for provider, entry in sorted(_stats.items())
+        }
@@ -7,16 +7,25 @@ from __future__ import annotations
 import html
 import logging
 import mimetypes
+import threading
 from typing import Any, NamedTuple
 
 import db
 from telebot import TeleBot
 from telebot.types import CallbackQuery, Message
 
+from modules import generation_jobs, media_cache
 from modules.home.keyboards import main_menu
 from modules.home.texts import MAIN
 from modules.i18n import t
-from utils import edit_or_send, ensure_force_sub, feature_disabled_text, is_feature_enabled, send_main_menu
+from utils import (
+    edit_or_send,
+    ensure_force_sub,
+    feature_disabled_text,
+    is_feature_enabled,
+    send_main_menu,
+    state_startswith,
+)
 from .keyboards import menu_keyboard, no_credit_keyboard
 from .service import ImageGenerationError, ImageService
 from .settings import (
@@ -40,6 +49,11 @@ from .texts import (
 
 logger = logging.getLogger(__name__)
 
+JOB_KIND = "image"
+
+_service: ImageService | None = None
+_service_lock = threading.Lock()
+
 USAGE = (
     "ساخت تصویر از متن:\n"
     "<b>/img</b> متن تصویر\n"
@@ -62,8 +76,7 @@ def _extract_prompt(message: Message) -> str:
 
 def _get_user_and_lang(from_user):
     user = db.get_or_create_user(from_user)
-    db.touch_last_seen(user["user_id"])
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     return user, lang
 
 
@@ -252,6 +265,76 @@ def _extract_image_url(data: Any, _visited: set[int] | None = None) -> str | Non
     return None
 
 
+def _get_service() -> ImageService:
+    """Return the shared service so submits and polls reuse one session."""
+
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ImageService()
+        return _service
+
+
+def _poll_job(task_id: str) -> dict | None:
+    return _get_service().check_image_status(task_id)
+
+
+def _show_error(bot: TeleBot, chat_id: int, status_message_id: int, lang: str, error: str) -> None:
+    error_message = html.escape(str(error or ""))
+    body = (
+        f"{error_text(lang)}\n<code>{error_message}</code>"
+        if error_message
+        else error_text(lang)
+    )
+    try:
+        bot.edit_message_text(
+            body,
+            chat_id=chat_id,
+            message_id=status_message_id,
+            parse_mode="HTML",
+        )
+    except Exception:
+        bot.send_message(chat_id, body, parse_mode="HTML")
+
+
+def _deliver_job(bot: TeleBot, job: dict, result: dict) -> None:
+    image_url = result.get("url")
+    lang = job["lang"] or "fa"
+    if not image_url:
+        logger.error(f"No image URL in result: {result}")
+        _show_error(bot, job["chat_id"], job["status_message_id"], lang, "خروجی تصویر دریافت نشد.")
+        return
+
+    logger.info(f"Image URL received: {image_url[:100]}")
+
+    media_cache.send(
+        bot,
+        job["chat_id"],
+        "photo",
+        media_cache.url_key(image_url),
+        image_url,
+        caption=result_caption(lang),
+        reply_to_message_id=job["reply_to_message_id"] or None,
+        allow_sending_without_reply=True,
+        parse_mode="HTML",
+    )
+    try:
+        db.log_image_generation(job["user_id"], job["prompt"], image_url)
+    except Exception:
+        logger.exception("Failed to log image generation for user %s", job["user_id"])
+    generation_jobs.capture(job)
+
+    try:
+        bot.delete_message(job["chat_id"], job["status_message_id"])
+    except Exception:
+        pass
+
+
+def _fail_job(bot: TeleBot, job: dict, error: str) -> None:
+    logger.error("Image generation error: %s", error)
+    _show_error(bot, job["chat_id"], job["status_message_id"], job["lang"] or "fa", error)
+
+
 def _process_prompt(
     bot: TeleBot,
     message: Message,
@@ -267,7 +350,7 @@ def _process_prompt(
         return
 
     try:
-        service = ImageService()
+        service = _get_service()
     except ImageGenerationError:
         bot.send_message(message.chat.id, not_configured(lang), parse_mode="HTML")
         _start_prompt_flow(
@@ -275,19 +358,22 @@ def _process_prompt(
         )
         return
 
-    fresh = db.get_user(user["user_id"]) or user
-    credits = db.normalize_credit_amount(fresh.get("credits", 0))
-    if credits < CREDIT_COST:
-        _send_no_credit(bot, message.chat.id, lang, credits)
+    # Reserve the credits before Runway is asked to do any paid work.
+    hold_id, balance = db.hold_credits(
+        user["user_id"], CREDIT_COST, reason=JOB_KIND, ttl=generation_jobs.hold_ttl(POLL_TIMEOUT)
+    )
+    if not hold_id:
+        _send_no_credit(bot, message.chat.id, lang, balance)
         _start_prompt_flow(
             bot, message.chat.id, user["user_id"], lang, show_intro=False
         )
         return
 
-    db.set_state(user["user_id"], STATE_PROCESSING)
-    status = bot.send_message(message.chat.id, processing(lang), parse_mode="HTML")
-
+    job_id = 0
     try:
+        db.set_state(user["user_id"], STATE_PROCESSING)
+        status = bot.send_message(message.chat.id, processing(lang), parse_mode="HTML")
+
         if reference:
             task_id = service.generate_image_from_image(
                 prompt,
@@ -299,66 +385,27 @@ def _process_prompt(
             task_id = service.generate_image(prompt)
             logger.info("Image task created: %s", task_id)
 
-        # Poll for completion and get image URL
-        result = service.get_image_status(
-            task_id,
-            poll_interval=POLL_INTERVAL,
-            timeout=POLL_TIMEOUT,
-        )
-        
-        image_url = result.get("url")
-        if not image_url:
-            logger.error(f"No image URL in result: {result}")
-            raise ImageGenerationError("خروجی تصویر دریافت نشد.")
-        
-        logger.info(f"Image URL received: {image_url[:100]}")
-
-        bot.send_photo(
-            message.chat.id,
-            photo=image_url,
-            caption=result_caption(lang),
+        # The generation dispatcher polls the task and delivers the photo.
+        job_id = generation_jobs.submit(
+            JOB_KIND,
+            user_id=user["user_id"],
+            chat_id=message.chat.id,
+            task_id=task_id,
+            lang=lang,
+            prompt=prompt,
+            cost=CREDIT_COST,
             reply_to_message_id=message.message_id,
-            parse_mode="HTML",
+            status_message_id=status.message_id,
+            timeout=POLL_TIMEOUT,
+            hold_id=hold_id,
         )
-        try:
-            db.log_image_generation(user["user_id"], prompt, image_url)
-        except Exception:
-            logger.exception("Failed to log image generation for user %s", user["user_id"])
-        db.deduct_credits(user["user_id"], CREDIT_COST)
-
-        try:
-            bot.delete_message(status.chat.id, status.message_id)
-        except Exception:
-            pass
 
     except ImageGenerationError as exc:
         logger.error("Image generation error: %s", exc)
-        try:
-            error_message = html.escape(str(exc))
-            body = (
-                f"{error_text(lang)}\n<code>{error_message}</code>"
-                if error_message
-                else error_text(lang)
-            )
-            bot.edit_message_text(
-                body,
-                chat_id=status.chat.id,
-                message_id=status.message_id,
-                parse_mode="HTML",
-            )
-        except Exception:
-            error_message = html.escape(str(exc))
-            body = (
-                f"{error_text(lang)}\n<code>{error_message}</code>"
-                if error_message
-                else error_text(lang)
-            )
-            bot.send_message(
-                message.chat.id,
-                body,
-                parse_mode="HTML",
-            )
+        _show_error(bot, status.chat.id, status.message_id, lang, str(exc))
     finally:
+        if not job_id:
+            db.release_hold(hold_id)
         _start_prompt_flow(
             bot, message.chat.id, user["user_id"], lang, show_intro=False
         )
@@ -418,6 +465,15 @@ def handle_img(bot: TeleBot, message: Message) -> None:
 
 
 def register(bot: TeleBot) -> None:
+    generation_jobs.register_kind(
+        JOB_KIND,
+        poll=_poll_job,
+        deliver=_deliver_job,
+        fail=_fail_job,
+        poll_interval=POLL_INTERVAL,
+        timeout_message="مهلت دریافت تصویر به پایان رسید.",
+    )
+
     @bot.callback_query_handler(func=lambda c: c.data == "image:back")
     def on_back(cq: CallbackQuery):
         user, lang = _get_user_and_lang(cq.from_user)
@@ -440,7 +496,7 @@ def register(bot: TeleBot) -> None:
         handle_img(bot, message)
 
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_WAIT_PROMPT),
+        func=state_startswith(STATE_WAIT_PROMPT),
         content_types=["text", "photo", "document"],
     )
     def on_prompt(message: Message):
@@ -3,7 +3,8 @@
 This module provides a thin wrapper around the Runway asynchronous task API
 and exposes two high level methods that are used by the Telegram handlers:
 ``generate_image`` for submitting a new prompt and ``get_image_status`` for
-polling the task until it is finished.
+polling the task until it is finished.  ``check_image_status`` performs a
+single poll and is used by the background generation dispatcher.
 
 The implementation keeps the configuration inside the code as requested; the
 only external dependency is the ``RUNWAY_API`` environment variable which must
@@ -20,6 +21,8 @@ from typing import Any, Dict, Optional
 
 import requests
 
+from modules import http_client, singleflight
+
 
 logger = logging.getLogger(__name__)
 
@@ -52,21 +55,19 @@ class ImageService:
 
         self._token = token
         self._base_urls = self._initialise_base_urls()
-        self._session = requests.Session()
-        self._session.headers.update(
-            {
-                "Authorization": f"Bearer {self._token}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "User-Agent": "vexa-ai-image-service/1.0",
-                "X-Runway-Version": self._API_VERSION,
-            }
-        )
+        # Sent with every request; connections come from the shared pool.
+        self._headers = {
+            "Authorization": f"Bearer {self._token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "User-Agent": "vexa-ai-image-service/1.0",
+            "X-Runway-Version": self._API_VERSION,
+        }
 
     # ------------------------------------------------------------------
     # Public API
     # ------------------------------------------------------------------
-    def generate_image(self, prompt: str) -> str:
+    def generate_image(self, prompt: str, *, ratio: str | None = None) -> str:
         """Submit a new generation task and return the task identifier."""
 
         cleaned = (prompt or "").strip()
@@ -76,13 +77,12 @@ class ImageService:
         payload: Dict[str, Any] = {
             "promptText": cleaned,
             "model": self._MODEL,
-            "ratio": f"{self._DEFAULT_WIDTH}:{self._DEFAULT_HEIGHT}",
+            "ratio": ratio or f"{self._DEFAULT_WIDTH}:{self._DEFAULT_HEIGHT}",
             "outputFormat": self._DEFAULT_FORMAT,
         }
 
         logger.debug("Submitting generation task to Runway", extra={"payload": payload})
-        response = self._request("POST", "/text_to_image", json=payload)
-        data = self._safe_json(response)
+        data = self._submit("/text_to_image", payload)
 
         task_id = data.get("id") or self._extract_task_id(data)
         if not task_id:
@@ -98,6 +98,7 @@ class ImageService:
         image_bytes: bytes,
         *,
         mime_type: str | None = None,
+        ratio: str | None = None,
     ) -> str:
         """Submit an image-to-image generation task and return the task identifier."""
 
@@ -115,7 +116,7 @@ class ImageService:
         payload: Dict[str, Any] = {
             "promptText": cleaned,
             "model": self._MODEL,
-            "ratio": f"{self._DEFAULT_WIDTH}:{self._DEFAULT_HEIGHT}",
+            "ratio": ratio or f"{self._DEFAULT_WIDTH}:{self._DEFAULT_HEIGHT}",
             "outputFormat": self._DEFAULT_FORMAT,
             "imageUrl": data_url,
         }
@@ -124,8 +125,7 @@ class ImageService:
             "Submitting image-to-image task to Runway",
             extra={"payload_keys": list(payload.keys())},
         )
-        response = self._request("POST", "/image_to_image", json=payload)
-        data = self._safe_json(response)
+        data = self._submit("/image_to_image", payload)
 
         task_id = data.get("id") or self._extract_task_id(data)
         if not task_id:
@@ -135,6 +135,60 @@ class ImageService:
         logger.info("Runway image-to-image task created", extra={"task_id": task_id})
         return str(task_id)
 
+    def _submit(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        # Submissions are never coalesced: every caller holds and is charged
+        # for its own generation, so it must get its own task.
+        return self._safe_json(self._request("POST", path, json=payload))
+
+    def check_image_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch the task once; return the result when done or ``None`` while running."""
+
+        if not task_id:
+            raise ImageGenerationError("شناسهٔ تسک معتبر نیست.")
+
+        # Status polls are read-only; concurrent polls of one task (the bot
+        # and the API dispatcher) share a single request.
+        payload = singleflight.do(
+            "image",
+            singleflight.fingerprint("/tasks", task_id),
+            lambda: self._safe_json(self._request("GET", f"/tasks/{task_id}")),
+        )
+
+        status = str(payload.get("status", "")).upper()
+        logger.debug(f"Task {task_id} status: {status}")
+
+        if status == "SUCCEEDED":
+            image_url = self._extract_image_url_direct(payload)
+
+            if not image_url:
+                output = payload.get("output")
+                image_url = self._extract_image_url_direct(output)
+
+            if not image_url:
+                result = payload.get("result")
+                image_url = self._extract_image_url_direct(result)
+
+            if not image_url:
+                assets = self._fetch_assets(task_id)
+                if assets:
+                    image_url = self._extract_image_url_direct(assets)
+
+            if image_url:
+                logger.info(
+                    "Image URL extracted for task",
+                    extra={"task_id": task_id, "image_url": image_url[:100]},
+                )
+                return {"url": image_url}
+
+            logger.error("No image URL in Runway response", extra={"payload": payload})
+            raise ImageGenerationError("خروجی تصویر در پاسخ موفق پیدا نشد.")
+
+        if status in {"FAILED", "CANCELED"}:
+            error_msg = payload.get("failure_reason", "تولید تصویر ناموفق بود.")
+            raise ImageGenerationError(f"خطا: {error_msg}")
+
+        return None
+
     def get_image_status(
         self,
         task_id: str,
@@ -151,42 +205,9 @@ class ImageService:
         deadline = time.time() + float(timeout or self._GENERATION_TIMEOUT)
 
         while time.time() < deadline:
-            response = self._request("GET", f"/tasks/{task_id}")
-            payload = self._safe_json(response)
-
-            status = str(payload.get("status", "")).upper()
-            logger.debug(f"Task {task_id} status: {status}")
-
-            if status == "SUCCEEDED":
-                image_url = self._extract_image_url_direct(payload)
-
-                if not image_url:
-                    output = payload.get("output")
-                    image_url = self._extract_image_url_direct(output)
-
-                if not image_url:
-                    result = payload.get("result")
-                    image_url = self._extract_image_url_direct(result)
-
-                if not image_url:
-                    assets = self._fetch_assets(task_id)
-                    if assets:
-                        image_url = self._extract_image_url_direct(assets)
-
-                if image_url:
-                    logger.info(
-                        "Image URL extracted for task",
-                        extra={"task_id": task_id, "image_url": image_url[:100]},
-                    )
-                    return {"url": image_url}
-
-                logger.error("No image URL in Runway response", extra={"payload": payload})
-                raise ImageGenerationError("خروجی تصویر در پاسخ موفق پیدا نشد.")
-
-            if status in {"FAILED", "CANCELED"}:
-                error_msg = payload.get("failure_reason", "تولید تصویر ناموفق بود.")
-                raise ImageGenerationError(f"خطا: {error_msg}")
-
+            result = self.check_image_status(task_id)
+            if result is not None:
+                return result
             time.sleep(poll_delay)
 
         raise ImageGenerationError("مهلت دریافت تصویر به پایان رسید.")
@@ -269,10 +290,12 @@ class ImageService:
         for index, base_url in enumerate(list(self._base_urls)):
             url = f"{base_url}{path}"
             try:
-                response = self._session.request(
+                response = http_client.request(
+                    "runway",
                     method,
                     url,
                     json=json,
+                    headers=self._headers,
                     timeout=timeout or self._REQUEST_TIMEOUT,
                 )
             except requests.RequestException as exc:  # pragma: no cover - network failure
@@ -296,8 +319,11 @@ class ImageService:
 
             if index != 0:
                 # Cache the working base URL so subsequent calls use it first.
-                self._base_urls.pop(index)
-                self._base_urls.insert(0, base_url)
+                # Rebind instead of mutating: the instance is shared by the
+                # generation dispatcher's worker threads.
+                self._base_urls = [base_url] + [
+                    url for url in self._base_urls if url != base_url
+                ]
 
             return response
 
@@ -5,3 +5,15 @@ STATE_PROCESSING = "image:processing"
 CREDIT_COST = 4
 POLL_INTERVAL = 3.0
 POLL_TIMEOUT = 300
+
+# Runway ratios accepted by the API's ``size`` presets.
+IMAGE_SIZE_OPTIONS = {
+    "square": "1024:1024",
+    "landscape": "1344:768",
+    "portrait": "768:1344",
+    "classic": "1184:864",
+}
+
+
+def get_ratio_for_size(size: str) -> str | None:
+    return IMAGE_SIZE_OPTIONS.get((size or "").strip().lower())
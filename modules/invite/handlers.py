@@ -1,13 +1,13 @@
 # modules/invite/handlers.py
 from __future__ import annotations
 
-import threading
 import time
 
 from telebot import TeleBot
 from telebot.types import CallbackQuery
 
 import db
+from modules import scheduler
 from modules.i18n import t
 from utils import edit_or_send, ensure_force_sub
 from .texts import INVITE_TEXT
@@ -23,13 +23,12 @@ def register(bot: TeleBot) -> None:
     def handle_daily_reward(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
         user_id = user["user_id"]
-        lang = db.get_user_lang(user_id, "fa")
+        lang = user.get("lang") or "fa"
 
         if user.get("banned"):
             bot.answer_callback_query(cq.id, t("error_banned", lang), show_alert=True)
             return
 
-        db.touch_last_seen(user_id)
         if not ensure_force_sub(bot, user_id, cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
             return
@@ -39,19 +38,18 @@ def register(bot: TeleBot) -> None:
     @bot.callback_query_handler(func=lambda c: c.data == "onboarding:invite")
     def handle_onboarding_invite(cq: CallbackQuery) -> None:
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
 
         if user.get("banned"):
             bot.answer_callback_query(cq.id, t("error_banned", lang), show_alert=True)
             return
 
-        db.touch_last_seen(user["user_id"])
         bot.answer_callback_query(cq.id)
         open_invite(bot, cq)
 
 def open_invite(bot, cq):
     user = db.get_or_create_user(cq.from_user)
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     if not ensure_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
         return
     bonus = int(db.get_setting("BONUS_REFERRAL", "30") or 30)
@@ -71,7 +69,7 @@ def _claim_daily_reward(bot: TeleBot, cq: CallbackQuery, user_id: int, lang: str
     now = int(time.time())
     last_claim = db.get_last_daily_reward(user_id)
     if now - last_claim >= DAILY_REWARD_INTERVAL:
-        db.add_credits(user_id, DAILY_REWARD_AMOUNT)
+        db.add_credits(user_id, DAILY_REWARD_AMOUNT, reason="daily_reward")
         db.set_last_daily_reward(user_id, now)
         amount_text = db.format_credit_amount(DAILY_REWARD_AMOUNT)
         bot.answer_callback_query(
@@ -80,13 +78,7 @@ def _claim_daily_reward(bot: TeleBot, cq: CallbackQuery, user_id: int, lang: str
             show_alert=True,
         )
         if cq.message:
-            timer = threading.Timer(
-                2.0,
-                _delete_message,
-                args=(bot, cq.message.chat.id, cq.message.message_id),
-            )
-            timer.daemon = True
-            timer.start()
+            scheduler.schedule_delete_message(cq.message.chat.id, cq.message.message_id, 2.0)
         return
 
     remaining = max(0, DAILY_REWARD_INTERVAL - (now - last_claim))
@@ -98,13 +90,6 @@ def _claim_daily_reward(bot: TeleBot, cq: CallbackQuery, user_id: int, lang: str
     )
 
 
-def _delete_message(bot: TeleBot, chat_id: int, message_id: int) -> None:
-    try:
-        bot.delete_message(chat_id, message_id)
-    except Exception:
-        pass
-
-
 def _format_remaining_time(seconds: int) -> str:
     seconds = max(0, int(seconds))
     hours, remainder = divmod(seconds, 3600)
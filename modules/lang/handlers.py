@@ -51,7 +51,7 @@ def register(bot):
     @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("lang:"))
     def lang_router(cq):
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         parts = cq.data.split(":")
         action = parts[1]
 
@@ -0,0 +1,96 @@
+"""Reuse Telegram ``file_id`` values for media the bot already sent.
+
+Every upload returns a ``file_id`` that Telegram accepts again without the
+bytes.  :func:`send` stores it in the ``media_cache`` table under a key
+derived from the content hash or provider URL (see :func:`content_key` and
+:func:`url_key`), so the next delivery of the same media is a zero-byte
+send instead of an upload or a fetch from the provider.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+from io import BytesIO
+from typing import BinaryIO, Callable, Optional, Union
+
+from telebot.apihelper import ApiTelegramException
+
+import db
+
+logger = logging.getLogger(__name__)
+
+Source = Union[str, bytes, Callable[[], Union[bytes, BinaryIO]]]
+
+
+def content_key(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def url_key(url: str) -> str:
+    return "url:" + hashlib.sha256((url or "").encode("utf-8")).hexdigest()
+
+
+def file_id_for(key: str, media_type: str) -> Optional[str]:
+    return db.get_media_file_id(key, media_type)
+
+
+def send(bot, chat_id: int, media_type: str, key: str, source: Source, *,
+         filename: str = "", **kwargs):
+    """Send media with ``bot.send_<media_type>``, preferring a cached file id.
+
+    ``source`` is what to upload on a miss: a URL, raw bytes, or a callable
+    returning bytes or a file object (only called when there is no usable
+    file id; a returned file object is closed after the upload).
+    """
+
+    sender = getattr(bot, f"send_{media_type}")
+    file_id = db.get_media_file_id(key, media_type)
+    if file_id:
+        try:
+            return sender(chat_id, file_id, **kwargs)
+        except ApiTelegramException as exc:
+            if exc.error_code != 400:
+                raise
+            # Expired or unknown file id; upload the media again.
+            db.delete_media_file_id(key, media_type)
+
+    opened = callable(source)
+    if opened:
+        source = source()
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+        source.name = filename or media_type
+    try:
+        sent = sender(chat_id, source, **kwargs)
+    finally:
+        if opened and hasattr(source, "close"):
+            source.close()
+    file_id = _sent_file_id(sent, media_type)
+    if file_id:
+        try:
+            db.set_media_file_id(key, media_type, file_id)
+        except Exception:
+            logger.exception("Failed to remember %s file id", media_type)
+    return sent
+
+
+def download(bot, key: str, media_type: str) -> Optional[bytes]:
+    """Fetch cached media back from Telegram; ``None`` if it is not cached."""
+
+    file_id = db.get_media_file_id(key, media_type)
+    if not file_id:
+        return None
+    try:
+        return bot.download_file(bot.get_file(file_id).file_path)
+    except Exception:
+        logger.warning("Failed to download cached %s %s", media_type, key)
+        return None
+
+
+def _sent_file_id(sent, media_type: str) -> Optional[str]:
+    media = getattr(sent, media_type, None)
+    if media_type == "photo" and media:
+        # Largest size; Telegram resizes again on resend.
+        media = media[-1]
+    return getattr(media, "file_id", None)
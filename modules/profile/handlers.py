@@ -7,6 +7,6 @@ def register(bot):
 
 def open_profile(bot, cq):
     user = db.get_or_create_user(cq.from_user)
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     txt = PROFILE_ALERT_TEXT(lang, user["credits"])
     bot.answer_callback_query(cq.id, txt, show_alert=True)
@@ -0,0 +1,204 @@
+"""Persistent scheduler for delayed bot actions.
+
+Modules register a handler per task kind with :func:`register_handler` and
+queue work with :func:`schedule`.  Every task is stored in
+``scheduled_tasks`` and kept in an in-memory heap; one dispatcher thread
+sleeps until the earliest task is due and hands it to a small worker pool.
+Tasks that were pending when the bot stopped are loaded again by
+:func:`start`, and the ones already overdue run right away.
+
+Handlers are called as ``handler(bot, **payload)``, so payload values must
+be JSON serialisable.  Passing ``key`` makes a task unique: scheduling
+again with the same key replaces the pending task and :func:`cancel` drops
+it.
+
+A due task whose kind has no handler yet (its module is not loaded in this
+process) is retried every ``UNHANDLED_RETRY_SECONDS``; once it is overdue by
+``SCHEDULER_UNHANDLED_TTL`` seconds it is deleted, so its row is not
+reloaded on every restart forever.
+"""
+
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+from telebot import TeleBot
+
+import db
+
+logger = logging.getLogger(__name__)
+
+WORKERS = max(1, int(os.getenv("SCHEDULER_WORKERS", "4") or 4))
+HOLD_SWEEP_SECONDS = max(5, int(os.getenv("CREDIT_HOLD_SWEEP_SECONDS", "60") or 60))
+UNHANDLED_TTL = max(0, int(os.getenv("SCHEDULER_UNHANDLED_TTL", "86400") or 0))
+UNHANDLED_RETRY_SECONDS = 30
+
+DELETE_MESSAGE = "delete_message"
+RELEASE_EXPIRED_HOLDS = "release_expired_holds"
+
+
+class _Task(NamedTuple):
+    kind: str
+    payload: Dict[str, Any]
+    key: Optional[str]
+    run_at: float
+
+
+_handlers: dict[str, Callable[..., None]] = {}
+_tasks: dict[int, _Task] = {}
+_keys: dict[str, int] = {}
+_heap: list[tuple[float, int]] = []
+_cond = threading.Condition()
+_bot: TeleBot | None = None
+_executor: ThreadPoolExecutor | None = None
+
+
+def register_handler(kind: str, handler: Callable[..., None]) -> None:
+    _handlers[kind] = handler
+
+
+def schedule(
+    kind: str,
+    delay: float,
+    payload: Optional[Dict[str, Any]] = None,
+    *,
+    key: Optional[str] = None,
+) -> int:
+    """Run ``kind`` after ``delay`` seconds and return the task id."""
+
+    payload = dict(payload or {})
+    run_at = time.time() + max(0.0, float(delay))
+    with _cond:
+        task_id = db.add_scheduled_task(kind, run_at, json.dumps(payload, ensure_ascii=False), key)
+        if key is not None:
+            previous = _keys.pop(key, None)
+            if previous is not None:
+                _tasks.pop(previous, None)
+        _push(task_id, _Task(kind, payload, key, run_at))
+        _cond.notify()
+    return task_id
+
+
+def cancel(key: str) -> bool:
+    """Drop the pending task registered under ``key``."""
+
+    with _cond:
+        task_id = _keys.pop(key, None)
+        if task_id is not None:
+            _tasks.pop(task_id, None)
+        removed = db.delete_scheduled_task_by_key(key)
+    return removed or task_id is not None
+
+
+def schedule_delete_message(chat_id: int, message_id: int, delay: float) -> int:
+    return schedule(DELETE_MESSAGE, delay, {"chat_id": chat_id, "message_id": message_id})
+
+
+def start(bot: TeleBot) -> None:
+    """Load persisted tasks and start the dispatcher thread (idempotent)."""
+
+    global _bot, _executor
+    with _cond:
+        if _bot is not None:
+            return
+        _bot = bot
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="scheduler")
+        for row in db.list_scheduled_tasks():
+            if row["id"] in _tasks:
+                continue
+            try:
+                payload = json.loads(row["payload"] or "{}")
+            except ValueError:
+                logger.warning("Dropping scheduled task %s with invalid payload", row["id"])
+                db.delete_scheduled_task(row["id"])
+                continue
+            _push(row["id"], _Task(row["kind"], payload, row["dedup_key"], float(row["run_at"])))
+        sweep_pending = RELEASE_EXPIRED_HOLDS in _keys
+    if not sweep_pending:
+        schedule(RELEASE_EXPIRED_HOLDS, 0, key=RELEASE_EXPIRED_HOLDS)
+    thread = threading.Thread(target=_run, name="scheduler", daemon=True)
+    thread.start()
+
+
+def _push(task_id: int, task: _Task, at: Optional[float] = None) -> None:
+    _tasks[task_id] = task
+    if task.key is not None:
+        _keys[task.key] = task_id
+    heapq.heappush(_heap, (task.run_at if at is None else at, task_id))
+
+
+def _next_due() -> tuple[int, _Task]:
+    with _cond:
+        while True:
+            now = time.time()
+            if _heap and _heap[0][0] <= now:
+                _, task_id = heapq.heappop(_heap)
+                task = _tasks.pop(task_id, None)
+                if task is None:
+                    # Cancelled or replaced after it was queued.
+                    continue
+                if task.key is not None and _keys.get(task.key) == task_id:
+                    del _keys[task.key]
+                return task_id, task
+            _cond.wait(_heap[0][0] - now if _heap else None)
+
+
+def _run() -> None:
+    while True:
+        task_id, task = _next_due()
+        _executor.submit(_execute, task_id, task)
+
+
+def _execute(task_id: int, task: _Task) -> None:
+    handler = _handlers.get(task.kind)
+    if handler is None:
+        _defer_unhandled(task_id, task)
+        return
+    # Remove before running: a crash mid-handler must not replay the action.
+    if not db.delete_scheduled_task(task_id):
+        return
+    try:
+        handler(_bot, **task.payload)
+    except Exception:
+        logger.exception("Scheduled task %s (%s) failed", task_id, task.kind)
+
+
+def _defer_unhandled(task_id: int, task: _Task) -> None:
+    # Owned by a module that is not loaded (or not registered yet).
+    if time.time() - task.run_at > UNHANDLED_TTL:
+        logger.warning("Dropping scheduled task %s: no handler for kind %s", task_id, task.kind)
+        db.delete_scheduled_task(task_id)
+        return
+    with _cond:
+        if task.key is not None and task.key in _keys:
+            return  # replaced by a newer task meanwhile
+        _push(task_id, task, at=time.time() + UNHANDLED_RETRY_SECONDS)
+        _cond.notify()
+
+
+def _delete_message(bot: TeleBot, chat_id: int, message_id: int) -> None:
+    try:
+        bot.delete_message(chat_id, message_id)
+    except Exception:
+        pass
+
+
+def _release_expired_holds(bot: TeleBot) -> None:
+    # Refund credit holds left open by workers that died mid-generation.
+    try:
+        released = db.release_expired_holds()
+        if released:
+            logger.info("Released %s expired credit holds", released)
+    finally:
+        schedule(RELEASE_EXPIRED_HOLDS, HOLD_SWEEP_SECONDS, key=RELEASE_EXPIRED_HOLDS)
+
+
+register_handler(DELETE_MESSAGE, _delete_message)
+register_handler(RELEASE_EXPIRED_HOLDS, _release_expired_holds)
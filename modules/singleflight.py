@@ -0,0 +1,108 @@
+"""In-process coalescing of identical concurrent upstream calls.
+
+When the same paid request (a TTS line, a chat completion, a web search)
+or the same image status poll is already in flight, :func:`do` makes later
+callers wait for it and share its result — or its exception — instead of
+calling the provider again.  Nothing is cached: once the call returns,
+the next identical request goes upstream as usual.
+
+Requests are identified by :func:`fingerprint`, a SHA-256 of the
+canonical JSON of the parts that decide the response.  Coalescing is
+opt-in per provider with ``SINGLEFLIGHT_PROVIDERS`` (comma separated,
+default ``gpt,search,tts,image``; empty disables it).  Only calls whose
+shared outcome is correct for every caller belong here: image generation
+submits are not coalesced, since each caller is charged for its own task.  :func:`stats`
+reports, per provider, how many calls went upstream and how many were
+coalesced (shown in the admin stats).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+PROVIDERS = frozenset(
+    name.strip()
+    for name in os.getenv("SINGLEFLIGHT_PROVIDERS", "gpt,search,tts,image").split(",")
+    if name.strip()
+)
+
+_calls: Dict[tuple, "_Call"] = {}
+_stats: Dict[str, Dict[str, int]] = {}
+_lock = threading.Lock()
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+def _canonical(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    raise TypeError(f"cannot fingerprint {type(value).__name__}")
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable key for a request made of JSON-like ``parts`` (bytes are hashed)."""
+
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=_canonical)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def do(provider: str, key: str, fn: Callable[[], T]) -> T:
+    """Run ``fn()``, or wait for the identical call already running and share its outcome.
+
+    Waiters receive the very same result object; callers must treat it as
+    read-only.
+    """
+
+    if provider not in PROVIDERS:
+        return fn()
+
+    with _lock:
+        entry = _stats.setdefault(provider, {"calls": 0, "coalesced": 0})
+        call = _calls.get((provider, key))
+        leader = call is None
+        if leader:
+            call = _calls[(provider, key)] = _Call()
+            entry["calls"] += 1
+        else:
+            entry["coalesced"] += 1
+
+    if not leader:
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+    except BaseException as exc:
+        call.error = exc
+        raise
+    finally:
+        with _lock:
+            _calls.pop((provider, key), None)
+        call.done.set()
+    return call.result
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Per provider since start: upstream ``calls``, ``coalesced`` waiters, ``in_flight``."""
+
+    with _lock:
+        in_flight: Dict[str, int] = {}
+        for provider, _key in _calls:
+            in_flight[provider] = in_flight.get(provider, 0) + 1
+        return {
+            provider: {**entry, "in_flight": in_flight.get(provider, 0)}
+            for provider, entry in sorted(_stats.items())
+        }
@@ -27,8 +27,7 @@ logger = logging.getLogger(__name__)
 
 def _get_user_and_lang(from_user):
     user = db.get_or_create_user(from_user)
-    db.touch_last_seen(user["user_id"])
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     return user, lang
 
 
@@ -90,12 +89,11 @@ def _handle_purchase(bot: TeleBot, cq: CallbackQuery) -> None:
         bot.answer_callback_query(cq.id)
         return
 
-    fresh = db.get_user(user["user_id"]) or user
-    credits_value = db.normalize_credit_amount(fresh.get("credits", 0))
     cost_text = db.format_credit_amount(CREDIT_COST)
-    credits_text = db.format_credit_amount(credits_value)
+    charged, balance = db.charge_credits(user["user_id"], CREDIT_COST, reason="sora2")
 
-    if credits_value < CREDIT_COST or not db.deduct_credits(user["user_id"], CREDIT_COST):
+    if not charged:
+        credits_text = db.format_credit_amount(balance)
         edit_or_send(
             bot,
             cq.message.chat.id,
@@ -108,7 +106,7 @@ def _handle_purchase(bot: TeleBot, cq: CallbackQuery) -> None:
 
     queue_index = db.create_sora2_request(user["user_id"])
     position = max(QUEUE_START_POSITION, QUEUE_START_POSITION - 1 + queue_index)
-    updated_user = db.get_user(user["user_id"]) or fresh
+    updated_user = {**user, "credits": balance}
 
     edit_or_send(
         bot,
@@ -0,0 +1,144 @@
+# modules/tts/chunking.py
+"""
+تقسیم متن‌های طولانی TTS به جمله‌ها و ساخت موازی صدا.
+
+متن روی علائم پایان جملهٔ فارسی/عربی/لاتین شکسته می‌شود و جمله‌ها تا سقف
+TTS_CHUNK_CHARS کاراکتر کنار هم قرار می‌گیرند. هر تکه جداگانه (و از طریق کش
+TTS) ساخته می‌شود؛ فقط تکه‌های ناموفق دوباره درخواست می‌شوند و فریم‌های MP3
+بدون انکود مجدد پشت سر هم قرار می‌گیرند.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Sequence, TypeVar
+
+CHUNK_CHARS = max(100, int(os.getenv("TTS_CHUNK_CHARS", "600") or 600))
+WORKERS = max(1, int(os.getenv("TTS_CHUNK_WORKERS", "4") or 4))
+RETRIES = max(0, int(os.getenv("TTS_CHUNK_RETRIES", "2") or 2))
+
+# پایان جمله: . ! ? … و معادل‌های فارسی/عربی (؟ ؛ ۔) یا خط جدید.
+# نقطهٔ بین دو رقم (مثل 3.5) پایان جمله حساب نمی‌شود چون بعدش فاصله نیست.
+_SENTENCE_END = re.compile(r"(?<=[.!?…؟؛۔;])\s+|\n+")
+# اگر یک جمله به‌تنهایی طولانی بود، روی ویرگول‌ها شکسته می‌شود
+_CLAUSE_END = re.compile(r"(?<=[,،:])\s+")
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="tts-chunk")
+
+T = TypeVar("T")
+
+
+def split_text(text: str, max_chars: int = CHUNK_CHARS) -> List[str]:
+    """تکه‌هایی حداکثر max_chars کاراکتری که هر کدام روی مرز جمله تمام می‌شوند."""
+    text = (text or "").strip()
+    if len(text) <= max_chars:
+        return [text] if text else []
+
+    pieces: List[str] = []
+    for sentence in _SENTENCE_END.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in _CLAUSE_END.split(sentence):
+            pieces.extend(_split_words(clause.strip(), max_chars))
+
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split_words(text: str, max_chars: int) -> List[str]:
+    if len(text) <= max_chars:
+        return [text] if text else []
+    parts: List[str] = []
+    current = ""
+    for word in text.split():
+        while len(word) > max_chars:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(word[:max_chars])
+            word = word[max_chars:]
+        if current and len(current) + 1 + len(word) > max_chars:
+            parts.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        parts.append(current)
+    return parts
+
+
+def synthesize_parts(synthesize_one: Callable[[str], T], parts: Sequence[str]) -> List[T]:
+    """
+    همهٔ تکه‌ها را هم‌زمان (با سقف TTS_CHUNK_WORKERS) می‌سازد و به ترتیب برمی‌گرداند.
+    در هر دور فقط تکه‌های ناموفق دوباره ارسال می‌شوند.
+    """
+    results: List[T] = [None] * len(parts)  # type: ignore[list-item]
+    pending = list(range(len(parts)))
+    error: Exception | None = None
+    for _ in range(RETRIES + 1):
+        futures = [(index, _executor.submit(synthesize_one, parts[index])) for index in pending]
+        pending = []
+        for index, future in futures:
+            try:
+                results[index] = future.result()
+            except Exception as exc:
+                error = exc
+                pending.append(index)
+        if not pending:
+            return results
+    raise error
+
+
+# ----------------- MP3 -----------------
+_MPEG1_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+_MPEG2_BITRATES = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def mp3_frames(data: bytes) -> bytes:
+    """
+    فریم‌های صوتی یک فایل MP3 برای چسباندن به تکه‌های دیگر.
+    تگ‌های ID3 و فریم Xing/Info حذف می‌شوند؛ تعداد فریم و بایت این فریم فقط
+    همان تکه را توصیف می‌کند و در فایل چسبانده‌شده مدت و جابه‌جایی را اشتباه نشان می‌دهد.
+    """
+    start, end = 0, len(data)
+    if data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        start = 10 + size + (10 if data[5] & 0x10 else 0)
+    if end - start >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    length = _frame_length(data, start)
+    if length and (b"Xing" in data[start:start + length] or b"Info" in data[start:start + length]):
+        start += length
+    return data[start:end]
+
+
+def _frame_length(data: bytes, offset: int) -> int:
+    if offset + 4 > len(data) or data[offset] != 0xFF or (data[offset + 1] & 0xE0) != 0xE0:
+        return 0
+    version = (data[offset + 1] >> 3) & 0x03
+    layer = (data[offset + 1] >> 1) & 0x03
+    bitrate_index = data[offset + 2] >> 4
+    rate_index = (data[offset + 2] >> 2) & 0x03
+    padding = (data[offset + 2] >> 1) & 0x01
+    if layer != 1 or version == 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return 0  # فقط Layer III با هدر معتبر
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if version == 3:
+        return 144000 * _MPEG1_BITRATES[bitrate_index] // sample_rate + padding
+    return 72000 * _MPEG2_BITRATES[bitrate_index] // sample_rate + padding
@@ -1,6 +1,4 @@
 # modules/tts/handlers.py
-from io import BytesIO
-import threading
 import time
 import db
 from utils import (
@@ -10,8 +8,10 @@ from utils import (
     is_feature_enabled,
     is_sound_enabled,
     send_main_menu,
+    state_startswith,
 )
 from config import DEBUG
+from modules import scheduler, tts_cache
 from modules.i18n import t
 from .texts import TITLE, ask_text, PROCESSING, NO_CREDIT, ERROR, BANNED
 from .keyboards import keyboard as tts_keyboard
@@ -27,7 +27,7 @@ from .settings import (
     get_voices,
     set_output_mode,
 )
-from .service import synthesize
+from .service import synthesize_cached
 
 # ----------------- filters -----------------
 _NORMALIZE_REPLACEMENTS = {
@@ -127,6 +127,7 @@ def safe_del(bot, chat_id, message_id):
         pass
 
 _DEMO_AUTO_DELETE_SECONDS = 50
+_DEMO_DELETE_TASK = "tts:demo_delete"
 
 def _demo_lock_key(user_id: int, voice_name: str) -> str:
     return f"tts_demo_lock:{user_id}:{voice_name}"
@@ -189,22 +190,27 @@ def _send_demo_audio(
         sent = bot.send_audio(chat_id, file_id, caption=caption)
     expires_at = int(time.time()) + _DEMO_AUTO_DELETE_SECONDS
     _set_demo_lock(user_id, voice_name, sent.message_id, expires_at)
-    timer = threading.Timer(
+    scheduler.schedule(
+        _DEMO_DELETE_TASK,
         _DEMO_AUTO_DELETE_SECONDS,
-        _delete_demo_message,
-        args=(bot, chat_id, user_id, voice_name, sent.message_id),
+        {
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "voice_name": voice_name,
+            "message_id": sent.message_id,
+        },
     )
-    timer.daemon = True
-    timer.start()
     return "sent"
 
 # ----------------- public API -----------------
 def register(bot):
+    scheduler.register_handler(_DEMO_DELETE_TASK, _delete_demo_message)
+
     # دکمه‌های داخل منوی TTS
     @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("tts:"))
     def tts_router(cq):
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
         output_mode = get_output_mode(user["user_id"])
         if not is_feature_enabled("FEATURE_TTS"):
             edit_or_send(
@@ -436,7 +442,7 @@ def register(bot):
 
     # دریافت متن برای تبدیل
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_WAIT_TEXT),
+        func=state_startswith(STATE_WAIT_TEXT),
         content_types=["text"]
     )
     def on_text_to_tts(msg):
@@ -454,8 +460,9 @@ def register(bot):
         # تغییر state به processing تا دیگه handler دوباره اجرا نشه
         db.set_state(user_id, f"tts:processing:{int(time.time())}")
         
+        hold_id = None
         try:
-            lang = db.get_user_lang(user_id, "fa")
+            lang = user.get("lang") or "fa"
 
             if not ensure_force_sub(bot, user_id, msg.chat.id, msg.message_id, lang):
                 return
@@ -501,8 +508,10 @@ def register(bot):
             is_custom_voice = db.get_user_voice(user_id, voice_name) is not None
             multiplier = 2 if is_custom_voice else 1
             cost = db.normalize_credit_amount(len(text) * CREDIT_PER_CHAR * multiplier)
-            balance = db.normalize_credit_amount(user.get("credits", 0))
-            if balance < cost:
+
+            # رزرو کردیت قبل از API call؛ بعد از ارسال فایل قطعی می‌شود
+            hold_id, balance = db.hold_credits(user_id, cost, reason="tts")
+            if not hold_id:
                 # state رو پاک نکن تا بتونیم منوی TTS رو بعداً پاک کنیم
                 from .keyboards import no_credit_keyboard
                 bot.send_message(
@@ -512,38 +521,28 @@ def register(bot):
                 )
                 return
 
-            # کسر کردیت قبل از API call
-            if not db.deduct_credits(user_id, cost):
-                refreshed = db.get_user(user_id) or {}
-                from .keyboards import no_credit_keyboard
-                new_balance = db.normalize_credit_amount(refreshed.get("credits", 0))
-                bot.send_message(
-                    msg.chat.id,
-                    NO_CREDIT(lang, new_balance, cost),
-                    reply_markup=no_credit_keyboard(lang),
-                )
-                return
-
             status = bot.send_message(msg.chat.id, PROCESSING(lang))
             
             # 🎯 فقط یکبار API call
             print(f"🔥 TTS REQUEST: user={user_id}, text_len={len(text)}, voice={voice_name}")
-            audio_data = synthesize(text, voice_id, "audio/mpeg")
-            print(f"✅ TTS RESPONSE: user={user_id}, audio_size={len(audio_data)} bytes")
+            audio = synthesize_cached(text, voice_id, "audio/mpeg")
+            print(f"✅ TTS RESPONSE: user={user_id}, cached={audio.hit}")
 
             # پاک‌سازی پیام‌ها
             safe_del(bot, status.chat.id, status.message_id)
             if last_menu_id:
                 safe_del(bot, msg.chat.id, last_menu_id)
 
-            # ارسال فایل (بدون کپشن) با نام Vexa.mp3
-            bio = BytesIO(audio_data)
-            bio.name = "Vexa.mp3"
+            # ارسال فایل (بدون کپشن) با نام Vexa.mp3؛ اگر قبلاً ارسال شده با file_id
             output_mode = get_output_mode(user_id)
-            if output_mode == "voice":
-                bot.send_voice(msg.chat.id, voice=bio)
-            else:
-                bot.send_document(msg.chat.id, document=bio)
+            tts_cache.send(
+                bot,
+                msg.chat.id,
+                audio,
+                "voice" if output_mode == "voice" else "document",
+                filename="Vexa.mp3",
+            )
+            db.capture_hold(hold_id)
 
             # بازگرداندن منوی TTS با صدای فعلی
             new_menu = bot.send_message(
@@ -563,10 +562,10 @@ def register(bot):
             schedule_creator_upsell(bot, user_id, msg.chat.id)
 
         except Exception as e:
-            # برگردان کردیت در صورت خطا
+            # برگردان کردیت در صورت خطا (اگر هنوز قطعی نشده)
             try:
-                db.add_credits(user_id, cost)
-                print(f"❌ TTS ERROR: user={user_id}, credits refunded={cost}")
+                if db.release_hold(hold_id) is not None:
+                    print(f"❌ TTS ERROR: user={user_id}, credits refunded={cost}")
             except:
                 pass
             safe_del(bot, status.chat.id if 'status' in locals() else None, status.message_id if 'status' in locals() else None)
@@ -582,7 +581,7 @@ def register(bot):
 
 def open_tts(bot, cq):
     user = db.get_or_create_user(cq.from_user)
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     if not is_feature_enabled("FEATURE_TTS"):
         edit_or_send(
             bot,
@@ -1,17 +1,23 @@
 # modules/tts/service.py
 import os, json, requests
+from typing import Iterator
+
+from modules import http_client, singleflight, tts_cache
+from . import chunking
 
 ELEVEN_API_KEY = os.getenv("ELEVEN_API_KEY", "")
 MODEL_ID = "eleven_v3"  # مدل ثابت
+# حالت استریم: صدا از اندپوینت /stream تکه‌تکه خوانده و مستقیم روی دیسک نوشته می‌شود
+STREAMING = os.getenv("ELEVEN_TTS_STREAM", "0") == "1"
+STREAM_CHUNK_SIZE = 64 * 1024
 
-def synthesize(text: str, voice_id: str, mime: str = "audio/mpeg") -> bytes:
-    """
-    v3 با کیفیت پایدار (non-stream). فقط text + model_id.
-    """
+def _request(text: str, voice_id: str, mime: str, *, stream: bool) -> requests.Response:
     if not ELEVEN_API_KEY:
         raise RuntimeError("ELEVEN_API_KEY is missing")
 
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"  # ← non-stream
+    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    if stream:
+        url += "/stream"
     headers = {
         "xi-api-key": ELEVEN_API_KEY,
         "accept": mime,
@@ -23,6 +29,87 @@ def synthesize(text: str, voice_id: str, mime: str = "audio/mpeg") -> bytes:
         # عمداً هیچ voice_settings یا پارامتر اضافه‌ای نمی‌فرستیم
     }
 
-    r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=120)
+    # timeout پیش‌فرض elevenlabs در http_client (۱۰، ۱۲۰) است؛ در حالت استریم عدد دوم
+    # فاصلهٔ مجاز بین دو تکه است، نه کل زمان ساخت
+    r = http_client.request(
+        "elevenlabs", "POST", url, headers=headers, data=json.dumps(payload), stream=stream
+    )
     r.raise_for_status()
-    return r.content
+    return r
+
+def synthesize(text: str, voice_id: str, mime: str = "audio/mpeg") -> bytes:
+    """
+    v3 با کیفیت پایدار (non-stream). فقط text + model_id.
+    درخواست یکسانی که هم‌زمان در جریان باشد دوباره فرستاده نمی‌شود.
+    """
+    return singleflight.do(
+        "tts",
+        singleflight.fingerprint("elevenlabs", text, voice_id, MODEL_ID, mime),
+        lambda: _request(text, voice_id, mime, stream=False).content,
+    )
+
+def synthesize_stream(text: str, voice_id: str, mime: str = "audio/mpeg") -> Iterator[bytes]:
+    """
+    نسخهٔ استریم: تکه‌های صدا به محض رسیدن برگردانده می‌شوند و کل فایل در حافظه نمی‌ماند.
+    """
+    with _request(text, voice_id, mime, stream=True) as r:
+        for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if chunk:
+                yield chunk
+
+def _synthesize_part(text: str, voice_id: str, mime: str) -> tts_cache.CachedAudio:
+    return tts_cache.get_or_synthesize(
+        synthesize,
+        text,
+        voice_id,
+        MODEL_ID,
+        mime,
+        stream=synthesize_stream if STREAMING else None,
+    )
+
+def _synthesize_chunked(parts: list, voice_id: str, mime: str):
+    # هر تکه جدا در کش می‌ماند؛ اگر یکی خطا بدهد، دفعهٔ بعد فقط همان ساخته می‌شود
+    audios = chunking.synthesize_parts(lambda part: _synthesize_part(part, voice_id, mime), parts)
+    for audio in audios:
+        with audio.open() as fh:
+            yield chunking.mp3_frames(fh.read())
+
+def _split(text: str, mime: str) -> list:
+    return chunking.split_text(text) if mime == "audio/mpeg" else [text]
+
+def _audio_chunks(text: str, voice_id: str, mime: str, parts: list) -> Iterator[bytes]:
+    if len(parts) > 1:
+        return _synthesize_chunked(parts, voice_id, mime)
+    if STREAMING:
+        return synthesize_stream(text, voice_id, mime)
+    return iter((synthesize(text, voice_id, mime),))
+
+def iter_audio(text: str, voice_id: str, mime: str = "audio/mpeg") -> Iterator[bytes]:
+    """
+    تکه‌های صدا به محض آماده شدن: از کش، یا مستقیم از ElevenLabs (و هم‌زمان ذخیره در کش).
+    """
+    parts = _split(text, mime)
+    return tts_cache.iter_or_synthesize(
+        lambda: _audio_chunks(text, voice_id, mime, parts),
+        text,
+        voice_id,
+        MODEL_ID,
+        mime,
+    )
+
+def synthesize_cached(text: str, voice_id: str, mime: str = "audio/mpeg") -> tts_cache.CachedAudio:
+    """
+    مثل synthesize، ولی اگر همین متن با همین صدا قبلاً ساخته شده باشد از کش خوانده می‌شود.
+    متن‌های طولانی MP3 جمله‌به‌جمله و به‌صورت موازی ساخته می‌شوند.
+    """
+    parts = _split(text, mime)
+    if len(parts) <= 1:
+        return _synthesize_part(text, voice_id, mime)
+    return tts_cache.get_or_synthesize(
+        synthesize,
+        text,
+        voice_id,
+        MODEL_ID,
+        mime,
+        stream=lambda _text, _voice_id, _mime: _synthesize_chunked(parts, voice_id, mime),
+    )
@@ -1,14 +1,15 @@
 from __future__ import annotations
 
-import threading
 import time
 
 import db
 from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
 
+from modules import scheduler
 from modules.i18n import t
 
 CREATOR_UPSELL_DELAY = 20.0
+CREATOR_UPSELL_TASK = "tts:creator_upsell"
 
 
 def _creator_upgrade_keyboard(lang: str) -> InlineKeyboardMarkup:
@@ -40,10 +41,12 @@ def schedule_creator_upsell(bot, user_id: int, chat_id: int) -> None:
         return
     if db.count_tts_requests(user_id) != 1:
         return
-    timer = threading.Timer(
+    scheduler.schedule(
+        CREATOR_UPSELL_TASK,
         CREATOR_UPSELL_DELAY,
-        _send_creator_upsell,
-        args=(bot, user_id, chat_id),
+        {"user_id": user_id, "chat_id": chat_id},
+        key=f"{CREATOR_UPSELL_TASK}:{user_id}",
     )
-    timer.daemon = True
-    timer.start()
+
+
+scheduler.register_handler(CREATOR_UPSELL_TASK, _send_creator_upsell)
@@ -0,0 +1,265 @@
+"""Content-addressed cache for synthesized speech.
+
+Audio is stored under ``DB_DIR/tts_cache`` by the SHA-256 of the normalized
+text, voice, model and mime type, and indexed in the ``tts_cache`` table.
+Once the files grow past ``TTS_CACHE_MAX_MB`` the least recently used ones
+are evicted (never the one just written; audio larger than the whole cache
+is not cached at all).  :func:`send` goes through :mod:`modules.media_cache`, so a
+repeated phrase is neither synthesized nor uploaded again.
+
+With a ``stream`` callable, a miss is written chunk by chunk straight into
+the cache file and sent from disk, so memory use does not grow with the
+length of the text.  The upload in :func:`send` starts only once the last
+chunk is on disk (the Bot API takes the complete file), so it does not
+overlap synthesis.  :func:`iter_or_synthesize` hands the chunks to the
+caller as they arrive while the file is being written.
+
+Identical concurrent misses in :func:`get_or_synthesize` are coalesced
+(:mod:`modules.singleflight`, provider ``tts``): one caller synthesizes and
+writes the file, the others get the same :class:`CachedAudio`.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+import weakref
+from io import BytesIO
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+import db
+from modules import media_cache, singleflight
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = max(0, int(os.getenv("TTS_CACHE_MAX_MB", "512") or 512)) * 1024 * 1024
+CACHE_DIR = os.path.join(db.DB_DIR, "tts_cache")
+
+_EXTENSIONS = {
+    "audio/mpeg": ".mp3",
+    "audio/ogg": ".ogg",
+    "audio/opus": ".opus",
+    "audio/wav": ".wav",
+    "audio/aac": ".aac",
+    "audio/flac": ".flac",
+}
+_WHITESPACE = re.compile(r"\s+")
+_evict_lock = threading.Lock()
+
+
+class CachedAudio:
+    """Synthesized audio; the bytes are read from disk only when needed.
+
+    Audio backed by a cache file keeps that file open (``pinned``), so it can
+    still be read after another thread evicted it.
+    """
+
+    def __init__(self, key: str, mime: str, path: str, *, data: bytes | None = None,
+                 pinned: BinaryIO | None = None, hit: bool = False) -> None:
+        self.key = key
+        self.mime = mime
+        self.path = path
+        self.hit = hit
+        self._data = data
+        self._pinned = pinned
+        self._pinned_lock = threading.Lock()
+        if pinned is not None:
+            weakref.finalize(self, pinned.close)
+
+    def read(self) -> bytes:
+        if self._data is None:
+            if self._pinned is not None:
+                self._data = self._read_pinned()
+            else:
+                with open(self.path, "rb") as fh:
+                    self._data = fh.read()
+        return self._data
+
+    def open(self, filename: str = "") -> BinaryIO:
+        """File object for uploading, named ``filename`` for Telegram."""
+
+        if self._data is None:
+            try:
+                fh = open(self.path, "rb")
+            except FileNotFoundError:
+                if self._pinned is None:
+                    raise
+            else:
+                if filename:
+                    fh.raw.name = filename
+                return fh
+        fh = BytesIO(self.read())
+        fh.name = filename or os.path.basename(self.path)
+        return fh
+
+    def _read_pinned(self) -> bytes:
+        # Waiters of a coalesced miss share this object and its handle.
+        with self._pinned_lock:
+            self._pinned.seek(0)
+            return self._pinned.read()
+
+
+def normalize_text(text: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+def cache_key(text: str, voice_id: str, model: str, mime: str) -> str:
+    raw = "\x1f".join((normalize_text(text), voice_id or "", model or "", mime or ""))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def get_or_synthesize(
+    synthesize: Callable[[str, str, str], bytes],
+    text: str,
+    voice_id: str,
+    model: str,
+    mime: str = "audio/mpeg",
+    *,
+    stream: Optional[Callable[[str, str, str], Iterable[bytes]]] = None,
+) -> CachedAudio:
+    """Return cached audio for this request, synthesizing it on a miss.
+
+    ``stream`` (if given) is used instead of ``synthesize`` for misses.
+    """
+
+    key = cache_key(text, voice_id, model, mime)
+    return singleflight.do(
+        "tts",
+        key,
+        lambda: _get_or_synthesize(key, synthesize, text, voice_id, mime, stream),
+    )
+
+
+def _get_or_synthesize(key, synthesize, text, voice_id, mime, stream) -> CachedAudio:
+    path = os.path.join(CACHE_DIR, key[:2], key + _EXTENSIONS.get(mime, ".bin"))
+    if MAX_BYTES <= 0:
+        if stream is not None:
+            return CachedAudio(key, mime, path, data=b"".join(stream(text, voice_id, mime)))
+        return CachedAudio(key, mime, path, data=synthesize(text, voice_id, mime))
+
+    entry = db.get_tts_cache_entry(key)
+    if entry is not None:
+        try:
+            pinned = open(entry["path"], "rb")
+        except FileNotFoundError:
+            db.delete_tts_cache_entry(key)
+        else:
+            return CachedAudio(key, entry["mime"], entry["path"], pinned=pinned, hit=True)
+
+    if stream is not None:
+        pinned = _store(key, path, mime, stream(text, voice_id, mime), pin=True)
+        return CachedAudio(key, mime, path, pinned=pinned)
+
+    data = synthesize(text, voice_id, mime)
+    if len(data) <= MAX_BYTES:
+        try:
+            _store(key, path, mime, (data,))
+        except OSError:
+            logger.exception("Failed to store TTS audio in the cache")
+    return CachedAudio(key, mime, path, data=data)
+
+
+def iter_or_synthesize(
+    chunks: Callable[[], Iterable[bytes]],
+    text: str,
+    voice_id: str,
+    model: str,
+    mime: str = "audio/mpeg",
+    *,
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """Yield the audio for this request: from the cache file on a hit,
+    otherwise from ``chunks()`` while copying it into the cache."""
+
+    key = cache_key(text, voice_id, model, mime)
+    if MAX_BYTES <= 0:
+        yield from chunks()
+        return
+
+    entry = db.get_tts_cache_entry(key)
+    if entry is not None:
+        try:
+            fh = open(entry["path"], "rb")
+        except FileNotFoundError:
+            db.delete_tts_cache_entry(key)
+        else:
+            with fh:
+                while True:
+                    block = fh.read(chunk_size)
+                    if not block:
+                        return
+                    yield block
+
+    path = os.path.join(CACHE_DIR, key[:2], key + _EXTENSIONS.get(mime, ".bin"))
+    yield from _tee(key, path, mime, chunks())
+
+
+def send(bot, chat_id: int, audio: CachedAudio, kind: str = "document", *,
+         filename: str = "Vexa.mp3", **kwargs):
+    """Send ``audio`` as a voice note or document, reusing its file id if known."""
+
+    return media_cache.send(
+        bot,
+        chat_id,
+        "voice" if kind == "voice" else "document",
+        f"tts:{audio.key}",
+        lambda: audio.open(filename),
+        **kwargs,
+    )
+
+
+def _store(key: str, path: str, mime: str, chunks: Iterable[bytes], *,
+           pin: bool = False) -> Optional[BinaryIO]:
+    """Write ``chunks`` into the cache; with ``pin`` return the file, opened."""
+
+    pins: list = []
+    for _ in _tee(key, path, mime, chunks, pins if pin else None):
+        pass
+    return pins[0] if pins else None
+
+
+def _tee(key: str, path: str, mime: str, chunks: Iterable[bytes],
+         pins: Optional[list] = None) -> Iterator[bytes]:
+    # The file only enters the cache once every chunk was written; an error
+    # or an abandoned iteration leaves nothing behind.  ``pins`` receives the
+    # written file opened before it can be evicted.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+                size += len(chunk)
+                yield chunk
+        if size > MAX_BYTES:
+            # Larger than the whole cache: only the caller gets it.
+            if pins is not None:
+                pins.append(open(tmp_path, "rb"))
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        if pins is not None:
+            pins.append(open(path, "rb"))
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    db.put_tts_cache_entry(key, path, mime, size)
+    _evict(keep=key)
+
+
+def _evict(keep: str = "") -> None:
+    with _evict_lock:
+        for path in db.evict_tts_cache(MAX_BYTES, keep):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -2,12 +2,12 @@
 
 from __future__ import annotations
 
-from io import BytesIO
 import math
 import time
 
 import db
-from utils import edit_or_send, ensure_force_sub, is_sound_enabled
+from utils import edit_or_send, ensure_force_sub, is_sound_enabled, state_startswith
+from modules import tts_cache
 from modules.i18n import t
 from modules.tts.texts import ask_text, PROCESSING, NO_CREDIT, ERROR, BANNED
 from modules.tts.keyboards import no_credit_keyboard
@@ -22,7 +22,7 @@ from .settings import (
     OUTPUTS,
     BANNED_WORDS,
 )
-from .service import synthesize
+from .service import synthesize_cached
 
 
 _NORMALIZE_REPLACEMENTS = {
@@ -98,7 +98,7 @@ def register(bot):
     @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("tts_openai:"))
     def tts_openai_router(cq):
         user = db.get_or_create_user(cq.from_user)
-        lang = db.get_user_lang(user["user_id"], "fa")
+        lang = user.get("lang") or "fa"
 
         if not ensure_force_sub(bot, user["user_id"], cq.message.chat.id, cq.message.message_id, lang):
             bot.answer_callback_query(cq.id)
@@ -169,7 +169,7 @@ def register(bot):
             return
 
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_WAIT_TEXT),
+        func=state_startswith(STATE_WAIT_TEXT),
         content_types=["text"],
     )
     def on_text_to_tts(msg):
@@ -184,9 +184,10 @@ def register(bot):
         db.set_state(user_id, f"tts_openai:processing:{int(time.time())}")
 
         cost = 0
+        hold_id = None
         status = None
         try:
-            lang = db.get_user_lang(user_id, "fa")
+            lang = user.get("lang") or "fa"
 
             if not ensure_force_sub(bot, user_id, msg.chat.id, msg.message_id, lang):
                 return
@@ -221,8 +222,8 @@ def register(bot):
 
             chunks = math.ceil(len(text) / CHARS_PER_CREDIT)
             cost = db.normalize_credit_amount(chunks * CREDIT_PER_10_CHARS)
-            balance = db.normalize_credit_amount(user.get("credits", 0))
-            if balance < cost:
+            hold_id, balance = db.hold_credits(user_id, cost, reason="tts_openai")
+            if not hold_id:
                 bot.send_message(
                     msg.chat.id,
                     NO_CREDIT(lang, balance, cost),
@@ -230,33 +231,22 @@ def register(bot):
                 )
                 return
 
-            if not db.deduct_credits(user_id, cost):
-                refreshed = db.get_user(user_id) or {}
-                new_balance = db.normalize_credit_amount(refreshed.get("credits", 0))
-                bot.send_message(
-                    msg.chat.id,
-                    NO_CREDIT(lang, new_balance, cost),
-                    reply_markup=no_credit_keyboard(lang),
-                )
-                return
-
             status = bot.send_message(msg.chat.id, PROCESSING(lang))
 
             print(
                 f"🔥 OPENAI TTS REQUEST: user={user_id}, text_len={len(text)}, voice={voice_name}"
             )
-            audio_data = synthesize(text, voice_id, OUTPUTS[0]["mime"])
+            audio = synthesize_cached(text, voice_id, OUTPUTS[0]["mime"])
             print(
-                f"✅ OPENAI TTS RESPONSE: user={user_id}, audio_size={len(audio_data)} bytes"
+                f"✅ OPENAI TTS RESPONSE: user={user_id}, cached={audio.hit}"
             )
 
             safe_del(bot, status.chat.id if status else None, status.message_id if status else None)
             if last_menu_id:
                 safe_del(bot, msg.chat.id, last_menu_id)
 
-            bio = BytesIO(audio_data)
-            bio.name = "Vexa.mp3"
-            bot.send_document(msg.chat.id, document=bio)
+            tts_cache.send(bot, msg.chat.id, audio, "document", filename="Vexa.mp3")
+            db.capture_hold(hold_id)
 
             new_menu = bot.send_message(
                 msg.chat.id,
@@ -274,8 +264,7 @@ def register(bot):
 
         except Exception as e:
             try:
-                if cost:
-                    db.add_credits(user_id, cost)
+                if db.release_hold(hold_id) is not None:
                     print(
                         f"❌ OPENAI TTS ERROR: user={user_id}, credits refunded={cost}, error={e}"
                     )
@@ -296,7 +285,7 @@ def register(bot):
 
 def open_tts(bot, cq, voice_name: str | None = None):
     user = db.get_or_create_user(cq.from_user)
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     if not is_sound_enabled():
         edit_or_send(
             bot,
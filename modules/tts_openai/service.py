@@ -5,8 +5,7 @@ from __future__ import annotations
 import json
 from typing import Final
 
-import requests
-
+from modules import http_client, tts_cache
 from modules.gpt.service import resolve_gpt_api_key
 
 _OPENAI_TTS_URL: Final[str] = "https://api.openai.com/v1/audio/speech"
@@ -29,12 +28,19 @@ def synthesize(text: str, voice: str, mime: str = "audio/mpeg") -> bytes:
         "input": text,
     }
 
-    response = requests.post(
+    response = http_client.request(
+        "openai_tts",
+        "POST",
         _OPENAI_TTS_URL,
         headers=headers,
         data=json.dumps(payload),
-        timeout=120,
     )
     response.raise_for_status()
     return response.content
 
+
+def synthesize_cached(text: str, voice: str, mime: str = "audio/mpeg") -> tts_cache.CachedAudio:
+    """Like :func:`synthesize`, served from the TTS cache when possible."""
+
+    return tts_cache.get_or_synthesize(synthesize, text, voice, _MODEL_ID, mime)
+
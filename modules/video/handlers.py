@@ -3,15 +3,17 @@
 from __future__ import annotations
 
 import logging
+import threading
 
 import db
 from telebot import TeleBot
 from telebot.types import CallbackQuery, Message
 
+from modules import generation_jobs, media_cache
 from modules.home.keyboards import main_menu
 from modules.home.texts import MAIN
 from modules.i18n import t
-from utils import edit_or_send, send_main_menu
+from utils import edit_or_send, send_main_menu, state_startswith
 from .keyboards import menu_keyboard, no_credit_keyboard
 from .service import VideoGenerationError, VideoService
 from .settings import (
@@ -32,6 +34,11 @@ from .texts import (
 
 logger = logging.getLogger(__name__)
 
+JOB_KIND = "video"
+
+_service: VideoService | None = None
+_service_lock = threading.Lock()
+
 USAGE = (
     "ساخت ویدیو از متن:\n"
     "<b>/video</b> توضیح ویدیو\n"
@@ -52,8 +59,7 @@ def _extract_prompt(message: Message) -> str:
 
 def _get_user_and_lang(from_user):
     user = db.get_or_create_user(from_user)
-    db.touch_last_seen(user["user_id"])
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     return user, lang
 
 
@@ -89,6 +95,75 @@ def _send_no_credit(bot: TeleBot, chat_id: int, lang: str, credits: float) -> No
     )
 
 
+def _get_service() -> VideoService:
+    """Return the shared service so submits and polls reuse one session."""
+
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = VideoService()
+        return _service
+
+
+def _poll_job(task_id: str) -> dict | None:
+    return _get_service().check_video_status(task_id)
+
+
+def _show_error(bot: TeleBot, chat_id: int, status_message_id: int, lang: str, error: str) -> None:
+    try:
+        bot.edit_message_text(
+            f"{error_text(lang)}\n<code>{error}</code>",
+            chat_id=chat_id,
+            message_id=status_message_id,
+            parse_mode="HTML",
+        )
+    except Exception:
+        bot.send_message(
+            chat_id,
+            f"{error_text(lang)}\n<code>{error}</code>",
+            parse_mode="HTML",
+        )
+
+
+def _deliver_job(bot: TeleBot, job: dict, result: dict) -> None:
+    lang = job["lang"] or "fa"
+    video_url = result.get("url")
+    if not video_url:
+        logger.error("No video URL in result: %s", result)
+        _show_error(bot, job["chat_id"], job["status_message_id"], lang, "خروجی ویدیو دریافت نشد.")
+        return
+
+    logger.info("Video URL received: %s", video_url[:100])
+
+    kwargs = {
+        "caption": result_caption(lang),
+        "reply_to_message_id": job["reply_to_message_id"] or None,
+        "allow_sending_without_reply": True,
+        "parse_mode": "HTML",
+        "supports_streaming": True,
+    }
+
+    media_cache.send(
+        bot,
+        job["chat_id"],
+        "video",
+        media_cache.url_key(video_url),
+        video_url,
+        **kwargs,
+    )
+    generation_jobs.capture(job)
+
+    try:
+        bot.delete_message(job["chat_id"], job["status_message_id"])
+    except Exception:
+        pass
+
+
+def _fail_job(bot: TeleBot, job: dict, error: str) -> None:
+    logger.error("Video generation error: %s", error)
+    _show_error(bot, job["chat_id"], job["status_message_id"], job["lang"] or "fa", error)
+
+
 def _process_prompt(bot: TeleBot, message: Message, user, prompt: str, lang: str) -> None:
     prompt = (prompt or "").strip()
     if not prompt:
@@ -96,7 +171,7 @@ def _process_prompt(bot: TeleBot, message: Message, user, prompt: str, lang: str
         return
 
     try:
-        service = VideoService()
+        service = _get_service()
     except VideoGenerationError:
         bot.send_message(message.chat.id, not_configured(lang), parse_mode="HTML")
         _start_prompt_flow(
@@ -104,70 +179,46 @@ def _process_prompt(bot: TeleBot, message: Message, user, prompt: str, lang: str
         )
         return
 
-    fresh = db.get_user(user["user_id"]) or user
-    credits = db.normalize_credit_amount(fresh.get("credits", 0))
-    if credits < CREDIT_COST:
-        _send_no_credit(bot, message.chat.id, lang, credits)
+    # Reserve the credits before Runway is asked to do any paid work.
+    hold_id, balance = db.hold_credits(
+        user["user_id"], CREDIT_COST, reason=JOB_KIND, ttl=generation_jobs.hold_ttl(POLL_TIMEOUT)
+    )
+    if not hold_id:
+        _send_no_credit(bot, message.chat.id, lang, balance)
         _start_prompt_flow(
             bot, message.chat.id, user["user_id"], lang, show_intro=False
         )
         return
 
-    db.set_state(user["user_id"], STATE_PROCESSING)
-    status = bot.send_message(message.chat.id, processing(lang), parse_mode="HTML")
-
+    job_id = 0
     try:
+        db.set_state(user["user_id"], STATE_PROCESSING)
+        status = bot.send_message(message.chat.id, processing(lang), parse_mode="HTML")
+
         task_id = service.generate_video(prompt)
         logger.info("Video task created: %s", task_id)
 
-        result = service.get_video_status(
-            task_id,
-            poll_interval=POLL_INTERVAL,
+        # The generation dispatcher polls the task and delivers the video.
+        job_id = generation_jobs.submit(
+            JOB_KIND,
+            user_id=user["user_id"],
+            chat_id=message.chat.id,
+            task_id=task_id,
+            lang=lang,
+            prompt=prompt,
+            cost=CREDIT_COST,
+            reply_to_message_id=message.message_id,
+            status_message_id=status.message_id,
             timeout=POLL_TIMEOUT,
+            hold_id=hold_id,
         )
 
-        video_url = result.get("url")
-        if not video_url:
-            logger.error("No video URL in result: %s", result)
-            raise VideoGenerationError("خروجی ویدیو دریافت نشد.")
-
-        logger.info("Video URL received: %s", video_url[:100])
-
-        kwargs = {
-            "caption": result_caption(lang),
-            "reply_to_message_id": message.message_id,
-            "parse_mode": "HTML",
-            "supports_streaming": True,
-        }
-
-        bot.send_video(
-            message.chat.id,
-            video=video_url,
-            **kwargs,
-        )
-        db.deduct_credits(user["user_id"], CREDIT_COST)
-
-        try:
-            bot.delete_message(status.chat.id, status.message_id)
-        except Exception:
-            pass
-
     except VideoGenerationError as exc:
         logger.error("Video generation error: %s", exc)
-        try:
-            bot.edit_message_text(
-                f"{error_text(lang)}\n<code>{exc}</code>",
-                chat_id=status.chat.id,
-                message_id=status.message_id,
-                parse_mode="HTML",
-            )
-        except Exception:
-            bot.send_message(
-                message.chat.id,
-                f"{error_text(lang)}\n<code>{exc}</code>",
-                parse_mode="HTML",
-            )
+        _show_error(bot, status.chat.id, status.message_id, lang, str(exc))
     finally:
+        if not job_id:
+            db.release_hold(hold_id)
         _start_prompt_flow(
             bot, message.chat.id, user["user_id"], lang, show_intro=False
         )
@@ -199,6 +250,15 @@ def handle_video(bot: TeleBot, message: Message) -> None:
 
 
 def register(bot: TeleBot) -> None:
+    generation_jobs.register_kind(
+        JOB_KIND,
+        poll=_poll_job,
+        deliver=_deliver_job,
+        fail=_fail_job,
+        poll_interval=POLL_INTERVAL,
+        timeout_message="مهلت دریافت ویدیو به پایان رسید.",
+    )
+
     @bot.callback_query_handler(func=lambda c: c.data == "video:back")
     def on_back(cq: CallbackQuery):
         user, lang = _get_user_and_lang(cq.from_user)
@@ -218,7 +278,7 @@ def register(bot: TeleBot) -> None:
         handle_video(bot, message)
 
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_WAIT_PROMPT),
+        func=state_startswith(STATE_WAIT_PROMPT),
         content_types=["text"],
     )
     def on_prompt(message: Message):
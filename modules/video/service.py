@@ -9,6 +9,8 @@ from typing import Any, Dict, Optional
 
 import requests
 
+from modules import http_client
+
 
 logger = logging.getLogger(__name__)
 
@@ -40,16 +42,14 @@ class VideoService:
 
         self._token = token
         self._base_urls = self._initialise_base_urls()
-        self._session = requests.Session()
-        self._session.headers.update(
-            {
-                "Authorization": f"Bearer {self._token}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "User-Agent": "vexa-ai-video-service/1.0",
-                "X-Runway-Version": self._API_VERSION,
-            }
-        )
+        # Sent with every request; connections come from the shared pool.
+        self._headers = {
+            "Authorization": f"Bearer {self._token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "User-Agent": "vexa-ai-video-service/1.0",
+            "X-Runway-Version": self._API_VERSION,
+        }
 
     # ------------------------------------------------------------------
     # Public API
@@ -104,6 +104,45 @@ class VideoService:
         logger.info("Runway video task created", extra={"task_id": task_id})
         return str(task_id)
 
+    def check_video_status(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch the task once; return the URLs when done or ``None`` while running."""
+
+        if not task_id:
+            raise VideoGenerationError("شناسهٔ تسک معتبر نیست.")
+
+        response = self._request("GET", f"/tasks/{task_id}")
+        payload = self._safe_json(response)
+
+        status = str(payload.get("status", "")).upper()
+        logger.debug("Task %s status: %s", task_id, status)
+
+        if status == "SUCCEEDED":
+            video_url = self._extract_video_url(payload)
+            cover_url = self._extract_cover_url(payload)
+
+            if not video_url:
+                assets = self._fetch_assets(task_id)
+                video_url = self._extract_video_url(assets)
+                cover_url = cover_url or self._extract_cover_url(assets)
+
+            if not video_url:
+                raise VideoGenerationError("خروجی ویدیو در پاسخ موفق پیدا نشد.")
+
+            return {
+                "url": video_url,
+                "cover": cover_url,
+            }
+
+        if status in {"FAILED", "CANCELED"}:
+            error_msg = (
+                payload.get("failure_reason")
+                or payload.get("error")
+                or "تولید ویدیو ناموفق بود."
+            )
+            raise VideoGenerationError(f"خطا: {error_msg}")
+
+        return None
+
     def get_video_status(
         self,
         task_id: str,
@@ -120,37 +159,9 @@ class VideoService:
         deadline = time.time() + float(timeout or self._GENERATION_TIMEOUT)
 
         while time.time() < deadline:
-            response = self._request("GET", f"/tasks/{task_id}")
-            payload = self._safe_json(response)
-
-            status = str(payload.get("status", "")).upper()
-            logger.debug("Task %s status: %s", task_id, status)
-
-            if status == "SUCCEEDED":
-                video_url = self._extract_video_url(payload)
-                cover_url = self._extract_cover_url(payload)
-
-                if not video_url:
-                    assets = self._fetch_assets(task_id)
-                    video_url = self._extract_video_url(assets)
-                    cover_url = cover_url or self._extract_cover_url(assets)
-
-                if not video_url:
-                    raise VideoGenerationError("خروجی ویدیو در پاسخ موفق پیدا نشد.")
-
-                return {
-                    "url": video_url,
-                    "cover": cover_url,
-                }
-
-            if status in {"FAILED", "CANCELED"}:
-                error_msg = (
-                    payload.get("failure_reason")
-                    or payload.get("error")
-                    or "تولید ویدیو ناموفق بود."
-                )
-                raise VideoGenerationError(f"خطا: {error_msg}")
-
+            result = self.check_video_status(task_id)
+            if result is not None:
+                return result
             time.sleep(poll_delay)
 
         raise VideoGenerationError("مهلت دریافت ویدیو به پایان رسید.")
@@ -210,10 +221,12 @@ class VideoService:
         for index, base_url in enumerate(list(self._base_urls)):
             url = f"{base_url}{path}"
             try:
-                response = self._session.request(
+                response = http_client.request(
+                    "runway",
                     method,
                     url,
                     json=json,
+                    headers=self._headers,
                     timeout=timeout or self._REQUEST_TIMEOUT,
                 )
             except requests.RequestException as exc:  # pragma: no cover - network failure
@@ -236,8 +249,10 @@ class VideoService:
                 raise VideoGenerationError(message)
 
             if index != 0:
-                self._base_urls.pop(index)
-                self._base_urls.insert(0, base_url)
+                # Rebind instead of mutating; the instance is shared across threads.
+                self._base_urls = [base_url] + [
+                    url for url in self._base_urls if url != base_url
+                ]
 
             return response
 
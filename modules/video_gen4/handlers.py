@@ -4,16 +4,25 @@ from __future__ import annotations
 
 import logging
 import mimetypes
+import threading
 from typing import Tuple
 
 import db
 from telebot import TeleBot
 from telebot.types import CallbackQuery, Message
 
+from modules import generation_jobs, media_cache
 from modules.home.keyboards import main_menu
 from modules.home.texts import MAIN
 from modules.i18n import t
-from utils import edit_or_send, ensure_force_sub, feature_disabled_text, is_feature_enabled, send_main_menu
+from utils import (
+    edit_or_send,
+    ensure_force_sub,
+    feature_disabled_text,
+    is_feature_enabled,
+    send_main_menu,
+    state_startswith,
+)
 from .keyboards import menu_keyboard, no_credit_keyboard
 from .service import VideoGen4Error, VideoGen4Service
 from .settings import (
@@ -37,11 +46,15 @@ from .texts import (
 
 logger = logging.getLogger(__name__)
 
+JOB_KIND = "video_gen4"
+
+_service: VideoGen4Service | None = None
+_service_lock = threading.Lock()
+
 
 def _get_user_and_lang(from_user):
     user = db.get_or_create_user(from_user)
-    db.touch_last_seen(user["user_id"])
-    lang = db.get_user_lang(user["user_id"], "fa")
+    lang = user.get("lang") or "fa"
     return user, lang
 
 
@@ -144,18 +157,80 @@ def _extract_image(bot: TeleBot, message: Message, lang: str, *, depth: int = 0)
     raise VideoGen4Error(need_image(lang))
 
 
+def _get_service() -> VideoGen4Service:
+    """Return the shared service so submits and polls reuse one session."""
+
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = VideoGen4Service()
+        return _service
+
+
+def _poll_job(task_id: str) -> dict | None:
+    return _get_service().check_video_status(task_id)
+
+
+def _show_error(bot: TeleBot, chat_id: int, status_message_id: int, lang: str, error: str) -> None:
+    try:
+        bot.edit_message_text(
+            f"{error_text(lang)}\n<code>{error}</code>",
+            chat_id=chat_id,
+            message_id=status_message_id,
+            parse_mode="HTML",
+        )
+    except Exception:
+        bot.send_message(
+            chat_id,
+            f"{error_text(lang)}\n<code>{error}</code>",
+            parse_mode="HTML",
+        )
+
+
+def _deliver_job(bot: TeleBot, job: dict, result: dict) -> None:
+    lang = job["lang"] or "fa"
+    video_url = result.get("url")
+    if not video_url:
+        _show_error(bot, job["chat_id"], job["status_message_id"], lang, "خروجی ویدیو دریافت نشد.")
+        return
+
+    media_cache.send(
+        bot,
+        job["chat_id"],
+        "video",
+        media_cache.url_key(video_url),
+        video_url,
+        caption=result_caption(lang),
+        reply_to_message_id=job["reply_to_message_id"] or None,
+        allow_sending_without_reply=True,
+        parse_mode="HTML",
+        supports_streaming=True,
+    )
+
+    if not generation_jobs.capture(job):
+        logger.warning("Failed to deduct credits after Gen-4 video", extra={"user": job["user_id"]})
+
+    try:
+        bot.delete_message(job["chat_id"], job["status_message_id"])
+    except Exception:
+        pass
+
+
+def _fail_job(bot: TeleBot, job: dict, error: str) -> None:
+    logger.error("Gen-4 video error: %s", error)
+    _show_error(bot, job["chat_id"], job["status_message_id"], job["lang"] or "fa", error)
+
+
 def _process_image(bot: TeleBot, message: Message, user, lang: str) -> None:
     try:
-        service = VideoGen4Service()
+        service = _get_service()
     except VideoGen4Error:
         bot.send_message(message.chat.id, not_configured(lang), parse_mode="HTML")
         _start_flow(bot, message.chat.id, user["user_id"], lang, show_intro=False)
         return
 
-    fresh = db.get_user(user["user_id"]) or user
-    credits = db.normalize_credit_amount(fresh.get("credits", 0))
-    if credits < CREDIT_COST:
-        _send_no_credit(bot, message.chat.id, lang, credits)
+    if db.normalize_credit_amount(user.get("credits", 0)) < CREDIT_COST:
+        _send_no_credit(bot, message.chat.id, lang, user.get("credits", 0))
         _start_flow(bot, message.chat.id, user["user_id"], lang, show_intro=False)
         return
 
@@ -165,56 +240,44 @@ def _process_image(bot: TeleBot, message: Message, user, lang: str) -> None:
         bot.reply_to(message, str(exc), parse_mode="HTML")
         return
 
-    prompt = (message.caption or "").strip()
+    # Reserve the credits before Runway is asked to do any paid work.
+    hold_id, balance = db.hold_credits(
+        user["user_id"], CREDIT_COST, reason=JOB_KIND, ttl=generation_jobs.hold_ttl(POLL_TIMEOUT)
+    )
+    if not hold_id:
+        _send_no_credit(bot, message.chat.id, lang, balance)
+        _start_flow(bot, message.chat.id, user["user_id"], lang, show_intro=False)
+        return
 
-    db.set_state(user["user_id"], STATE_PROCESSING)
-    status = bot.send_message(message.chat.id, processing(lang), parse_mode="HTML")
+    prompt = (message.caption or "").strip()
 
+    job_id = 0
     try:
-        task_id = service.generate_video(image_bytes, mime_type=mime_type, prompt=prompt)
-        result = service.get_video_status(
-            task_id,
-            poll_interval=POLL_INTERVAL,
-            timeout=POLL_TIMEOUT,
-        )
+        db.set_state(user["user_id"], STATE_PROCESSING)
+        status = bot.send_message(message.chat.id, processing(lang), parse_mode="HTML")
 
-        video_url = result.get("url")
-        if not video_url:
-            raise VideoGen4Error("خروجی ویدیو دریافت نشد.")
-
-        bot.send_video(
-            message.chat.id,
-            video=video_url,
-            caption=result_caption(lang),
+        task_id = service.generate_video(image_bytes, mime_type=mime_type, prompt=prompt)
+        # The generation dispatcher polls the task and delivers the video.
+        job_id = generation_jobs.submit(
+            JOB_KIND,
+            user_id=user["user_id"],
+            chat_id=message.chat.id,
+            task_id=task_id,
+            lang=lang,
+            prompt=prompt,
+            cost=CREDIT_COST,
             reply_to_message_id=message.message_id,
-            parse_mode="HTML",
-            supports_streaming=True,
+            status_message_id=status.message_id,
+            timeout=POLL_TIMEOUT,
+            hold_id=hold_id,
         )
 
-        if not db.deduct_credits(user["user_id"], CREDIT_COST):
-            logger.warning("Failed to deduct credits after Gen-4 video", extra={"user": user["user_id"]})
-
-        try:
-            bot.delete_message(status.chat.id, status.message_id)
-        except Exception:
-            pass
-
     except VideoGen4Error as exc:
         logger.error("Gen-4 video error: %s", exc)
-        try:
-            bot.edit_message_text(
-                f"{error_text(lang)}\n<code>{exc}</code>",
-                chat_id=status.chat.id,
-                message_id=status.message_id,
-                parse_mode="HTML",
-            )
-        except Exception:
-            bot.send_message(
-                message.chat.id,
-                f"{error_text(lang)}\n<code>{exc}</code>",
-                parse_mode="HTML",
-            )
+        _show_error(bot, status.chat.id, status.message_id, lang, str(exc))
     finally:
+        if not job_id:
+            db.release_hold(hold_id)
         _start_flow(bot, message.chat.id, user["user_id"], lang, show_intro=False)
 
 
@@ -247,6 +310,15 @@ def open_video(bot: TeleBot, call: CallbackQuery) -> None:
 
 
 def register(bot: TeleBot) -> None:
+    generation_jobs.register_kind(
+        JOB_KIND,
+        poll=_poll_job,
+        deliver=_deliver_job,
+        fail=_fail_job,
+        poll_interval=POLL_INTERVAL,
+        timeout_message="مهلت دریافت ویدیو به پایان رسید.",
+    )
+
     @bot.callback_query_handler(func=lambda c: c.data == "video_gen4:back")
     def on_back(cq: CallbackQuery):
         user, lang = _get_user_and_lang(cq.from_user)
@@ -305,7 +377,7 @@ def register(bot: TeleBot) -> None:
         _process_image(bot, message, user, lang)
 
     @bot.message_handler(
-        func=lambda m: (db.get_state(m.from_user.id) or "").startswith(STATE_WAIT_IMAGE),
+        func=state_startswith(STATE_WAIT_IMAGE),
         content_types=["text"],
     )
     def on_waiting_text(message: Message):
@@ -0,0 +1,84 @@
+"""Updates per second through the db helpers of one Telegram update.
+
+    python tests/bench_db_updates.py [--updates 5000] [--users 200] [--threads 1]
+
+Replays the helper calls the bot makes for a typical text update
+(``get_or_create_user``, ``get_user_lang``, ``touch_last_seen``, two
+``get_state`` reads, the settings reads and ``log_message``) against a
+throwaway database, once on the shared per-thread connection and once with
+``--reconnect`` semantics (the connection is closed after every helper, as
+the helpers used to open their own), and reports updates per second.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("DB_DIR", tempfile.mkdtemp(prefix="vexa-bench-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+def _update(user_id: int, reconnect: bool) -> None:
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Bench")
+    calls = (
+        lambda: db.get_or_create_user(user),
+        lambda: db.get_user_lang(user_id),
+        lambda: db.touch_last_seen(user_id),
+        lambda: db.get_state(user_id),
+        lambda: db.get_setting("BOT_ENABLED", "1"),
+        lambda: db.get_settings(),
+        lambda: db.get_state(user_id),
+        lambda: db.log_message(user_id, "in", "سلام، یک سؤال دارم"),
+    )
+    for call in calls:
+        call()
+        if reconnect:
+            db.close_connection()
+
+
+def _worker(count: int, users: int, offset: int, reconnect: bool) -> None:
+    for index in range(count):
+        _update(1_000_000 + (offset + index) % users, reconnect)
+    db.close_connection()
+
+
+def run(updates: int, users: int, threads: int, reconnect: bool) -> float:
+    per_thread = max(1, updates // threads)
+    workers = [
+        threading.Thread(target=_worker, args=(per_thread, users, n * per_thread, reconnect))
+        for n in range(threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    db.flush_logs()
+    return per_thread * threads / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    db.init_db()
+    _worker(args.users, args.users, 0, False)  # create the users up front
+    print(f"{args.updates} updates, {args.users} users, {args.threads} thread(s), {db.DB_JOURNAL_MODE} journal\n")
+    for label, reconnect in (("connection per helper", True), ("per-thread connection", False)):
+        rate = run(args.updates, args.users, args.threads, reconnect)
+        print(f"{label:24}{rate:>10.0f} updates/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Prompt size per GPT turn: the last N rows versus the token budget.
+
+    python tests/bench_gpt_history.py [--turns 50] [--paste-ratio 0.3]
+
+Replays one simulated conversation of mixed Persian and English turns, a
+share of them long log pastes, against both ways of picking the history and
+reports the estimated prompt and history tokens per turn and how long
+building the history took.  Summaries are stubbed and folded inline, so no
+API key is needed; the database is a throwaway file.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DB_DIR", tempfile.mkdtemp(prefix="vexa-bench-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from modules.gpt import history  # noqa: E402
+from modules.gpt.service import build_default_messages  # noqa: E402
+
+_PERSIAN = [
+    "سلام، می‌خواهم یک برنامهٔ سفر سه‌روزه برای شیراز بنویسم.",
+    "این را خلاصه‌تر بنویس و قیمت‌ها را هم اضافه کن.",
+    "ممنون، حالا همین را به انگلیسی ترجمه کن.",
+    "چطور می‌توانم این خطا را در پایتون رفع کنم؟",
+]
+_ENGLISH = [
+    "Can you explain how connection pooling works in requests?",
+    "Rewrite the last answer as a short checklist.",
+    "What would change if the database were on a network drive?",
+    "Thanks, that fixed it. One more question about retries.",
+]
+
+
+def _paste(rng: random.Random) -> str:
+    lines = [
+        f"2026-10-17 12:{rng.randrange(60):02d}:{rng.randrange(60):02d} ERROR worker-{rng.randrange(16)} "
+        f"Traceback (most recent call last): File \"app.py\", line {rng.randrange(900)}"
+        for _ in range(rng.randrange(20, 40))
+    ]
+    return "\n".join(lines)
+
+
+def _message(rng: random.Random, paste_ratio: float, reply: bool) -> str:
+    if rng.random() < paste_ratio:
+        return _paste(rng)
+    text = rng.choice(_PERSIAN if rng.random() < 0.5 else _ENGLISH)
+    return " ".join([text] * (rng.randrange(3, 8) if reply else 1))
+
+
+def _tokens(messages) -> int:
+    return sum(history.message_tokens(message) for message in messages)
+
+
+def _stub_summary(summary: str, messages) -> str:
+    _stub_summary.calls += 1
+    notes = (summary + " " + " ".join(m["content"][:60] for m in messages)).strip()
+    return notes[-history.GPT_SUMMARY_TOKENS * 2:]
+
+
+_stub_summary.calls = 0
+
+
+def run(turns: int, paste_ratio: float, seed: int) -> None:
+    db.init_db()
+    history._summarise = _stub_summary
+    history.GPT_SUMMARY = True
+    rng = random.Random(seed)
+    strategies = {
+        "last 6 rows": (101, lambda uid: db.get_recent_gpt_messages(uid, 6)),
+        "token budget": (102, history.build_context),
+    }
+    results = {name: {"prompt": [], "history": [], "build_us": []} for name in strategies}
+
+    for _ in range(turns):
+        question = _message(rng, paste_ratio, reply=False)
+        answer = _message(rng, paste_ratio, reply=True)
+        for name, (user_id, build) in strategies.items():
+            started = time.perf_counter()
+            context = build(user_id)
+            results[name]["build_us"].append((time.perf_counter() - started) * 1e6)
+            results[name]["history"].append(_tokens(context))
+            results[name]["prompt"].append(_tokens(build_default_messages(context, question, normalised=True)))
+            db.log_gpt_message(user_id, "user", question)
+            db.log_gpt_message(user_id, "assistant", answer)
+            if build is history.build_context:
+                history._update_summary(user_id)
+
+    print(f"{turns} turns, {paste_ratio:.0%} pastes, budget {history.GPT_HISTORY_TOKENS} tokens\n")
+    print(f"{'':15}{'prompt avg/max':>18}{'history avg/max':>19}{'build p50':>12}")
+    for name, values in results.items():
+        print(
+            f"{name:15}"
+            f"{statistics.mean(values['prompt']):>10.0f} / {max(values['prompt']):<5}"
+            f"{statistics.mean(values['history']):>11.0f} / {max(values['history']):<5}"
+            f"{statistics.median(values['build_us']):>9.0f} us"
+        )
+    print(f"\nsummary requests: {_stub_summary.calls} (max {history.GPT_SUMMARY_TOKENS} output tokens each)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--paste-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    run(args.turns, args.paste_ratio, args.seed)
+
+
+if __name__ == "__main__":
+    main()
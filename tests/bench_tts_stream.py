@@ -0,0 +1,138 @@
+"""Latency and peak RSS of ElevenLabs synthesis, buffered versus streamed.
+
+    python tests/bench_tts_stream.py [--mb 20] [--runs 15] [--chunk-delay 0.001]
+
+Serves ``--mb`` MB of audio from a local HTTP server in 64 KiB chunks (the
+ElevenLabs URL is rewritten to it) and runs each mode in its own process so
+``ru_maxrss`` is per mode:
+
+* ``first byte`` — :func:`modules.tts.service.iter_audio` yields its first
+  chunk (what the API's streaming TTS endpoint sends on);
+* ``ready`` — :func:`modules.tts.service.synthesize_cached` returns, i.e. the
+  whole file is on disk.  The bot's Telegram upload starts only here: the
+  Bot API takes the complete file, so spooling and uploading do not overlap.
+
+Every run uses a new text, so all requests are cache misses.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK = 64 * 1024
+
+
+def _serve(size: int, delay: float) -> str:
+    block = bytes(CHUNK)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            for offset in range(0, size, CHUNK):
+                self.wfile.write(block[: min(CHUNK, size - offset)])
+                if delay:
+                    time.sleep(delay)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def _child(mode: str, size: int, runs: int, delay: float) -> dict:
+    os.environ["DB_DIR"] = tempfile.mkdtemp(prefix="vexa-bench-")
+    os.environ["ELEVEN_API_KEY"] = "bench"
+    os.environ["ELEVEN_TTS_STREAM"] = "1" if mode == "stream" else "0"
+    os.environ["TTS_CACHE_MAX_MB"] = str(max(512, size * 2 // (1024 * 1024)))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import db
+    from modules import http_client
+    from modules.tts import service
+
+    db.init_db()
+    base = _serve(size, delay)
+    request = http_client.request
+
+    def local_request(provider, method, url, **kwargs):
+        return request(provider, method, url.replace("https://api.elevenlabs.io", base), **kwargs)
+
+    http_client.request = local_request
+
+    first_byte, ready = [], []
+    for run in range(runs):
+        started = time.perf_counter()
+        chunks = service.iter_audio(f"bench first byte {run}", "voice")
+        next(chunks)
+        first_byte.append(time.perf_counter() - started)
+        for _ in chunks:
+            pass
+
+        started = time.perf_counter()
+        audio = service.synthesize_cached(f"bench ready {run}", "voice")
+        ready.append(time.perf_counter() - started)
+        with audio.open() as fh:
+            while fh.read(CHUNK):
+                pass
+        del audio
+
+    return {
+        "first_byte": first_byte,
+        "ready": ready,
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=15)
+    parser.add_argument("--chunk-delay", type=float, default=0.001)
+    parser.add_argument("--child", choices=("bytes", "stream"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = args.mb * 1024 * 1024
+
+    if args.child:
+        print(json.dumps(_child(args.child, size, args.runs, args.chunk_delay)))
+        return
+
+    print(f"{args.mb} MB x{args.runs}, {args.chunk_delay * 1000:g} ms between 64 KiB chunks\n")
+    print(f"{'':8}{'first byte p50/p95':>22}{'ready p50/p95':>20}{'peak RSS':>12}")
+    for mode in ("bytes", "stream"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", mode, "--mb", str(args.mb),
+             "--runs", str(args.runs), "--chunk-delay", str(args.chunk_delay)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{mode:8}"
+            f"{statistics.median(result['first_byte']):>12.3f}s / {_percentile(result['first_byte'], 0.95):.3f}s"
+            f"{statistics.median(result['ready']):>10.3f}s / {_percentile(result['ready'], 0.95):.3f}s"
+            f"{result['rss_mb']:>9.1f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# db.py reads DB_DIR at import time; every test run gets a fresh database.
+os.environ.setdefault("DB_DIR", tempfile.mkdtemp(prefix="vexa-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,92 @@
+"""Load check of the HTTP API with stubbed Runway and ElevenLabs.
+
+Many concurrent ``/v1/image`` requests whose Runway tasks keep rendering
+must not hold up authentication or the cheap endpoints.
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+
+import api_server
+import db
+from modules import generation_jobs
+
+
+class _Runway:
+    """Tasks are created at once and stay running until ``finish`` is set."""
+
+    def __init__(self):
+        self.submitted = 0
+        self.finish = threading.Event()
+        self._lock = threading.Lock()
+
+    def generate_image(self, prompt, *, ratio=None):
+        with self._lock:
+            self.submitted += 1
+            return f"task-{self.submitted}"
+
+    def check_image_status(self, task_id):
+        time.sleep(0.01)
+        if not self.finish.is_set():
+            return None
+        return {"url": f"https://images.example/{task_id}.png"}
+
+
+class _Audio:
+    def read(self):
+        return b"ID3audio"
+
+
+def _user(user_id):
+    db.get_or_create_user(SimpleNamespace(id=user_id, username="", first_name=""))
+    db.add_credits(user_id, 1000)
+    return db.get_or_create_api_token(user_id)
+
+
+def test_slow_image_generations_do_not_block_cheap_calls(monkeypatch):
+    runway = _Runway()
+    monkeypatch.setattr(api_server, "_get_image_service", lambda: runway)
+    monkeypatch.setattr(api_server, "synthesize_cached", lambda *args: _Audio())
+    monkeypatch.setattr(generation_jobs, "TICK_SECONDS", 0.05)
+    monkeypatch.setitem(
+        generation_jobs._kinds,
+        "api_image",
+        generation_jobs._kinds["api_image"]._replace(poll_interval=0.05),
+    )
+    headers = {"X-API-Key": _user(9001)}
+    images = api_server._BLOCKING_WORKERS * 2
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=api_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://api") as client:
+            generations = [
+                asyncio.ensure_future(client.post("/v1/image", json={"prompt": f"cat {n}"}, headers=headers))
+                for n in range(images)
+            ]
+            while runway.submitted < images:
+                await asyncio.sleep(0.01)
+
+            started = time.monotonic()
+            voices = await client.get("/v1/voices", headers=headers)
+            voices_elapsed = time.monotonic() - started
+            started = time.monotonic()
+            tts = await client.post("/v1/tts", json={"text": "hello"}, headers=headers)
+            tts_elapsed = time.monotonic() - started
+            assert not any(generation.done() for generation in generations)
+
+            runway.finish.set()
+            responses = await asyncio.wait_for(asyncio.gather(*generations), 30)
+        return voices, voices_elapsed, tts, tts_elapsed, responses
+
+    voices, voices_elapsed, tts, tts_elapsed, responses = asyncio.run(scenario())
+
+    assert voices.status_code == 200
+    assert voices_elapsed < 1.0
+    assert tts.status_code == 200
+    assert tts_elapsed < 1.0
+    assert [response.status_code for response in responses] == [200] * images
+    assert all(response.json()["image_url"].startswith("https://images.example/") for response in responses)
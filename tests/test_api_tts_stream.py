@@ -0,0 +1,52 @@
+import asyncio
+import threading
+
+import api_server
+
+
+def test_cancel_mid_chunk_releases_hold_and_closes_stream(monkeypatch):
+    started = threading.Event()
+    resume = threading.Event()
+    closed = threading.Event()
+    released = []
+    captured = []
+
+    def audio():
+        try:
+            yield b"first"
+            started.set()
+            resume.wait(5)
+            yield b"second"
+        finally:
+            closed.set()
+
+    monkeypatch.setattr(api_server, "iter_audio", lambda *args: audio())
+    monkeypatch.setattr(api_server.db, "release_hold", released.append)
+    monkeypatch.setattr(api_server.db, "capture_hold", captured.append)
+
+    async def scenario():
+        response = await api_server._stream_tts(1, "text", "voice", "name", "audio/mpeg", 1.0, 9.0, 42)
+        body = response.body_iterator
+        assert await body.__anext__() == b"first"
+        reading = asyncio.ensure_future(body.__anext__())
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # The client disconnects while the next chunk is being synthesized.
+        reading.cancel()
+        try:
+            await reading
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(scenario())
+
+    for _ in range(100):
+        if released:
+            break
+        threading.Event().wait(0.01)
+    assert released == [42]
+    assert captured == []
+    assert not closed.is_set()  # still executing; closed once it returns
+
+    resume.set()
+    assert closed.wait(5)
@@ -0,0 +1,73 @@
+import hashlib
+import hmac
+from types import SimpleNamespace
+
+import pytest
+
+import api_server
+import db
+from modules import http_client
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://127.0.0.1/hook",
+        "http://localhost:8080/hook",
+        "http://10.1.2.3/hook",
+        "http://192.168.0.10/hook",
+        "http://169.254.169.254/latest/meta-data/",
+        "http://[::1]/hook",
+        "http://[::ffff:127.0.0.1]/hook",
+        "http://0.0.0.0/hook",
+        "http://240.0.0.1/hook",
+        "ftp://93.184.215.14/hook",
+        "http:///hook",
+    ],
+)
+def test_internal_webhook_urls_are_refused(url):
+    assert api_server._webhook_url_error(url)
+
+
+def test_public_webhook_url_is_accepted():
+    assert api_server._webhook_url_error("https://93.184.215.14:8443/hook") is None
+
+
+def _user(user_id):
+    db.get_or_create_user(SimpleNamespace(id=user_id, username="", first_name=""))
+    db.get_or_create_api_token(user_id)
+
+
+def test_webhook_is_signed_with_a_secret_that_survives_token_rotation(monkeypatch):
+    sent = []
+
+    def request(provider, method, url, **kwargs):
+        sent.append(kwargs)
+        return SimpleNamespace(status_code=200)
+
+    monkeypatch.setattr(http_client, "request", request)
+    _user(9101)
+    secret = db.get_webhook_secret(9101)
+    assert secret and secret != db.get_api_token(9101)
+
+    db.rotate_api_token(9101)
+    api_server._post_webhook(9101, "https://93.184.215.14/hook", b'{"job_id": 1}')
+
+    assert db.get_webhook_secret(9101) == secret
+    expected = hmac.new(secret.encode("utf-8"), b'{"job_id": 1}', hashlib.sha256).hexdigest()
+    assert [kwargs["headers"]["X-Vexa-Signature"] for kwargs in sent] == [f"sha256={expected}"]
+
+
+def test_webhook_to_internal_host_is_not_sent(monkeypatch):
+    sent = []
+    monkeypatch.setattr(http_client, "request", lambda *args, **kwargs: sent.append(args))
+    _user(9102)
+
+    api_server._post_webhook(9102, "http://169.254.169.254/latest", b"{}")
+
+    assert sent == []
+
+
+def test_webhook_session_does_not_retry():
+    adapter = http_client.session("webhook").get_adapter("https://example.com/")
+    assert adapter.max_retries.total == 0
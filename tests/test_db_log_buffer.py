@@ -0,0 +1,53 @@
+import sqlite3
+from contextlib import contextmanager
+
+import db
+
+
+def _failing_transaction(monkeypatch, error):
+    real = db.transaction
+
+    @contextmanager
+    def transaction():
+        monkeypatch.setattr(db, "transaction", real)
+        raise error
+        yield  # pragma: no cover
+
+    monkeypatch.setattr(db, "transaction", transaction)
+
+
+def _texts(user_id):
+    con = db.get_connection()
+    rows = con.execute("SELECT text FROM messages WHERE user_id=? ORDER BY id", (user_id,))
+    return [row[0] for row in rows]
+
+
+def test_locked_database_requeues_the_batch(monkeypatch):
+    db.init_db()
+    db.flush_logs()
+    requeued = db.get_log_buffer_stats()["requeued_rows"]
+    # Armed first: the next flush with rows fails, whether it is this one
+    # or the background writer's.
+    _failing_transaction(monkeypatch, sqlite3.OperationalError("database is locked"))
+    db.log_message(9301, "in", "first")
+    db.log_menu_usage(9301, "tts")
+    db.flush_logs()
+    assert db.get_log_buffer_stats()["requeued_rows"] > requeued
+
+    db.log_message(9301, "in", "second")
+    db.log_menu_usage(9301, "tts")
+    db.flush_logs()
+    assert _texts(9301) == ["first", "second"]
+    assert [(item["menu_key"], item["count"]) for item in db.get_user_menu_usage(9301)] == [("tts", 2)]
+
+
+def test_other_errors_drop_the_batch(monkeypatch):
+    db.init_db()
+    db.flush_logs()
+    failed = db.get_log_buffer_stats()["failed_rows"]
+    _failing_transaction(monkeypatch, sqlite3.DatabaseError("database disk image is malformed"))
+    db.log_message(9302, "in", "lost")
+    db.flush_logs()
+    db.flush_logs()
+    assert db.get_log_buffer_stats()["failed_rows"] == failed + 1
+    assert _texts(9302) == []
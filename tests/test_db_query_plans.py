@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def traced():
+    db.init_db()
+    con = db.get_connection()
+    statements = []
+    con.set_trace_callback(statements.append)
+    yield statements
+    con.set_trace_callback(None)
+
+
+def _plans(statements):
+    con = db.get_connection()
+    reads = [sql for sql in statements if sql.lstrip().upper().startswith(("SELECT", "DELETE"))]
+    assert reads, "no SELECT or DELETE was traced"
+    return {sql: [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + sql)] for sql in reads}
+
+
+def _assert_indexed(statements, index_hint):
+    for sql, details in _plans(statements).items():
+        assert not any(detail.startswith("SCAN") for detail in details), (sql, details)
+        assert any(index_hint in detail for detail in details), (sql, details)
+
+
+def test_migrations_are_applied():
+    db.init_db()
+    version = db.get_connection().execute("PRAGMA user_version").fetchone()[0]
+    assert version == len(db._SCHEMA_MIGRATIONS)
+
+
+def test_state_lookup_uses_primary_key(traced):
+    db.get_state(987654321)
+    _assert_indexed(traced, "USING INTEGER PRIMARY KEY")
+
+
+def test_recent_gpt_messages_use_user_index(traced):
+    db.get_gpt_history_window(987654322, 6)
+    _assert_indexed(traced, "idx_gpt_messages_user")
+
+
+def test_expired_holds_use_partial_index(traced):
+    db.release_expired_holds()
+    _assert_indexed(traced, "idx_credit_ledger_held")
+
+
+def _user(user_id):
+    db.get_or_create_user(SimpleNamespace(id=user_id, username="", first_name=""))
+
+
+# One case per index of schema migration 1, through the helper it serves.
+@pytest.mark.parametrize(
+    "call, index",
+    [
+        (lambda tmp: db.count_tts_requests(1), "idx_messages_user_kind"),
+        (lambda tmp: db.export_user_tts_csv(1, tmp / "tts.csv"), "idx_messages_user_kind"),
+        (lambda tmp: db.export_user_messages_csv(1, tmp / "messages.csv"), "idx_messages_user_kind"),
+        (lambda tmp: db.get_gpt_history_window(987654323, 6), "idx_gpt_messages_user"),
+        (lambda tmp: db.get_recent_vexa_assistant_messages(987654324, 6), "idx_vexa_assistant_messages_user"),
+        (lambda tmp: db.list_user_images(1), "idx_image_generations_user"),
+        (lambda tmp: db.list_user_voices(1), "idx_user_voices_user"),
+        (lambda tmp: db.get_user_voice(1, "name"), "idx_user_voices_user"),
+        (lambda tmp: db.delete_user_voice_by_voice_id("voice"), "idx_user_voices_voice_id"),
+        (lambda tmp: db.count_invited("1"), "idx_users_referred_by"),
+        (lambda tmp: db.get_user_ids_by_lang("en"), "idx_users_lang"),
+        (lambda tmp: db.count_user_ids("en"), "idx_users_lang"),
+        (lambda tmp: db.get_user_ids_after(0, "en"), "idx_users_lang"),
+        (lambda tmp: db.count_active_users(), "idx_users_last_seen"),
+        (lambda tmp: db.count_daily_reward_users_since(days=1), "idx_users_last_daily_reward"),
+        (lambda tmp: db.count_users_today(), "idx_users_joined_at"),
+        (lambda tmp: db.get_user_by_username("@Someone"), "idx_users_username_lower"),
+    ],
+)
+def test_hot_queries_use_their_index(traced, tmp_path, call, index):
+    call(tmp_path)
+    _assert_indexed(traced, index)
+
+
+def test_sora2_requests_per_user_use_user_index(traced):
+    # No helper reads them per user yet; the index serves ad-hoc lookups.
+    db.get_connection().execute("SELECT COUNT(*) FROM sora2_requests WHERE user_id=1").fetchone()
+    _assert_indexed(traced, "idx_sora2_requests_user")
+
+
+def test_reset_user_deletes_by_index(traced):
+    _user(987654325)
+    traced.clear()
+    assert db.reset_user(987654325)
+
+    for sql, details in _plans(traced).items():
+        assert not any(detail.startswith("SCAN") for detail in details), (sql, details)
+    expected = {
+        "DELETE FROM messages": "idx_messages_user_kind",
+        "DELETE FROM gpt_messages": "idx_gpt_messages_user",
+        "DELETE FROM vexa_assistant_messages": "idx_vexa_assistant_messages_user",
+        "DELETE FROM purchases": "idx_purchases_user",
+        "DELETE FROM user_voices": "idx_user_voices_user",
+        "DELETE FROM image_generations": "idx_image_generations_user",
+    }
+    for prefix, index in expected.items():
+        _assert_indexed([sql for sql in traced if sql.lstrip().startswith(prefix)], index)
@@ -0,0 +1,27 @@
+import db
+from modules import generation_jobs
+
+
+def test_pending_scan_is_limited_to_the_given_kinds():
+    # A backlog of jobs owned by a process that is down (say the HTTP API)
+    # must not hide this process' jobs behind the scan limit.
+    db.init_db()
+    for n in range(5):
+        db.create_generation_job(9201, 0, "t_foreign", f"foreign-{n}")
+    mine = db.create_generation_job(9201, 0, "t_mine", "mine-1")
+
+    assert [job["id"] for job in db.list_pending_generation_jobs(["t_mine"], limit=2)] == [mine]
+    assert db.list_pending_generation_jobs([]) == []
+
+
+def test_dispatcher_asks_only_for_registered_kinds(monkeypatch):
+    asked = []
+
+    def pending(kinds, limit=500):
+        asked.append(sorted(kinds))
+        return []
+
+    monkeypatch.setattr(generation_jobs.db, "list_pending_generation_jobs", pending)
+    generation_jobs._tick(None, None)
+
+    assert asked[-1] == sorted(generation_jobs._kinds)
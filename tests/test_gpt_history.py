@@ -0,0 +1,99 @@
+import itertools
+
+import pytest
+
+import db
+from modules.gpt import history
+
+_user_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def user_id(monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(history, "GPT_HISTORY_TOKENS", 200)
+    monkeypatch.setattr(history, "GPT_HISTORY_LIMIT", 20)
+    monkeypatch.setattr(history, "GPT_SUMMARY", True)
+    monkeypatch.setattr(history, "GPT_SUMMARY_MIN_MESSAGES", 4)
+    return next(_user_ids)
+
+
+def _log_turns(user_id, messages):
+    for index in range(messages):
+        role = "user" if index % 2 == 0 else "assistant"
+        # 80 ASCII characters: 20 tokens + 4 per message.
+        db.log_gpt_message(user_id, role, f"{index:02d}" + "x" * 78)
+
+
+def test_fold_leaves_half_of_the_budget(user_id, monkeypatch):
+    folded = []
+
+    def summarise(summary, messages):
+        folded.append([item["content"][:2] for item in messages])
+        return "notes"
+
+    monkeypatch.setattr(history, "_summarise", summarise)
+    _log_turns(user_id, 20)
+
+    # 200 tokens hold the last 8 messages; 4 fit in half of the budget.
+    assert len(history.build_context(user_id)) == 8
+    history._update_summary(user_id)
+
+    assert folded == [[f"{index:02d}" for index in range(16)]]
+    assert db.get_gpt_summary(user_id) == ("notes", 16)
+    context = history.build_context(user_id)
+    assert context[0]["role"] == "system" and context[0]["content"].endswith("notes")
+    assert [item["content"][:2] for item in context[1:]] == ["16", "17", "18", "19"]
+
+    # The next turns only append after the summary until the budget fills up.
+    _log_turns(user_id, 2)
+    history._update_summary(user_id)
+    assert db.get_gpt_summary(user_id) == ("notes", 16)
+    assert len(history.build_context(user_id)) == 1 + 6
+
+
+def test_fold_skips_non_positive_counts(user_id, monkeypatch):
+    window = [{"role": "user", "content": "x" * 80}] * 6
+    # Everything before the window is summarised and the whole window fits
+    # half of the budget: there is nothing to fold.
+    monkeypatch.setattr(history, "_window", lambda uid: (window, 6, "notes", 6, window))
+    monkeypatch.setattr(history, "GPT_HISTORY_TOKENS", 1000)
+    monkeypatch.setattr(history, "GPT_SUMMARY_MIN_MESSAGES", 0)
+    monkeypatch.setattr(
+        history.db, "get_gpt_messages_range", lambda *args: pytest.fail("called with a non-positive count")
+    )
+
+    history._update_summary(user_id)
+
+
+@pytest.mark.parametrize("folds_before", [0, 1])
+def test_fold_is_dropped_when_history_is_cleared_meanwhile(user_id, monkeypatch, folds_before):
+    monkeypatch.setattr(history, "_summarise", lambda summary, messages: "notes")
+    _log_turns(user_id, 20)
+    for _ in range(folds_before):
+        history._update_summary(user_id)
+        _log_turns(user_id, 12)
+
+    def clear_then_summarise(summary, messages):
+        db.clear_gpt_history(user_id)
+        return "stale notes"
+
+    monkeypatch.setattr(history, "_summarise", clear_then_summarise)
+    history._update_summary(user_id)
+
+    assert db.get_gpt_summary(user_id) == ("", 0)
+    _log_turns(user_id, 2)
+    assert [item["content"][:2] for item in history.build_context(user_id)] == ["00", "01"]
+
+
+def test_summary_write_checks_the_stored_state(user_id):
+    _log_turns(user_id, 20)
+    assert not db.advance_gpt_summary(user_id, "notes", 0, 30)  # not that many messages
+    assert db.advance_gpt_summary(user_id, "notes", 0, 16)
+    assert not db.advance_gpt_summary(user_id, "other", 0, 18)  # summarised meanwhile
+    assert db.get_gpt_summary(user_id) == ("notes", 16)
+
+    db.clear_gpt_history(user_id)
+    _log_turns(user_id, 20)
+    assert not db.advance_gpt_summary(user_id, "stale", 16, 18)
+    assert db.get_gpt_summary(user_id) == ("", 0)
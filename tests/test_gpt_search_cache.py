@@ -0,0 +1,37 @@
+import pytest
+
+from modules.gpt import service
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "bitcoin price",
+        "BTC prices today?",
+        "how much is gold",
+        "latest news on the election",
+        "USD to EUR rate now",
+        "قیمت دلار",
+        "قیمتش چنده؟",
+        "جدیدترین اخبار بورس",
+        "نرخ تتر امروز",
+    ],
+)
+def test_live_queries_get_the_short_ttl(query):
+    assert service.search_ttl(query) == service.GPT_SEARCH_LIVE_TTL
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "what do you know about ethereum",
+        "how accurate is carbon dating",
+        "generate a list of planets",
+        "costa rica capital",
+        "who was the first curator of the louvre",
+        "بیت کوین چیست؟",
+        "تاریخچه بورس تهران",
+    ],
+)
+def test_encyclopedic_queries_get_the_long_ttl(query):
+    assert service.search_ttl(query) == service.GPT_SEARCH_CACHE_TTL
@@ -0,0 +1,38 @@
+from modules.gpt import handlers
+
+
+class _Bot:
+    def __init__(self):
+        self.edits = []
+
+    def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class _Message:
+    message_id = 7
+
+    class chat:
+        id = 1
+
+
+def test_progress_edits_escape_partial_html(monkeypatch):
+    def chunks(messages):
+        yield "if a < b && <b>c"
+        yield " done"
+
+    monkeypatch.setattr(handlers, "stream_chat_completion", chunks)
+    monkeypatch.setattr(handlers, "GPT_STREAM_EDIT_INTERVAL", 0)
+    bot = _Bot()
+
+    answer = handlers._stream_answer(bot, _Message, [])
+
+    assert answer == "if a < b && <b>c done"
+    assert bot.edits[0] == "if a &lt; b &amp;&amp; &lt;b&gt;c" + handlers._PROGRESS_CURSOR
+    assert all("<" not in edit for edit in bot.edits)
+
+
+def test_progress_text_stays_within_message_limit():
+    text = handlers._progress_text("&" * 5000)
+    assert len(text) <= handlers._PROGRESS_MAX_CHARS + len(handlers._PROGRESS_CURSOR)
+    assert text.startswith("&amp;")
@@ -0,0 +1,60 @@
+import threading
+import time
+
+from modules.image.service import ImageService
+
+
+class _Response:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def _service(monkeypatch, handler):
+    monkeypatch.setenv("RUNWAY_API", "token")
+    service = ImageService()
+    monkeypatch.setattr(service, "_request", handler)
+    return service
+
+
+def _concurrently(count, fn):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(fn())) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_identical_concurrent_submits_get_their_own_tasks(monkeypatch):
+    calls = []
+
+    def handler(method, path, **kwargs):
+        calls.append(path)
+        task_id = f"task-{len(calls)}"
+        time.sleep(0.1)
+        return _Response({"id": task_id})
+
+    service = _service(monkeypatch, handler)
+    task_ids = _concurrently(5, lambda: service.generate_image("a cat"))
+
+    assert len(calls) == 5
+    assert len(set(task_ids)) == 5
+
+
+def test_concurrent_status_polls_are_coalesced(monkeypatch):
+    calls = []
+
+    def handler(method, path, **kwargs):
+        calls.append(path)
+        time.sleep(0.1)
+        return _Response({"status": "RUNNING"})
+
+    service = _service(monkeypatch, handler)
+    results = _concurrently(5, lambda: service.check_image_status("task-1"))
+
+    assert results == [None] * 5
+    assert calls == ["/tasks/task-1"]
@@ -0,0 +1,46 @@
+import json
+
+import db
+from modules import scheduler
+
+
+def _task(kind, run_at, key=None):
+    task_id = db.add_scheduled_task(kind, run_at, json.dumps({}), key)
+    return task_id, scheduler._Task(kind, {}, key, run_at)
+
+
+def _row_ids():
+    return {row["id"] for row in db.list_scheduled_tasks()}
+
+
+def test_unhandled_task_stays_queued_until_its_handler_registers(monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(scheduler, "_heap", [])
+    monkeypatch.setattr(scheduler, "_tasks", {})
+    monkeypatch.setattr(scheduler, "_handlers", {})
+    task_id, task = _task("test_late_kind", scheduler.time.time())
+
+    scheduler._execute(task_id, task)
+
+    assert task_id in _row_ids()
+    assert scheduler._tasks[task_id] == task
+    assert scheduler._heap[0][0] >= task.run_at + scheduler.UNHANDLED_RETRY_SECONDS - 1
+
+    ran = []
+    scheduler.register_handler("test_late_kind", lambda bot: ran.append(task_id))
+    scheduler._execute(task_id, scheduler._tasks.pop(task_id))
+    assert ran == [task_id]
+    assert task_id not in _row_ids()
+
+
+def test_orphaned_task_row_is_deleted_after_the_ttl(monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(scheduler, "_heap", [])
+    monkeypatch.setattr(scheduler, "_tasks", {})
+    monkeypatch.setattr(scheduler, "UNHANDLED_TTL", 60)
+    task_id, task = _task("test_orphan_kind", scheduler.time.time() - 61)
+
+    scheduler._execute(task_id, task)
+
+    assert task_id not in _row_ids()
+    assert scheduler._heap == [] and scheduler._tasks == {}
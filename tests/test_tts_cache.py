@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import db
+from modules import tts_cache
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    db.init_db()
+    monkeypatch.setattr(tts_cache, "MAX_BYTES", 100)
+
+
+def _stream(data):
+    return lambda text, voice_id, mime: iter([data[:10], data[10:]])
+
+
+def _synthesize(text, voice_id, mime):
+    pytest.fail("streamed requests do not call synthesize")
+
+
+def test_streamed_miss_survives_eviction_by_another_thread():
+    audio = tts_cache.get_or_synthesize(_synthesize, "evicted", "voice", "model", stream=_stream(b"a" * 40))
+    assert db.get_tts_cache_entry(audio.key) is not None
+
+    # Another thread evicts everything before the caller sends the audio.
+    for path in db.evict_tts_cache(0):
+        os.remove(path)
+
+    with audio.open("Vexa.mp3") as fh:
+        assert fh.read() == b"a" * 40
+    assert audio.read() == b"a" * 40
+
+
+def test_audio_larger_than_the_cache_is_not_cached():
+    audio = tts_cache.get_or_synthesize(_synthesize, "too large", "voice", "model", stream=_stream(b"b" * 150))
+
+    assert db.get_tts_cache_entry(audio.key) is None
+    assert not os.path.exists(audio.path)
+    with audio.open() as fh:
+        assert fh.read() == b"b" * 150
+
+    data = b"c" * 150
+    audio = tts_cache.get_or_synthesize(lambda *args: data, "too large, bytes", "voice", "model")
+    assert db.get_tts_cache_entry(audio.key) is None
+    assert audio.read() == data
+
+
+def test_eviction_never_drops_the_entry_just_written():
+    old = tts_cache.get_or_synthesize(_synthesize, "old", "voice", "model", stream=_stream(b"o" * 60))
+    # Used "later" than anything written now, so LRU alone would pick the new entry.
+    with db.transaction() as con:
+        con.execute("UPDATE tts_cache SET last_used_at=last_used_at+3600 WHERE cache_key=?", (old.key,))
+    new = tts_cache.get_or_synthesize(_synthesize, "new", "voice", "model", stream=_stream(b"n" * 60))
+
+    assert db.get_tts_cache_entry(new.key) is not None
+    assert db.get_tts_cache_entry(old.key) is None
+    with new.open() as fh:
+        assert fh.read() == b"n" * 60
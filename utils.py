@@ -35,6 +35,31 @@ def feature_label(feature_key: str, lang: str) -> str:
 def feature_disabled_text(feature_key: str, lang: str) -> str:
     return t("feature_disabled", lang).format(feature=feature_label(feature_key, lang))
 
+# --- state routing for message handler predicates ---
+# TeleBot tests every registered ``func=`` predicate in turn for each incoming
+# message. The sender's state is resolved once and stored on the message, so
+# all state predicates for that update share a single lookup.
+_MESSAGE_STATE_ATTR = "_vexa_state"
+
+
+def message_state(message) -> str:
+    state = getattr(message, _MESSAGE_STATE_ATTR, None)
+    if state is None:
+        state = db.get_state(message.from_user.id) or ""
+        try:
+            setattr(message, _MESSAGE_STATE_ATTR, state)
+        except AttributeError:
+            pass
+    return state
+
+
+def state_equals(state: str):
+    return lambda message: message_state(message) == state
+
+
+def state_startswith(prefix: str):
+    return lambda message: message_state(message).startswith(prefix)
+
 def edit_or_send(bot, chat_id, message_id, text, reply_markup=None, parse_mode="HTML"):
     try:
         bot.edit_message_text(chat_id=chat_id, message_id=message_id,